@@ -1,6 +1,7 @@
 import datetime
-import json as classic_json
 import multiprocessing as mp
+import os
+import queue
 import time
 from typing import Dict
 from typing import NoReturn
@@ -28,8 +29,12 @@ from artemis_utils.envvars import REST_PORT
 from artemis_utils.envvars import WITHDRAWN_HIJACK_THRESHOLD
 from artemis_utils.rabbitmq import create_exchange
 from artemis_utils.rabbitmq import create_queue
+from artemis_utils.redis import decode_redis_hijack
+from artemis_utils.redis import encode_redis_hijack
+from artemis_utils.redis import HIJACK_PURGE_SCRIPT
 from artemis_utils.redis import ping_redis
-from artemis_utils.redis import purge_redis_eph_pers_keys
+from artemis_utils.redis import purge_redis_hijack
+from artemis_utils.redis import REDIS_HIJACK_LUA_HELPERS
 from artemis_utils.redis import redis_key
 from artemis_utils.service import wait_data_worker_dependencies
 from kombu import Connection
@@ -49,11 +54,6 @@ shared_memory_locks = {
     "monitored_prefixes": mp.Lock(),
     "configured_prefix_count": mp.Lock(),
     "config_timestamp": mp.Lock(),
-    "insert_bgp_entries": mp.Lock(),
-    "handle_bgp_withdrawals": mp.Lock(),
-    "handled_bgp_entries": mp.Lock(),
-    "outdate_hijacks": mp.Lock(),
-    "insert_hijacks_entries": mp.Lock(),
     "monitors": mp.Lock(),
     "service_reconfiguring": mp.Lock(),
 }
@@ -64,6 +64,44 @@ VIEWS = ["view_configs", "view_bgpupdates", "view_hijacks"]
 SERVICE_NAME = "database"
 DATA_WORKER_DEPENDENCIES = [PREFIXTREE_HOST, NOTIFIER_HOST]
 
+# number of BGP update keys cached per hijack; past this cap the hijack
+# updates are looked up in the database (bgp_updates.hijack_key) instead
+HIJACK_BGPUPDATE_KEYS_CAP = int(os.getenv("HIJACK_BGPUPDATE_KEYS_CAP", 10000))
+# max number of messages whose rows are staged for the bulk updater (and of rows
+# pending for the next bulk update); when the staging queue is full, the data
+# worker stops consuming messages
+DB_STAGING_QUEUE_SIZE = int(os.getenv("DB_STAGING_QUEUE_SIZE", 10000))
+# prefetch count of the staged consumers; their messages are only acked after
+# the bulk update that commits their rows, so that many may be unacked at once
+# (AMQP caps the prefetch count to 65535)
+STAGED_PREFETCH_COUNT = min(DB_STAGING_QUEUE_SIZE, 65535)
+# max number of retries of a failed bulk write; past them, its rows are dropped
+# (and their keys logged), so that they cannot stall the bulk updates forever
+DB_BULK_UPDATE_MAX_RETRIES = int(os.getenv("DB_BULK_UPDATE_MAX_RETRIES", 10))
+# seconds to wait for room in the full staging queue before checking the
+# heartbeats of the rabbitmq connection again
+STAGING_QUEUE_PUT_TIMEOUT = 1
+
+# atomically adds BGP update keys to an existing redis hijack and returns
+# {hijack fields, peers seen} of the hijack (if any)
+# KEYS: hijack, peers seen, BGP update keys
+# ARGV: BGP update keys cap, BGP update keys
+HIJACK_ADD_UPDATE_KEYS_SCRIPT = (
+    REDIS_HIJACK_LUA_HELPERS
+    + """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return {{}, {}}
+end
+-- copied one by one, since unpack is limited by the Lua C stack (~8000 values)
+local new_keys = {}
+for i = 2, #ARGV do
+    new_keys[#new_keys + 1] = ARGV[i]
+end
+add_bgpupdate_keys(KEYS[1], KEYS[3], tonumber(ARGV[1]), new_keys)
+return {redis.call("HGETALL", KEYS[1]), redis.call("SMEMBERS", KEYS[2])}
+"""
+)
+
 
 def save_config(wo_db, config_hash, yaml_config, raw_config, comment, config_timestamp):
     try:
@@ -482,6 +520,7 @@ class HijackMultiActionHandler(RequestHandler):
             database=DB_NAME,
         )
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+        self.redis_purge_hijack = self.redis.register_script(HIJACK_PURGE_SCRIPT)
 
     def post(self):
         """
@@ -543,68 +582,66 @@ class HijackMultiActionHandler(RequestHandler):
                         elif ignore_action:
                             # if ongoing, clear redis
                             if self.redis.sismember("persistent-keys", hijack_key):
-                                purge_redis_eph_pers_keys(
-                                    self.redis, redis_hijack_key, hijack_key
+                                purge_redis_hijack(
+                                    self.redis_purge_hijack,
+                                    redis_hijack_key,
+                                    hijack_key,
                                 )
                             self.wo_db.execute(query, (hijack_key,))
                         elif resolve_action:
                             # if ongoing, clear redis
                             if self.redis.sismember("persistent-keys", hijack_key):
-                                purge_redis_eph_pers_keys(
-                                    self.redis, redis_hijack_key, hijack_key
+                                purge_redis_hijack(
+                                    self.redis_purge_hijack,
+                                    redis_hijack_key,
+                                    hijack_key,
                                 )
                             self.wo_db.execute(
                                 query, (datetime.datetime.now(), hijack_key)
                             )
                         elif delete_action:
-                            redis_hijack = self.redis.get(redis_hijack_key)
+                            bgpupdate_keys = self.redis.smembers(
+                                "hijack_{}_bgpupdate_keys".format(redis_hijack_key)
+                            )
                             if self.redis.sismember("persistent-keys", hijack_key):
-                                purge_redis_eph_pers_keys(
-                                    self.redis, redis_hijack_key, hijack_key
-                                )
-                            log.debug(
-                                "redis-entry for {}: {}".format(
-                                    redis_hijack_key, redis_hijack
+                                purge_redis_hijack(
+                                    self.redis_purge_hijack,
+                                    redis_hijack_key,
+                                    hijack_key,
                                 )
-                            )
                             self.wo_db.execute(query, (hijack_key,))
-                            if redis_hijack and classic_json.loads(
-                                redis_hijack.decode("utf-8")
-                            ).get("bgpupdate_keys", []):
+                            # the cached keys are dropped once they exceed the cap
+                            if bgpupdate_keys:
                                 log.debug("deleting hijack using cache for bgp updates")
-                                redis_hijack = classic_json.loads(
-                                    redis_hijack.decode("utf-8")
-                                )
+                                bgpupdate_keys = [
+                                    bgpupdate_key.decode("utf-8")
+                                    for bgpupdate_key in bgpupdate_keys
+                                ]
                                 log.debug(
                                     "bgpupdate_keys {} for {}".format(
-                                        redis_hijack["bgpupdate_keys"], redis_hijack
+                                        bgpupdate_keys, redis_hijack_key
                                     )
                                 )
                                 self.wo_db.execute(
-                                    "DELETE FROM bgp_updates WHERE %s = ANY(hijack_key) AND handled = true AND array_length(hijack_key,1) = 1 AND key = ANY(%s);",
-                                    (hijack_key, list(redis_hijack["bgpupdate_keys"])),
+                                    "DELETE FROM bgp_updates WHERE hijack_key @> ARRAY[%s]::text[] AND handled = true AND array_length(hijack_key,1) = 1 AND key = ANY(%s);",
+                                    (hijack_key, bgpupdate_keys),
                                 )
                                 self.wo_db.execute(
                                     "UPDATE bgp_updates SET hijack_key = array_remove(hijack_key, %s) WHERE handled = true AND key = ANY(%s);",
-                                    (hijack_key, list(redis_hijack["bgpupdate_keys"])),
+                                    (hijack_key, bgpupdate_keys),
                                 )
                             else:
                                 log.debug(
                                     "deleting hijack by querying bgp updates database"
                                 )
                                 self.wo_db.execute(
-                                    "DELETE FROM bgp_updates WHERE %s = ANY(hijack_key) AND array_length(hijack_key,1) = 1 AND handled = true;",
+                                    "DELETE FROM bgp_updates WHERE hijack_key @> ARRAY[%s]::text[] AND array_length(hijack_key,1) = 1 AND handled = true;",
                                     (hijack_key,),
                                 )
                                 self.wo_db.execute(
-                                    "UPDATE bgp_updates SET hijack_key = array_remove(hijack_key, %s) WHERE %s = ANY(hijack_key) AND handled = true;",
+                                    "UPDATE bgp_updates SET hijack_key = array_remove(hijack_key, %s) WHERE hijack_key @> ARRAY[%s]::text[] AND handled = true;",
                                     (hijack_key, hijack_key),
                                 )
-                                log.debug(
-                                    "bgpupdate_keys is empty for {}".format(
-                                        redis_hijack
-                                    )
-                                )
                         else:
                             raise BaseException("unreachable code reached")
 
@@ -636,11 +673,6 @@ class Database:
         self.shared_memory_manager_dict["monitors"] = {}
         self.shared_memory_manager_dict["configured_prefix_count"] = 0
         self.shared_memory_manager_dict["config_timestamp"] = -1
-        self.shared_memory_manager_dict["insert_bgp_entries"] = list()
-        self.shared_memory_manager_dict["handle_bgp_withdrawals"] = list()
-        self.shared_memory_manager_dict["handled_bgp_entries"] = list()
-        self.shared_memory_manager_dict["outdate_hijacks"] = list()
-        self.shared_memory_manager_dict["insert_hijacks_entries"] = {}
 
     def make_rest_app(self):
         return Application(
@@ -690,9 +722,27 @@ class DatabaseBulkUpdater:
     Database bulk updater.
     """
 
-    def __init__(self, connection, shared_memory_manager_dict):
+    def __init__(
+        self, connection, shared_memory_manager_dict, staging_queue, committed_queue
+    ):
         self.connection = connection
         self.shared_memory_manager_dict = shared_memory_manager_dict
+        # rows staged by the data worker, and the rows of the next bulk update
+        # (owned by the bulk updater process, deduplicated upon draining)
+        self.staging_queue = staging_queue
+        # sequence numbers of the drained messages, handed back to the data worker
+        # (to be acked) once the bulk update that writes their rows succeeds
+        self.committed_queue = committed_queue
+        self.drained_messages = []
+        # BGP update key -> row (the latest one of duplicate keys)
+        self.insert_bgp_entries = {}
+        self.handle_bgp_withdrawals = {}
+        self.handled_bgp_entries = set()
+        self.outdate_hijacks = {}
+        self.insert_hijacks_entries = {}
+        # set when a write of the last bulk update failed (its rows are retried)
+        self.bulk_update_failed = False
+        self.bulk_update_retries = 0
 
         # DB variables
         self.ro_db = DB(
@@ -722,27 +772,121 @@ class DatabaseBulkUpdater:
 
         # redis db
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+        self.redis_add_hijack_update_keys = self.redis.register_script(
+            HIJACK_ADD_UPDATE_KEYS_SCRIPT
+        )
+        self.redis_purge_hijack = self.redis.register_script(HIJACK_PURGE_SCRIPT)
+
+    def _pending_rows(self):
+        return (
+            len(self.insert_bgp_entries)
+            + len(self.handle_bgp_withdrawals)
+            + len(self.handled_bgp_entries)
+            + len(self.outdate_hijacks)
+            + len(self.insert_hijacks_entries)
+        )
+
+    def _drain_staging_queue(self):
+        """
+        Moves the rows staged by the data worker to the rows of the next bulk update,
+        keeping the latest row of duplicate keys. Nothing is drained while the rows
+        of the last bulk update are retried, nor past DB_STAGING_QUEUE_SIZE pending
+        rows, so that the staging queue fills up and the data worker stops consuming
+        messages.
+        """
+        if self.bulk_update_failed:
+            return
+        # bounded, so that a busy data worker cannot postpone the bulk update forever
+        for _ in range(DB_STAGING_QUEUE_SIZE):
+            if self._pending_rows() >= DB_STAGING_QUEUE_SIZE:
+                break
+            try:
+                seq, entry_type, entries = self.staging_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.drained_messages.append(seq)
+            if entry_type == "insert_bgp_entries":
+                for entry in entries:
+                    self.insert_bgp_entries[entry[1]] = entry
+            elif entry_type == "handle_bgp_withdrawals":
+                self.handle_bgp_withdrawals.update(dict.fromkeys(entries))
+            elif entry_type == "handled_bgp_entries":
+                self.handled_bgp_entries.update(entries)
+            elif entry_type == "outdate_hijacks":
+                self.outdate_hijacks.update(dict.fromkeys(entries))
+            elif entry_type == "insert_hijacks_entries":
+                for hijack in entries:
+                    self._merge_hijack_entry(hijack)
+
+    def _merge_hijack_entry(self, msg_):
+        key = msg_["key"]  # persistent hijack key
+        if key not in self.insert_hijacks_entries:
+            self.insert_hijacks_entries[key] = {
+                "prefix": msg_["prefix"],
+                "hijack_as": msg_["hijack_as"],
+                "type": msg_["type"],
+                "time_started": msg_["time_started"],
+                "time_last": msg_["time_last"],
+                "peers_seen": list(msg_["peers_seen"]),
+                "asns_inf": set(msg_["asns_inf"]),
+                "num_peers_seen": len(msg_["peers_seen"]),
+                "num_asns_inf": msg_["num_asns_inf"],
+                "monitor_keys": set(msg_["monitor_keys"]),
+                "time_detected": msg_["time_detected"],
+                "configured_prefix": msg_["configured_prefix"],
+                "timestamp_of_config": msg_["timestamp_of_config"],
+                "community_annotation": msg_["community_annotation"],
+                "rpki_status": msg_["rpki_status"],
+            }
+        else:
+            entry = self.insert_hijacks_entries[key]
+            entry["time_started"] = min(entry["time_started"], msg_["time_started"])
+            entry["time_last"] = max(entry["time_last"], msg_["time_last"])
+            entry["peers_seen"] = list(msg_["peers_seen"])
+            # only the infected ASes of each hijack update are sent
+            entry["asns_inf"].update(msg_["asns_inf"])
+            entry["num_peers_seen"] = len(msg_["peers_seen"])
+            entry["num_asns_inf"] = max(entry["num_asns_inf"], msg_["num_asns_inf"])
+            entry["monitor_keys"].update(msg_["monitor_keys"])
+            entry["community_annotation"] = msg_["community_annotation"]
+            entry["rpki_status"] = msg_["rpki_status"]
+
+    def _bgp_update_rows(self):
+        # the communities and original path are JSON-encoded here, while copying,
+        # instead of in the data worker
+        for entry in self.insert_bgp_entries.values():
+            yield entry[:7] + (json.dumps(entry[7]),) + entry[8:12] + (
+                json.dumps(entry[12]),
+            )
 
     def _insert_bgp_updates(self):
-        shared_memory_locks["insert_bgp_entries"].acquire()
         num_of_entries = 0
         try:
-            query = (
-                "INSERT INTO bgp_updates (prefix, key, origin_as, peer_asn, as_path, service, type, communities, "
-                "timestamp, hijack_key, handled, matched_prefix, orig_path) VALUES %s"
-            )
-            self.wo_db.execute_values(
-                query,
-                self.shared_memory_manager_dict["insert_bgp_entries"],
-                page_size=1000,
+            self.wo_db.copy_values(
+                "bgp_updates",
+                [
+                    "prefix",
+                    "key",
+                    "origin_as",
+                    "peer_asn",
+                    "as_path",
+                    "service",
+                    "type",
+                    "communities",
+                    "timestamp",
+                    "hijack_key",
+                    "handled",
+                    "matched_prefix",
+                    "orig_path",
+                ],
+                self._bgp_update_rows(),
             )
-            num_of_entries = len(self.shared_memory_manager_dict["insert_bgp_entries"])
-            self.shared_memory_manager_dict["insert_bgp_entries"] = []
+            num_of_entries = len(self.insert_bgp_entries)
+            self.insert_bgp_entries = {}
         except Exception:
             log.exception("exception")
             num_of_entries = -1
         finally:
-            shared_memory_locks["insert_bgp_entries"].release()
             return num_of_entries
 
     def _update_bgp_updates(self):
@@ -751,23 +895,17 @@ class DatabaseBulkUpdater:
         timestamp_thres = time.time() - 7 * 24 * 60 * 60 if HISTORIC == "false" else 0
         timestamp_thres = datetime.datetime.fromtimestamp(timestamp_thres)
         # Update the BGP entries using the hijack messages
-        handled_bgp_entries = set(
-            self.shared_memory_manager_dict["handled_bgp_entries"]
-        )
-        for hijack_key in self.shared_memory_manager_dict["insert_hijacks_entries"]:
-            for bgp_entry_to_update in self.shared_memory_manager_dict[
-                "insert_hijacks_entries"
-            ][hijack_key]["monitor_keys"]:
+        for hijack_key in self.insert_hijacks_entries:
+            for bgp_entry_to_update in self.insert_hijacks_entries[hijack_key][
+                "monitor_keys"
+            ]:
                 num_of_updates += 1
                 update_bgp_entries.add(
                     (hijack_key, bgp_entry_to_update, timestamp_thres)
                 )
                 # exclude handle bgp updates that point to same hijack as
                 # this
-                handled_bgp_entries.discard(bgp_entry_to_update)
-        self.shared_memory_manager_dict["handled_bgp_entries"] = list(
-            handled_bgp_entries
-        )
+                self.handled_bgp_entries.discard(bgp_entry_to_update)
 
         if update_bgp_entries:
             try:
@@ -808,102 +946,40 @@ class DatabaseBulkUpdater:
                 update_bgp_entries_serial.clear()
                 update_bgp_entries_dict.clear()
 
-                # calculate new withdrawn peers seeing the new update announcements
-
-                # get all bgp updates (announcements) keys that were just updated
-                # plus the related hijack keys
+                # calculate new withdrawn peers seeing the new update announcements:
+                # per (hijack, prefix, peer) of the just updated announcements, a peer is
+                # removed from the withdrawn peers of the hijack if its latest announcement
+                # is newer than its latest withdrawal
                 updated_hijack_keys = set(map(lambda x: x[0], update_bgp_entries))
                 updated_bgp_update_keys = set(map(lambda x: x[1], update_bgp_entries))
-
-                # get all handled hijack update entries of type 'A' that belong to this set
-                # (ordered by DESC timestamp)
-                query = (
-                    "SELECT key, prefix, peer_asn, hijack_key, timestamp "
-                    "FROM bgp_updates WHERE handled = true AND type = 'A'"
-                    "AND hijack_key<>ARRAY[]::text[] "
-                    "ORDER BY timestamp DESC"
-                )
-                ann_updates_entries = self.ro_db.execute(query)
-                hijacks_to_ann_prefix_peer_timestamp = {}
-                for entry in ann_updates_entries:
-                    hijack_keys = entry[3]
-                    for hijack_key in hijack_keys:
-                        if (
-                            hijack_key in updated_hijack_keys
-                            and entry[0] in updated_bgp_update_keys
-                        ):
-                            prefix_peer = "{}-{}".format(entry[1], entry[2])
-                            if hijack_key not in hijacks_to_ann_prefix_peer_timestamp:
-                                hijacks_to_ann_prefix_peer_timestamp[hijack_key] = {}
-                            # the following needs to take place only the first time the prefix-peer combo is encountered
-                            if (
-                                prefix_peer
-                                not in hijacks_to_ann_prefix_peer_timestamp[hijack_key]
-                            ):
-                                hijacks_to_ann_prefix_peer_timestamp[hijack_key][
-                                    prefix_peer
-                                ] = (entry[4].timestamp(), entry[2])
-
-                # get all handled hijack updates of type 'W' (ordered by DESC timestamp)
-                query = (
-                    "SELECT key, prefix, peer_asn, hijack_key, timestamp "
-                    "FROM bgp_updates WHERE handled = true AND type = 'W'"
-                    "AND hijack_key<>ARRAY[]::text[] "
-                    "ORDER BY timestamp DESC"
-                )
-                wit_updates_entries = self.ro_db.execute(query)
-                hijacks_to_wit_prefix_peer_timestamp = {}
-                for entry in wit_updates_entries:
-                    hijack_keys = entry[3]
-                    for hijack_key in hijack_keys:
-                        if hijack_key in updated_hijack_keys:
-                            prefix_peer = "{}-{}".format(entry[1], entry[2])
-                            if hijack_key not in hijacks_to_wit_prefix_peer_timestamp:
-                                hijacks_to_wit_prefix_peer_timestamp[hijack_key] = {}
-                            # the following needs to take place only the first time the prefix-peer combo is encountered
-                            if (
-                                prefix_peer
-                                not in hijacks_to_wit_prefix_peer_timestamp[hijack_key]
-                            ):
-                                hijacks_to_wit_prefix_peer_timestamp[hijack_key][
-                                    prefix_peer
-                                ] = (entry[4].timestamp(), entry[2])
-
-                # check what peers need to be removed from withdrawn sets
-                remove_withdrawn_peers = set()
-                for hijack_key in hijacks_to_ann_prefix_peer_timestamp:
-                    if hijack_key in hijacks_to_wit_prefix_peer_timestamp:
-                        for prefix_peer in hijacks_to_ann_prefix_peer_timestamp[
-                            hijack_key
-                        ]:
-                            if (
-                                prefix_peer
-                                in hijacks_to_wit_prefix_peer_timestamp[hijack_key]
-                            ):
-                                if (
-                                    hijacks_to_wit_prefix_peer_timestamp[hijack_key][
-                                        prefix_peer
-                                    ][0]
-                                    < hijacks_to_ann_prefix_peer_timestamp[hijack_key][
-                                        prefix_peer
-                                    ][0]
-                                ):
-                                    remove_withdrawn_peers.add(
-                                        (
-                                            hijack_key,
-                                            hijacks_to_ann_prefix_peer_timestamp[
-                                                hijack_key
-                                            ][prefix_peer][1],
-                                        )
-                                    )
-
-                # execute query
                 query = (
-                    "UPDATE hijacks SET peers_withdrawn=array_remove(peers_withdrawn, data.v2::BIGINT) FROM "
-                    "(VALUES %s) AS data (v1, v2) WHERE hijacks.key=data.v1"
+                    "WITH ann AS ("
+                    "SELECT DISTINCT ON (h.hijack_key, u.prefix, u.peer_asn) "
+                    "h.hijack_key, u.prefix, u.peer_asn, u.timestamp "
+                    "FROM bgp_updates u CROSS JOIN LATERAL unnest(u.hijack_key) AS h (hijack_key) "
+                    "WHERE u.key = ANY(%s::text[]) AND u.handled = true AND u.type = 'A' "
+                    "AND u.hijack_key && %s::text[] AND h.hijack_key = ANY(%s::text[]) "
+                    "ORDER BY h.hijack_key, u.prefix, u.peer_asn, u.timestamp DESC), "
+                    "wit AS ("
+                    "SELECT DISTINCT ON (ann.hijack_key, ann.prefix, ann.peer_asn) "
+                    "ann.hijack_key, ann.peer_asn, ann.timestamp AS ann_timestamp, w.timestamp "
+                    "FROM ann JOIN bgp_updates w ON w.prefix = ann.prefix AND w.peer_asn = ann.peer_asn "
+                    "AND w.type = 'W' AND w.handled = true AND w.hijack_key @> ARRAY[ann.hijack_key] "
+                    "ORDER BY ann.hijack_key, ann.prefix, ann.peer_asn, w.timestamp DESC), "
+                    "data AS ("
+                    "SELECT hijack_key, array_agg(peer_asn) AS peers FROM wit "
+                    "WHERE timestamp < ann_timestamp GROUP BY hijack_key) "
+                    "UPDATE hijacks SET peers_withdrawn=ARRAY("
+                    "SELECT peer FROM unnest(hijacks.peers_withdrawn) AS peer WHERE peer <> ALL(data.peers)) "
+                    "FROM data WHERE hijacks.key=data.hijack_key"
                 )
-                self.wo_db.execute_values(
-                    query, list(remove_withdrawn_peers), page_size=1000
+                self.wo_db.execute(
+                    query,
+                    (
+                        list(updated_bgp_update_keys),
+                        list(updated_hijack_keys),
+                        list(updated_hijack_keys),
+                    ),
                 )
 
             except Exception:
@@ -914,23 +990,19 @@ class DatabaseBulkUpdater:
         update_bgp_entries.clear()
 
         # Update the BGP entries using the handled messages
-        if self.shared_memory_manager_dict["handled_bgp_entries"]:
+        if self.handled_bgp_entries:
             try:
                 query = "UPDATE bgp_updates SET handled=true FROM (VALUES %s) AS data (key) WHERE bgp_updates.key=data.key"
                 self.wo_db.execute_values(
                     query,
-                    self.shared_memory_manager_dict["handled_bgp_entries"],
+                    list(self.handled_bgp_entries),
                     page_size=1000,
                 )
-                num_of_updates += len(
-                    self.shared_memory_manager_dict["handled_bgp_entries"]
-                )
-                self.shared_memory_manager_dict["handled_bgp_entries"] = []
+                num_of_updates += len(self.handled_bgp_entries)
+                self.handled_bgp_entries = set()
             except Exception:
                 log.exception(
-                    "handled bgp entries {}".format(
-                        len(self.shared_memory_manager_dict["handled_bgp_entries"])
-                    )
+                    "handled bgp entries {}".format(len(self.handled_bgp_entries))
                 )
                 num_of_updates = -1
 
@@ -943,50 +1015,36 @@ class DatabaseBulkUpdater:
                 "INSERT INTO hijacks (key, type, prefix, hijack_as, num_peers_seen, num_asns_inf, "
                 "time_started, time_last, time_ended, mitigation_started, time_detected, under_mitigation, "
                 "active, resolved, ignored, withdrawn, dormant, configured_prefix, timestamp_of_config, comment, peers_seen, peers_withdrawn, asns_inf, community_annotation, rpki_status) "
-                "VALUES %s ON CONFLICT(key, time_detected) DO UPDATE SET num_peers_seen=excluded.num_peers_seen, num_asns_inf=excluded.num_asns_inf "
+                "VALUES %s ON CONFLICT(key, time_detected) DO UPDATE SET num_peers_seen=excluded.num_peers_seen, "
+                "num_asns_inf=GREATEST(excluded.num_asns_inf, hijacks.num_asns_inf) "
                 ", time_started=LEAST(excluded.time_started, hijacks.time_started), time_last=GREATEST(excluded.time_last, hijacks.time_last), "
-                "peers_seen=excluded.peers_seen, asns_inf=excluded.asns_inf, dormant=false, timestamp_of_config=excluded.timestamp_of_config, "
+                "peers_seen=excluded.peers_seen, asns_inf=ARRAY(SELECT DISTINCT UNNEST(hijacks.asns_inf || excluded.asns_inf)), "
+                "dormant=false, timestamp_of_config=excluded.timestamp_of_config, "
                 "configured_prefix=excluded.configured_prefix, community_annotation=excluded.community_annotation, rpki_status=excluded.rpki_status"
             )
 
             values = []
-            for key in self.shared_memory_manager_dict["insert_hijacks_entries"]:
+            for key in self.insert_hijacks_entries:
                 entry = (
                     key,  # key
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "type"
-                    ],  # type
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "prefix"
-                    ],  # prefix
+                    self.insert_hijacks_entries[key]["type"],  # type
+                    self.insert_hijacks_entries[key]["prefix"],  # prefix
                     # hijack_as
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "hijack_as"
-                    ],
+                    self.insert_hijacks_entries[key]["hijack_as"],
                     # num_peers_seen
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "num_peers_seen"
-                    ],
+                    self.insert_hijacks_entries[key]["num_peers_seen"],
                     # num_asns_inf
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "num_asns_inf"
-                    ],
+                    self.insert_hijacks_entries[key]["num_asns_inf"],
                     datetime.datetime.fromtimestamp(
-                        self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                            "time_started"
-                        ]
+                        self.insert_hijacks_entries[key]["time_started"]
                     ),  # time_started
                     datetime.datetime.fromtimestamp(
-                        self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                            "time_last"
-                        ]
+                        self.insert_hijacks_entries[key]["time_last"]
                     ),  # time_last
                     None,  # time_ended
                     None,  # mitigation_started
                     datetime.datetime.fromtimestamp(
-                        self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                            "time_detected"
-                        ]
+                        self.insert_hijacks_entries[key]["time_detected"]
                     ),  # time_detected
                     False,  # under_mitigation
                     True,  # active
@@ -995,38 +1053,24 @@ class DatabaseBulkUpdater:
                     False,  # withdrawn
                     False,  # dormant
                     # configured_prefix
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "configured_prefix"
-                    ],
+                    self.insert_hijacks_entries[key]["configured_prefix"],
                     datetime.datetime.fromtimestamp(
-                        self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                            "timestamp_of_config"
-                        ]
+                        self.insert_hijacks_entries[key]["timestamp_of_config"]
                     ),  # timestamp_of_config
                     "",  # comment
                     # peers_seen
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "peers_seen"
-                    ],
+                    self.insert_hijacks_entries[key]["peers_seen"],
                     [],  # peers_withdrawn
                     # asns_inf
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "asns_inf"
-                    ],
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "community_annotation"
-                    ],
-                    self.shared_memory_manager_dict["insert_hijacks_entries"][key][
-                        "rpki_status"
-                    ],
+                    list(self.insert_hijacks_entries[key]["asns_inf"]),
+                    self.insert_hijacks_entries[key]["community_annotation"],
+                    self.insert_hijacks_entries[key]["rpki_status"],
                 )
                 values.append(entry)
 
             self.wo_db.execute_values(query, values, page_size=1000)
-            num_of_entries = len(
-                self.shared_memory_manager_dict["insert_hijacks_entries"]
-            )
-            self.shared_memory_manager_dict["insert_hijacks_entries"] = {}
+            num_of_entries = len(self.insert_hijacks_entries)
+            self.insert_hijacks_entries = {}
         except Exception:
             log.exception("exception")
             num_of_entries = -1
@@ -1036,119 +1080,169 @@ class DatabaseBulkUpdater:
     def _handle_bgp_withdrawals(self):
         timestamp_thres = time.time() - 7 * 24 * 60 * 60 if HISTORIC == "false" else 0
         timestamp_thres = datetime.datetime.fromtimestamp(timestamp_thres)
+        # the active hijacks matching the withdrawals of the batch, along with the latest
+        # handled announcement of the withdrawn prefix-peer, in one query
         query = (
-            "SELECT DISTINCT ON (hijacks.key) hijacks.peers_seen, hijacks.peers_withdrawn, "
+            "SELECT DISTINCT ON (data.key, hijacks.key) data.key, hijacks.peers_seen, hijacks.peers_withdrawn, "
             "hijacks.key, hijacks.hijack_as, hijacks.type, bgp_updates.timestamp, hijacks.time_last "
-            "FROM hijacks LEFT JOIN bgp_updates ON (hijacks.key = ANY(bgp_updates.hijack_key)) "
-            "WHERE bgp_updates.prefix = %s "
-            "AND bgp_updates.type = 'A' "
+            "FROM unnest(%s::inet[], %s::bigint[], %s::text[]) AS data (prefix, peer_asn, key) "
+            "JOIN bgp_updates ON (bgp_updates.prefix = data.prefix AND bgp_updates.peer_asn = data.peer_asn) "
+            "JOIN hijacks ON (hijacks.key = ANY(bgp_updates.hijack_key)) "
+            "WHERE bgp_updates.type = 'A' "
             "AND bgp_updates.timestamp >= %s "
             "AND hijacks.active = true "
-            "AND bgp_updates.peer_asn = %s "
             "AND bgp_updates.handled = true "
-            "ORDER BY hijacks.key, bgp_updates.timestamp DESC"
+            "ORDER BY data.key, hijacks.key, bgp_updates.timestamp DESC"
         )
+        # withdrawal -> 0: prefix, 1: peer_asn, 2: timestamp, 3: key
+        withdrawals = list(self.handle_bgp_withdrawals)
+        num_of_entries = len(withdrawals)
+        self.handle_bgp_withdrawals = {}
         update_normal_withdrawals = set()
         update_hijack_withdrawals = set()
-        shared_memory_locks["handle_bgp_withdrawals"].acquire()
-        for withdrawal in self.shared_memory_manager_dict["handle_bgp_withdrawals"]:
+        if withdrawals:
             try:
-                # withdrawal -> 0: prefix, 1: peer_asn, 2: timestamp, 3:
-                # key
                 entries = self.ro_db.execute(
-                    query, (withdrawal[0], timestamp_thres, withdrawal[1])
+                    query,
+                    (
+                        [withdrawal[0] for withdrawal in withdrawals],
+                        [withdrawal[1] for withdrawal in withdrawals],
+                        [withdrawal[3] for withdrawal in withdrawals],
+                        timestamp_thres,
+                    ),
                 )
-
-                if not entries:
-                    update_normal_withdrawals.add((withdrawal[3],))
-                    continue
+                withdrawal_entries = {}
                 for entry in entries:
-                    # entry -> 0: peers_seen, 1: peers_withdrawn, 2:
-                    # hij.key, 3: hij.as, 4: hij.type, 5: timestamp
-                    # 6: time_last
-                    update_hijack_withdrawals.add((entry[2], withdrawal[3]))
-                    # update the bgpupdate_keys related to this hijack with withdrawals
-                    redis_hijack_key = redis_key(withdrawal[0], entry[3], entry[4])
-                    # to prevent detectors from working in parallel with hijack update
-                    hijack = None
-                    if self.redis.exists("{}token_active".format(redis_hijack_key)):
-                        self.redis.set("{}token_active".format(redis_hijack_key), "1")
-                    if self.redis.exists("{}token".format(redis_hijack_key)):
-                        token = self.redis.blpop(
-                            "{}token".format(redis_hijack_key), timeout=60
-                        )
-                        if not token:
-                            log.info(
-                                "Redis withdrawal addition encountered redis token timeout for hijack {}".format(
-                                    entry[2]
-                                )
-                            )
-                        hijack = self.redis.get(redis_hijack_key)
-                        redis_pipeline = self.redis.pipeline()
-                        if hijack:
-                            hijack = classic_json.loads(hijack.decode("utf-8"))
-                            hijack["bgpupdate_keys"] = list(
-                                set(hijack["bgpupdate_keys"] + [withdrawal[3]])
-                            )
-                            redis_pipeline.set(redis_hijack_key, json.dumps(hijack))
-                        redis_pipeline.lpush(
-                            "{}token".format(redis_hijack_key), "token"
-                        )
-                        redis_pipeline.execute()
-                    if entry[5] > withdrawal[2]:
-                        continue
-                    # matching withdraw with a hijack
-                    if withdrawal[1] not in entry[1] and withdrawal[1] in entry[0]:
-                        entry[1].append(withdrawal[1])
-                        timestamp = max(withdrawal[2], entry[6])
-                        # if a certain percentage of hijack 'A' peers see corresponding hijack 'W'
-                        if len(entry[1]) >= int(
-                            round(WITHDRAWN_HIJACK_THRESHOLD * len(entry[0]) / 100.0)
+                    withdrawal_entries.setdefault(entry[0], []).append(entry[1:])
+
+                # apply the withdrawals in order to the (cached) hijacks they match,
+                # so that each one sees the peers withdrawn by the previous ones
+                hijacks = {}
+                for withdrawal in withdrawals:
+                    matched = False
+                    for entry in withdrawal_entries.get(withdrawal[3], []):
+                        # entry -> 0: peers_seen, 1: peers_withdrawn, 2:
+                        # hij.key, 3: hij.as, 4: hij.type, 5: timestamp
+                        # 6: time_last
+                        if entry[2] not in hijacks:
+                            hijacks[entry[2]] = {
+                                "redis_key": redis_key(
+                                    withdrawal[0], entry[3], entry[4]
+                                ),
+                                "peers_seen": entry[0],
+                                "peers_withdrawn": entry[1],
+                                "time_last": entry[6],
+                                "bgpupdate_keys": [],
+                                "updated": False,
+                                "withdrawn": False,
+                            }
+                        hijack = hijacks[entry[2]]
+                        # hijacks withdrawn by a previous withdrawal are no longer active
+                        if hijack["withdrawn"]:
+                            continue
+                        matched = True
+                        update_hijack_withdrawals.add((entry[2], withdrawal[3]))
+                        hijack["bgpupdate_keys"].append(withdrawal[3])
+                        if entry[5] > withdrawal[2]:
+                            continue
+                        # matching withdraw with a hijack
+                        if (
+                            withdrawal[1] not in hijack["peers_withdrawn"]
+                            and withdrawal[1] in hijack["peers_seen"]
                         ):
-                            # set hijack as withdrawn and delete from redis
-                            if hijack:
-                                hijack["end_tag"] = "withdrawn"
-                            purge_redis_eph_pers_keys(
-                                self.redis, redis_hijack_key, entry[2]
-                            )
-                            self.wo_db.execute(
-                                "UPDATE hijacks SET active=false, dormant=false, resolved=false, withdrawn=true, time_ended=%s, "
-                                "peers_withdrawn=%s, time_last=%s WHERE key=%s;",
-                                (timestamp, entry[1], timestamp, entry[2]),
+                            hijack["peers_withdrawn"].append(withdrawal[1])
+                            hijack["time_last"] = max(
+                                withdrawal[2], hijack["time_last"]
                             )
+                            hijack["updated"] = True
+                            # if a certain percentage of hijack 'A' peers see corresponding hijack 'W'
+                            if len(hijack["peers_withdrawn"]) >= int(
+                                round(
+                                    WITHDRAWN_HIJACK_THRESHOLD
+                                    * len(hijack["peers_seen"])
+                                    / 100.0
+                                )
+                            ):
+                                hijack["withdrawn"] = True
+                    if not matched:
+                        update_normal_withdrawals.add((withdrawal[3],))
+
+                # update the bgpupdate_keys related to the hijacks with withdrawals
+                redis_pipeline = self.redis.pipeline()
+                for hijack in hijacks.values():
+                    self.redis_add_hijack_update_keys(
+                        keys=[
+                            hijack["redis_key"],
+                            "hijack_{}_peers_seen".format(hijack["redis_key"]),
+                            "hijack_{}_bgpupdate_keys".format(hijack["redis_key"]),
+                        ],
+                        args=[HIJACK_BGPUPDATE_KEYS_CAP] + hijack["bgpupdate_keys"],
+                        client=redis_pipeline,
+                    )
+                results = redis_pipeline.execute()
 
-                            log.debug("withdrawn hijack {}".format(entry))
-                            if hijack:
-                                with Producer(self.connection) as producer:
-                                    producer.publish(
-                                        hijack,
-                                        exchange=self.hijack_notification_exchange,
-                                        routing_key="mail-log",
-                                        retry=False,
-                                        priority=1,
-                                        serializer="ujson",
-                                    )
-                                    producer.publish(
-                                        hijack,
-                                        exchange=self.hijack_notification_exchange,
-                                        routing_key="hij-log",
-                                        retry=False,
-                                        priority=1,
-                                        serializer="ujson",
-                                    )
-                        else:
-                            # add withdrawal to hijack
-                            self.wo_db.execute(
-                                "UPDATE hijacks SET peers_withdrawn=%s, time_last=%s, dormant=false WHERE key=%s;",
-                                (entry[1], timestamp, entry[2]),
+                withdrawn_hijacks = []
+                update_hijacks = []
+                for (hijack_key, hijack), (hijack_fields, peers_seen) in zip(
+                    hijacks.items(), results
+                ):
+                    if not hijack["updated"]:
+                        continue
+                    update_hijacks.append(
+                        (
+                            hijack_key,
+                            hijack["peers_withdrawn"],
+                            hijack["time_last"],
+                            hijack["withdrawn"],
+                        )
+                    )
+                    if hijack["withdrawn"]:
+                        # set hijack as withdrawn and delete from redis
+                        purge_redis_hijack(
+                            self.redis_purge_hijack, hijack["redis_key"], hijack_key
+                        )
+                        log.debug("withdrawn hijack {}".format(hijack_key))
+                        if hijack_fields:
+                            withdrawn_hijack = decode_redis_hijack(
+                                hijack_fields, peers_seen
                             )
+                            withdrawn_hijack["end_tag"] = "withdrawn"
+                            withdrawn_hijacks.append(withdrawn_hijack)
+                    else:
+                        log.debug("updating hijack {}".format(hijack_key))
 
-                            log.debug("updating hijack {}".format(entry))
+                # add withdrawals to hijacks, setting as withdrawn (ended) those that
+                # exceeded the threshold
+                query = (
+                    "UPDATE hijacks SET peers_withdrawn=data.v2, time_last=data.v3, dormant=false, "
+                    "active=(hijacks.active AND NOT data.v4), resolved=(hijacks.resolved AND NOT data.v4), "
+                    "withdrawn=(hijacks.withdrawn OR data.v4), "
+                    "time_ended=(CASE WHEN data.v4 THEN data.v3 ELSE hijacks.time_ended END) "
+                    "FROM (VALUES %s) AS data (v1, v2, v3, v4) WHERE hijacks.key=data.v1"
+                )
+                self.wo_db.execute_values(query, update_hijacks, page_size=1000)
+
+                if withdrawn_hijacks:
+                    with Producer(self.connection) as producer:
+                        for withdrawn_hijack in withdrawn_hijacks:
+                            producer.publish(
+                                withdrawn_hijack,
+                                exchange=self.hijack_notification_exchange,
+                                routing_key="mail-log",
+                                retry=False,
+                                priority=1,
+                                serializer="ujson",
+                            )
+                            producer.publish(
+                                withdrawn_hijack,
+                                exchange=self.hijack_notification_exchange,
+                                routing_key="hij-log",
+                                retry=False,
+                                priority=1,
+                                serializer="ujson",
+                            )
             except Exception:
                 log.exception("exception")
-        num_of_entries = len(self.shared_memory_manager_dict["handle_bgp_withdrawals"])
-        self.shared_memory_manager_dict["handle_bgp_withdrawals"] = []
-        shared_memory_locks["handle_bgp_withdrawals"].release()
 
         try:
             update_hijack_withdrawals_dict = {}
@@ -1203,22 +1297,105 @@ class DatabaseBulkUpdater:
         return num_of_entries
 
     def _handle_hijack_outdate(self):
-        shared_memory_locks["outdate_hijacks"].acquire()
-        if not self.shared_memory_manager_dict["outdate_hijacks"]:
-            shared_memory_locks["outdate_hijacks"].release()
+        if not self.outdate_hijacks:
             return
         try:
             query = "UPDATE hijacks SET active=false, dormant=false, outdated=true FROM (VALUES %s) AS data (key) WHERE hijacks.key=data.key;"
             self.wo_db.execute_values(
                 query,
-                self.shared_memory_manager_dict["outdate_hijacks"],
+                list(self.outdate_hijacks),
                 page_size=1000,
             )
-            self.shared_memory_manager_dict["outdate_hijacks"] = []
+            self.outdate_hijacks = {}
         except Exception:
             log.exception("")
-        finally:
-            shared_memory_locks["outdate_hijacks"].release()
+
+    def _drop_failed_rows(self, inserts, updates, hijacks):
+        """
+        Drops the rows of the bulk writes that keep failing, logging their keys.
+        """
+        if inserts == -1:
+            log.error(
+                "dropping {} BGP updates after {} failed inserts: {}".format(
+                    len(self.insert_bgp_entries),
+                    self.bulk_update_retries,
+                    list(self.insert_bgp_entries),
+                )
+            )
+            self.insert_bgp_entries = {}
+        if updates == -1:
+            log.error(
+                "dropping {} handled BGP updates after {} failed updates: {}".format(
+                    len(self.handled_bgp_entries),
+                    self.bulk_update_retries,
+                    list(self.handled_bgp_entries),
+                )
+            )
+            self.handled_bgp_entries = set()
+        if hijacks == -1:
+            log.error(
+                "dropping {} hijacks after {} failed inserts: {}".format(
+                    len(self.insert_hijacks_entries),
+                    self.bulk_update_retries,
+                    list(self.insert_hijacks_entries),
+                )
+            )
+            self.insert_hijacks_entries = {}
+        self.bulk_update_failed = False
+        self.bulk_update_retries = 0
+
+    def _commit_drained_messages(self):
+        """
+        Hands the drained messages back to the data worker, to be acked.
+        """
+        for seq in self.drained_messages:
+            self.committed_queue.put(seq)
+        self.drained_messages = []
+
+    def bulk_update(self):
+        """
+        Writes the rows of the next bulk update; the messages of its rows are
+        committed once every write succeeds, or once the failed rows are dropped.
+        """
+        try:
+            self._drain_staging_queue()
+            inserts = self._insert_bgp_updates()
+            updates = self._update_bgp_updates()
+            hijacks = self._insert_update_hijacks()
+            withdrawals = self._handle_bgp_withdrawals()
+            self._handle_hijack_outdate()
+            self.bulk_update_failed = -1 in (inserts, updates, hijacks)
+            if self.bulk_update_failed:
+                self.bulk_update_retries += 1
+                if self.bulk_update_retries > DB_BULK_UPDATE_MAX_RETRIES:
+                    self._drop_failed_rows(inserts, updates, hijacks)
+            else:
+                self.bulk_update_retries = 0
+            if not self.bulk_update_failed:
+                self._commit_drained_messages()
+            str_ = ""
+            if inserts:
+                str_ += "BGP Updates Inserted: {}\n".format(inserts)
+            if updates:
+                str_ += "BGP Updates Updated: {}\n".format(updates)
+            if hijacks:
+                str_ += "Hijacks Inserted: {}".format(hijacks)
+            if withdrawals:
+                str_ += "Withdrawals Handled: {}".format(withdrawals)
+            if str_ != "":
+                log.debug("{}".format(str_))
+        except Exception:
+            log.exception("exception")
+            log.error("flushing current state")
+            self.insert_bgp_entries = {}
+            self.handle_bgp_withdrawals = {}
+            self.handled_bgp_entries = set()
+            self.outdate_hijacks = {}
+            self.insert_hijacks_entries = {}
+            self.bulk_update_failed = False
+            self.bulk_update_retries = 0
+            # their rows are dropped, as the rows of the failed writes
+            self._commit_drained_messages()
 
     def run(self):
         while True:
@@ -1228,47 +1405,8 @@ class DatabaseBulkUpdater:
                 shared_memory_locks["data_worker"].release()
                 break
             shared_memory_locks["data_worker"].release()
-            try:
-                inserts = self._insert_bgp_updates()
-                shared_memory_locks["insert_hijacks_entries"].acquire()
-                shared_memory_locks["handled_bgp_entries"].acquire()
-                updates = self._update_bgp_updates()
-                shared_memory_locks["handled_bgp_entries"].release()
-                hijacks = self._insert_update_hijacks()
-                shared_memory_locks["insert_hijacks_entries"].release()
-                withdrawals = self._handle_bgp_withdrawals()
-                self._handle_hijack_outdate()
-                str_ = ""
-                if inserts:
-                    str_ += "BGP Updates Inserted: {}\n".format(inserts)
-                if updates:
-                    str_ += "BGP Updates Updated: {}\n".format(updates)
-                if hijacks:
-                    str_ += "Hijacks Inserted: {}".format(hijacks)
-                if withdrawals:
-                    str_ += "Withdrawals Handled: {}".format(withdrawals)
-                if str_ != "":
-                    log.debug("{}".format(str_))
-            except Exception:
-                log.exception("exception")
-                log.error("flushing current state")
-                shared_memory_locks["insert_bgp_entries"].acquire()
-                shared_memory_locks["handle_bgp_withdrawals"].acquire()
-                shared_memory_locks["handled_bgp_entries"].acquire()
-                shared_memory_locks["outdate_hijacks"].acquire()
-                shared_memory_locks["insert_hijacks_entries"].acquire()
-                self.shared_memory_manager_dict["insert_bgp_entries"] = []
-                self.shared_memory_manager_dict["handle_bgp_withdrawals"] = []
-                self.shared_memory_manager_dict["handled_bgp_entries"] = []
-                self.shared_memory_manager_dict["outdate_hijacks"] = []
-                self.shared_memory_manager_dict["insert_hijacks_entries"] = {}
-                shared_memory_locks["insert_bgp_entries"].release()
-                shared_memory_locks["handle_bgp_withdrawals"].release()
-                shared_memory_locks["handled_bgp_entries"].release()
-                shared_memory_locks["outdate_hijacks"].release()
-                shared_memory_locks["insert_hijacks_entries"].release()
-            finally:
-                time.sleep(BULK_TIMER)
+            self.bulk_update()
+            time.sleep(BULK_TIMER)
 
 
 class DatabaseDataWorker(ConsumerProducerMixin):
@@ -1305,6 +1443,7 @@ class DatabaseDataWorker(ConsumerProducerMixin):
         # redis db
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
         ping_redis(self.redis)
+        self.redis_purge_hijack = self.redis.register_script(HIJACK_PURGE_SCRIPT)
         # the first DB process that starts, bootstraps redis and blocks rest of replicas until complete
         if not self.redis.getset("redis-bootstrap", "1"):
             log.info("bootstrapping redis...")
@@ -1424,8 +1563,18 @@ class DatabaseDataWorker(ConsumerProducerMixin):
         )
 
         log.info("setting up bulk updater process...")
+        # rows are staged for the bulk updater through a bounded queue, and their
+        # messages are acked once the bulk updater commits them
+        self.staging_queue = mp.Queue(maxsize=DB_STAGING_QUEUE_SIZE)
+        self.committed_queue = mp.Queue()
+        # sequence number -> staged message, not acked yet
+        self.staged_messages = {}
+        self.staged_message_seq = 0
         self.bulk_updater = DatabaseBulkUpdater(
-            self.connection, self.shared_memory_manager_dict
+            self.connection,
+            self.shared_memory_manager_dict,
+            self.staging_queue,
+            self.committed_queue,
         )
         mp.Process(target=self.bulk_updater.run).start()
         log.info("bulk updater set up")
@@ -1437,25 +1586,25 @@ class DatabaseDataWorker(ConsumerProducerMixin):
             Consumer(
                 queues=[self.update_queue],
                 on_message=self.handle_bgp_update,
-                prefetch_count=100,
+                prefetch_count=STAGED_PREFETCH_COUNT,
                 accept=["ujson"],
             ),
             Consumer(
                 queues=[self.hijack_queue],
                 on_message=self.handle_hijack_update,
-                prefetch_count=100,
+                prefetch_count=STAGED_PREFETCH_COUNT,
                 accept=["ujson"],
             ),
             Consumer(
                 queues=[self.withdraw_queue],
                 on_message=self.handle_withdraw_update,
-                prefetch_count=100,
+                prefetch_count=STAGED_PREFETCH_COUNT,
                 accept=["ujson"],
             ),
             Consumer(
                 queues=[self.handled_queue],
                 on_message=self.handle_handled_bgp_update,
-                prefetch_count=100,
+                prefetch_count=STAGED_PREFETCH_COUNT,
                 accept=["ujson"],
             ),
             Consumer(
@@ -1514,79 +1663,124 @@ class DatabaseDataWorker(ConsumerProducerMixin):
             ),
         ]
 
-    def handle_bgp_update(self, message):
-        # log.debug('message: {}\npayload: {}'.format(message, message.payload))
-        message.ack()
-        msg_ = message.payload
-        # prefix, key, origin_as, peer_asn, as_path, service, type, communities,
-        # timestamp, hijack_key, handled, matched_prefix, orig_path
+    def on_iteration(self):
+        self.ack_committed_messages()
 
-        if not self.redis.getset(msg_["key"], "1"):
+    def ack_committed_messages(self):
+        """
+        Acks the staged messages whose rows the bulk updater has committed.
+        """
+        while True:
             try:
-                # discard old (older than 1.30 hour ago) timestamped BGP updates (may accumulate due to load)
-                if (
-                    HISTORIC == "false"
-                    and msg_["timestamp"] < int(time.time()) - 90 * 60
-                ):
-                    return
+                seq = self.committed_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.staged_messages.pop(seq).ack()
 
-                # discard BGP updates not matching any configured prefix any more
-                best_match = msg_["prefix_node"]["prefix"]  # matched_prefix
-                if not best_match:
+    def stage_entries(self, message, entry_type, entries):
+        """
+        Stages the rows of a message for the bulk updater; the message is acked once
+        its rows are committed (or right away, if it has no rows). While the staging
+        queue is full, this blocks, so that no more messages are consumed (though the
+        heartbeats of the connection are still sent and committed messages acked).
+        """
+        if not entries:
+            message.ack()
+            return
+        self.staged_message_seq += 1
+        seq = self.staged_message_seq
+        self.staged_messages[seq] = message
+        while True:
+            try:
+                self.staging_queue.put(
+                    (seq, entry_type, entries), timeout=STAGING_QUEUE_PUT_TIMEOUT
+                )
+                break
+            except queue.Full:
+                # the bulk updater stops along with the data worker
+                shared_memory_locks["data_worker"].acquire()
+                running = self.shared_memory_manager_dict["data_worker_running"]
+                shared_memory_locks["data_worker"].release()
+                if not running:
+                    # left unacked, so that it is redelivered
+                    del self.staged_messages[seq]
                     return
+                self.connection.heartbeat_check()
+                self.ack_committed_messages()
 
-                origin_as = -1
-                if len(msg_["path"]) >= 1:
-                    origin_as = msg_["path"][-1]
-
-                value = (
-                    msg_["prefix"],  # prefix
-                    msg_["key"],  # key
-                    origin_as,  # origin_as
-                    msg_["peer_asn"],  # peer_asn
-                    msg_["path"],  # as_path
-                    msg_["service"],  # service
-                    msg_["type"],  # type
-                    json.dumps(
-                        [(k["asn"], k["value"]) for k in msg_["communities"]]
-                    ),  # communities
-                    datetime.datetime.fromtimestamp((msg_["timestamp"])),  # timestamp
-                    [],  # hijack_key
-                    False,  # handled
-                    best_match,
-                    json.dumps(msg_["orig_path"]),  # orig_path
-                )
-                # insert all types of BGP updates
-                # thread-safe access to update dict
-                shared_memory_locks["insert_bgp_entries"].acquire()
-                insert_bgp_entries = self.shared_memory_manager_dict[
-                    "insert_bgp_entries"
-                ]
-                insert_bgp_entries.append(value)
-                self.shared_memory_manager_dict[
-                    "insert_bgp_entries"
-                ] = insert_bgp_entries
-                shared_memory_locks["insert_bgp_entries"].release()
-
-                # register the monitor/peer ASN from whom we learned this BGP update
-                self.redis.sadd("peer-asns", msg_["peer_asn"])
-                redis_peer_asns = self.redis.scard("peer-asns")
-                if redis_peer_asns != self.monitor_peers:
-                    self.monitor_peers = redis_peer_asns
-                    self.wo_db.execute(
-                        "UPDATE stats SET monitor_peers=%s;", (self.monitor_peers,)
+    def handle_bgp_update(self, message):
+        # log.debug('message: {}\npayload: {}'.format(message, message.payload))
+        # prefixtree publishes a list of updates for every batch of updates it receives
+        if isinstance(message.payload, list):
+            bgp_updates = message.payload
+        else:
+            bgp_updates = [message.payload]
+        values = []
+        try:
+            for msg_ in bgp_updates:
+                # prefix, key, origin_as, peer_asn, as_path, service, type, communities,
+                # timestamp, hijack_key, handled, matched_prefix, orig_path
+                if self.redis.getset(msg_["key"], "1"):
+                    continue
+                try:
+                    # discard old (older than 1.30 hour ago) timestamped BGP updates (may accumulate due to load)
+                    if (
+                        HISTORIC == "false"
+                        and msg_["timestamp"] < int(time.time()) - 90 * 60
+                    ):
+                        continue
+
+                    # discard BGP updates not matching any configured prefix any more
+                    best_match = msg_["prefix_node"]["prefix"]  # matched_prefix
+                    if not best_match:
+                        continue
+
+                    origin_as = -1
+                    if len(msg_["path"]) >= 1:
+                        origin_as = msg_["path"][-1]
+
+                    value = (
+                        msg_["prefix"],  # prefix
+                        msg_["key"],  # key
+                        origin_as,  # origin_as
+                        msg_["peer_asn"],  # peer_asn
+                        msg_["path"],  # as_path
+                        msg_["service"],  # service
+                        msg_["type"],  # type
+                        [
+                            (k["asn"], k["value"]) for k in msg_["communities"]
+                        ],  # communities
+                        datetime.datetime.fromtimestamp(
+                            (msg_["timestamp"])
+                        ),  # timestamp
+                        [],  # hijack_key
+                        False,  # handled
+                        best_match,
+                        msg_["orig_path"],  # orig_path
                     )
-            except Exception:
-                log.exception("{}".format(msg_))
-            finally:
-                # reset timer each time we hit the same BGP update
-                self.redis.expire(msg_["key"], 2 * 60 * 60)
+                    values.append(value)
+
+                    # register the monitor/peer ASN from whom we learned this BGP update
+                    self.redis.sadd("peer-asns", msg_["peer_asn"])
+                    redis_peer_asns = self.redis.scard("peer-asns")
+                    if redis_peer_asns != self.monitor_peers:
+                        self.monitor_peers = redis_peer_asns
+                        self.wo_db.execute(
+                            "UPDATE stats SET monitor_peers=%s;", (self.monitor_peers,)
+                        )
+                except Exception:
+                    log.exception("{}".format(msg_))
+                finally:
+                    # reset timer each time we hit the same BGP update
+                    self.redis.expire(msg_["key"], 2 * 60 * 60)
+        finally:
+            # insert all types of BGP updates
+            self.stage_entries(message, "insert_bgp_entries", values)
 
     def handle_withdraw_update(self, message):
         # log.debug('message: {}\npayload: {}'.format(message, message.payload))
-        message.ack()
         msg_ = message.payload
-        shared_memory_locks["handle_bgp_withdrawals"].acquire()
+        values = []
         try:
             # update hijacks based on withdrawal messages
             value = (
@@ -1595,110 +1789,31 @@ class DatabaseDataWorker(ConsumerProducerMixin):
                 datetime.datetime.fromtimestamp((msg_["timestamp"])),  # timestamp
                 msg_["key"],  # key
             )
-            handle_bgp_withdrawals = self.shared_memory_manager_dict[
-                "handle_bgp_withdrawals"
-            ]
-            if value not in handle_bgp_withdrawals:
-                handle_bgp_withdrawals.append(value)
-            self.shared_memory_manager_dict[
-                "handle_bgp_withdrawals"
-            ] = handle_bgp_withdrawals
+            values.append(value)
         except Exception:
             log.exception("{}".format(msg_))
         finally:
-            shared_memory_locks["handle_bgp_withdrawals"].release()
+            self.stage_entries(message, "handle_bgp_withdrawals", values)
 
     def handle_hijack_outdate(self, message):
         # log.debug('message: {}\npayload: {}'.format(message, message.payload))
-        message.ack()
-        shared_memory_locks["outdate_hijacks"].acquire()
+        values = []
         try:
             raw = message.payload
-            if (raw["persistent_hijack_key"],) not in self.shared_memory_manager_dict[
-                "outdate_hijacks"
-            ]:
-                outdate_hijacks = self.shared_memory_manager_dict["outdate_hijacks"]
-                outdate_hijacks.append((raw["persistent_hijack_key"],))
-                self.shared_memory_manager_dict["outdate_hijacks"] = outdate_hijacks
+            values.append((raw["persistent_hijack_key"],))
         except Exception:
             log.exception("{}".format(message))
         finally:
-            shared_memory_locks["outdate_hijacks"].release()
+            self.stage_entries(message, "outdate_hijacks", values)
 
     def handle_hijack_update(self, message):
         # log.debug('message: {}\npayload: {}'.format(message, message.payload))
-        message.ack()
-        msg_ = message.payload
-        shared_memory_locks["insert_hijacks_entries"].acquire()
-        try:
-            key = msg_["key"]  # persistent hijack key
-
-            insert_hijacks_entries = self.shared_memory_manager_dict[
-                "insert_hijacks_entries"
-            ]
-            if key not in insert_hijacks_entries:
-                # log.info('key {} at {}'.format(key, os.getpid()))
-                insert_hijacks_entries[key] = {}
-                insert_hijacks_entries[key]["prefix"] = msg_["prefix"]
-                insert_hijacks_entries[key]["hijack_as"] = msg_["hijack_as"]
-                insert_hijacks_entries[key]["type"] = msg_["type"]
-                insert_hijacks_entries[key]["time_started"] = msg_["time_started"]
-                insert_hijacks_entries[key]["time_last"] = msg_["time_last"]
-                insert_hijacks_entries[key]["peers_seen"] = list(msg_["peers_seen"])
-                insert_hijacks_entries[key]["asns_inf"] = list(msg_["asns_inf"])
-                insert_hijacks_entries[key]["num_peers_seen"] = len(msg_["peers_seen"])
-                insert_hijacks_entries[key]["num_asns_inf"] = len(msg_["asns_inf"])
-                insert_hijacks_entries[key]["monitor_keys"] = set(msg_["monitor_keys"])
-                insert_hijacks_entries[key]["time_detected"] = msg_["time_detected"]
-                insert_hijacks_entries[key]["configured_prefix"] = msg_[
-                    "configured_prefix"
-                ]
-                insert_hijacks_entries[key]["timestamp_of_config"] = msg_[
-                    "timestamp_of_config"
-                ]
-                insert_hijacks_entries[key]["community_annotation"] = msg_[
-                    "community_annotation"
-                ]
-                insert_hijacks_entries[key]["rpki_status"] = msg_["rpki_status"]
-            else:
-                insert_hijacks_entries[key]["time_started"] = min(
-                    insert_hijacks_entries[key]["time_started"], msg_["time_started"]
-                )
-                insert_hijacks_entries[key]["time_last"] = max(
-                    insert_hijacks_entries[key]["time_last"], msg_["time_last"]
-                )
-                insert_hijacks_entries[key]["peers_seen"] = list(msg_["peers_seen"])
-                insert_hijacks_entries[key]["asns_inf"] = list(msg_["asns_inf"])
-                insert_hijacks_entries[key]["num_peers_seen"] = len(msg_["peers_seen"])
-                insert_hijacks_entries[key]["num_asns_inf"] = len(msg_["asns_inf"])
-                insert_hijacks_entries[key]["monitor_keys"].update(msg_["monitor_keys"])
-                insert_hijacks_entries[key]["community_annotation"] = msg_[
-                    "community_annotation"
-                ]
-                insert_hijacks_entries[key]["rpki_status"] = msg_["rpki_status"]
-
-            self.shared_memory_manager_dict[
-                "insert_hijacks_entries"
-            ] = insert_hijacks_entries
-        except Exception:
-            log.exception("{}".format(msg_))
-        finally:
-            shared_memory_locks["insert_hijacks_entries"].release()
+        # the hijack updates are merged by persistent hijack key by the bulk updater
+        self.stage_entries(message, "insert_hijacks_entries", [message.payload])
 
     def handle_handled_bgp_update(self, message):
         # log.debug('message: {}\npayload: {}'.format(message, message.payload))
-        message.ack()
-        shared_memory_locks["handled_bgp_entries"].acquire()
-        try:
-            key_ = (message.payload,)
-            handled_bgp_entries = self.shared_memory_manager_dict["handled_bgp_entries"]
-            if key_ not in handled_bgp_entries:
-                handled_bgp_entries.append(key_)
-            self.shared_memory_manager_dict["handled_bgp_entries"] = handled_bgp_entries
-        except Exception:
-            log.exception("{}".format(message))
-        finally:
-            shared_memory_locks["handled_bgp_entries"].release()
+        self.stage_entries(message, "handled_bgp_entries", [(message.payload,)])
 
     def handle_hijack_ongoing_request(self, message):
         if not isinstance(message, dict):
@@ -1708,7 +1823,7 @@ class DatabaseDataWorker(ConsumerProducerMixin):
             query = (
                 "SELECT b.key, b.prefix, b.origin_as, b.as_path, b.type, b.peer_asn, "
                 "b.communities, b.timestamp, b.service, b.matched_prefix, h.key, h.hijack_as, h.type "
-                "FROM hijacks AS h LEFT JOIN bgp_updates AS b ON (h.key = ANY(b.hijack_key)) "
+                "FROM hijacks AS h LEFT JOIN bgp_updates AS b ON (b.hijack_key @> ARRAY[h.key]::text[]) "
                 "WHERE h.active = true AND b.handled=true"
             )
 
@@ -1782,8 +1897,6 @@ class DatabaseDataWorker(ConsumerProducerMixin):
                 result = {
                     "time_started": entry[0].timestamp(),
                     "time_last": entry[1].timestamp(),
-                    "peers_seen": set(entry[2]),
-                    "asns_inf": set(entry[3]),
                     "key": entry[4],
                     "prefix": entry[5],
                     "hijack_as": entry[6],
@@ -1794,10 +1907,28 @@ class DatabaseDataWorker(ConsumerProducerMixin):
                     "community_annotation": entry[11],
                     "rpki_status": entry[12],
                 }
-                result["bgpupdate_keys"] = ongoing_hijacks_to_updates[entry[4]]
+                bgpupdate_keys = ongoing_hijacks_to_updates.get(entry[4], set())
+                if len(bgpupdate_keys) > HIJACK_BGPUPDATE_KEYS_CAP:
+                    result["bgpupdate_keys_spilled"] = 1
+                    bgpupdate_keys = set()
 
                 redis_hijack_key = redis_key(entry[5], entry[6], entry[7])
-                redis_pipeline.set(redis_hijack_key, json.dumps(result))
+                # invalidate the hijack caches of detection
+                redis_pipeline.hdel(redis_hijack_key, "version")
+                redis_pipeline.hmset(redis_hijack_key, encode_redis_hijack(result))
+                if entry[2]:
+                    redis_pipeline.sadd(
+                        "hijack_{}_peers_seen".format(redis_hijack_key), *entry[2]
+                    )
+                if entry[3]:
+                    redis_pipeline.pfadd(
+                        "hijack_{}_asns_inf".format(redis_hijack_key), *entry[3]
+                    )
+                if bgpupdate_keys:
+                    redis_pipeline.sadd(
+                        "hijack_{}_bgpupdate_keys".format(redis_hijack_key),
+                        *bgpupdate_keys
+                    )
                 redis_pipeline.sadd("persistent-keys", entry[4])
             redis_pipeline.execute()
 
@@ -1874,6 +2005,10 @@ class DatabaseDataWorker(ConsumerProducerMixin):
                         "hijack_{}_prefixes_peers".format(redis_hijack_key),
                         "{}_{}".format(update[2], update[3]),
                     )
+                    # keep the prefix-peer indexes of detection in sync
+                    redis_pipeline.publish(
+                        "prefix-peer-hijacks", "+{}_{}".format(update[2], update[3])
+                    )
             redis_pipeline.execute()
 
             # bootstrap seen monitor peers
@@ -1900,7 +2035,9 @@ class DatabaseDataWorker(ConsumerProducerMixin):
             redis_hijack_key = redis_key(raw["prefix"], raw["hijack_as"], raw["type"])
             # if ongoing, clear redis
             if self.redis.sismember("persistent-keys", raw["key"]):
-                purge_redis_eph_pers_keys(self.redis, redis_hijack_key, raw["key"])
+                purge_redis_hijack(
+                    self.redis_purge_hijack, redis_hijack_key, raw["key"]
+                )
 
             self.wo_db.execute(
                 "UPDATE hijacks SET active=false, dormant=false, resolved=true, seen=true, time_ended=%s WHERE key=%s;",
@@ -1916,38 +2053,40 @@ class DatabaseDataWorker(ConsumerProducerMixin):
         log.debug("payload: {}".format(raw))
         try:
             redis_hijack_key = redis_key(raw["prefix"], raw["hijack_as"], raw["type"])
-            redis_hijack = self.redis.get(redis_hijack_key)
+            bgpupdate_keys = self.redis.smembers(
+                "hijack_{}_bgpupdate_keys".format(redis_hijack_key)
+            )
             if self.redis.sismember("persistent-keys", raw["key"]):
-                purge_redis_eph_pers_keys(self.redis, redis_hijack_key, raw["key"])
+                purge_redis_hijack(
+                    self.redis_purge_hijack, redis_hijack_key, raw["key"]
+                )
 
-            log.debug("redis-entry for {}: {}".format(redis_hijack_key, redis_hijack))
             self.wo_db.execute("DELETE FROM hijacks WHERE key=%s;", (raw["key"],))
-            if redis_hijack and classic_json.loads(redis_hijack.decode("utf-8")).get(
-                "bgpupdate_keys", []
-            ):
+            # the cached keys are dropped once they exceed the cap
+            if bgpupdate_keys:
                 log.debug("deleting hijack using cache for bgp updates")
-                redis_hijack = classic_json.loads(redis_hijack.decode("utf-8"))
+                bgpupdate_keys = [
+                    bgpupdate_key.decode("utf-8") for bgpupdate_key in bgpupdate_keys
+                ]
                 log.debug(
-                    "bgpupdate_keys {} for {}".format(
-                        redis_hijack["bgpupdate_keys"], redis_hijack_key
-                    )
+                    "bgpupdate_keys {} for {}".format(bgpupdate_keys, redis_hijack_key)
                 )
                 self.wo_db.execute(
-                    "DELETE FROM bgp_updates WHERE %s = ANY(hijack_key) AND handled = true AND array_length(hijack_key,1) = 1 AND key = ANY(%s);",
-                    (raw["key"], list(redis_hijack["bgpupdate_keys"])),
+                    "DELETE FROM bgp_updates WHERE hijack_key @> ARRAY[%s]::text[] AND handled = true AND array_length(hijack_key,1) = 1 AND key = ANY(%s);",
+                    (raw["key"], bgpupdate_keys),
                 )
                 self.wo_db.execute(
                     "UPDATE bgp_updates SET hijack_key = array_remove(hijack_key, %s) WHERE handled = true AND key = ANY(%s);",
-                    (raw["key"], list(redis_hijack["bgpupdate_keys"])),
+                    (raw["key"], bgpupdate_keys),
                 )
             else:
                 log.debug("deleting hijack by querying bgp updates database")
                 self.wo_db.execute(
-                    "DELETE FROM bgp_updates WHERE %s = ANY(hijack_key) AND array_length(hijack_key,1) = 1 AND handled = true;",
+                    "DELETE FROM bgp_updates WHERE hijack_key @> ARRAY[%s]::text[] AND array_length(hijack_key,1) = 1 AND handled = true;",
                     (raw["key"],),
                 )
                 self.wo_db.execute(
-                    "UPDATE bgp_updates SET hijack_key = array_remove(hijack_key, %s) WHERE %s = ANY(hijack_key) AND handled = true;",
+                    "UPDATE bgp_updates SET hijack_key = array_remove(hijack_key, %s) WHERE hijack_key @> ARRAY[%s]::text[] AND handled = true;",
                     (raw["key"], raw["key"]),
                 )
 
@@ -1985,7 +2124,9 @@ class DatabaseDataWorker(ConsumerProducerMixin):
             redis_hijack_key = redis_key(raw["prefix"], raw["hijack_as"], raw["type"])
             # if ongoing, clear redis
             if self.redis.sismember("persistent-keys", raw["key"]):
-                purge_redis_eph_pers_keys(self.redis, redis_hijack_key, raw["key"])
+                purge_redis_hijack(
+                    self.redis_purge_hijack, redis_hijack_key, raw["key"]
+                )
             self.wo_db.execute(
                 "UPDATE hijacks SET active=false, dormant=false, seen=false, ignored=true WHERE key=%s;",
                 (raw["key"],),
@@ -0,0 +1,444 @@
+import datetime
+import queue
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import database
+import fakeredis
+from artemis_utils.redis import encode_redis_hijack
+from artemis_utils.redis import redis_hijack_keys
+from artemis_utils.redis import redis_key
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds)
+
+
+class WithdrawalsDB:
+    """
+    In-memory stand-in of the hijacks and (handled) bgp_updates tables, for
+    the queries of the withdrawals of the bulk updater.
+    """
+
+    def __init__(self, hijacks, announcements):
+        # hijack key -> hijack row
+        self.hijacks = hijacks
+        # (prefix, peer_asn) -> [(timestamp, hijack keys)] of the announcements
+        self.announcements = {}
+        for prefix, peer_asn, announcement_timestamp, hijack_keys in announcements:
+            self.announcements.setdefault((prefix, peer_asn), []).append(
+                (announcement_timestamp, hijack_keys)
+            )
+        # bgp update key -> hijack keys of the handled withdrawals
+        self.withdrawals = {}
+
+    def execute(self, query, params):
+        # the active hijacks matching the withdrawals, along with the latest
+        # announcement of the withdrawn prefix-peer
+        prefixes, peer_asns, keys, timestamp_thres = params
+        entries = []
+        for prefix, peer_asn, key in zip(prefixes, peer_asns, keys):
+            latest_announcements = {}
+            for announcement_timestamp, hijack_keys in self.announcements.get(
+                (prefix, peer_asn), []
+            ):
+                for hijack_key in hijack_keys:
+                    latest_announcements[hijack_key] = max(
+                        announcement_timestamp,
+                        latest_announcements.get(hijack_key, announcement_timestamp),
+                    )
+            for hijack_key, announcement_timestamp in sorted(
+                latest_announcements.items()
+            ):
+                hijack = self.hijacks[hijack_key]
+                if not hijack["active"]:
+                    continue
+                entries.append(
+                    (
+                        key,
+                        list(hijack["peers_seen"]),
+                        list(hijack["peers_withdrawn"]),
+                        hijack_key,
+                        hijack["hijack_as"],
+                        hijack["type"],
+                        announcement_timestamp,
+                        hijack["time_last"],
+                    )
+                )
+        return entries
+
+    def execute_values(self, query, rows, page_size=None):
+        if query.startswith("UPDATE hijacks"):
+            for hijack_key, peers_withdrawn, time_last, withdrawn in rows:
+                hijack = self.hijacks[hijack_key]
+                hijack["peers_withdrawn"] = list(peers_withdrawn)
+                hijack["time_last"] = time_last
+                hijack["active"] = hijack["active"] and not withdrawn
+                hijack["withdrawn"] = hijack["withdrawn"] or withdrawn
+        elif "hijack_key" in query:
+            self.execute_batch(query, rows)
+        else:
+            for (key,) in rows:
+                self.withdrawals.setdefault(key, set())
+
+    def execute_batch(self, query, rows, page_size=None):
+        for hijack_key, key in rows:
+            self.withdrawals.setdefault(key, set()).add(hijack_key)
+
+
+class DatabaseBulkUpdaterTester(unittest.TestCase):
+    def make_bulk_updater(self, hijacks, announcements):
+        """
+        Returns a bulk updater on an in-memory database, along with the redis
+        state of its (active) hijacks.
+        """
+        redis_instance = fakeredis.FakeStrictRedis()
+        for hijack_key, hijack in hijacks.items():
+            redis_hijack_key = redis_key(
+                hijack["prefix"], hijack["hijack_as"], hijack["type"]
+            )
+            for field, value in encode_redis_hijack(
+                {
+                    "key": hijack_key,
+                    "prefix": hijack["prefix"],
+                    "hijack_as": hijack["hijack_as"],
+                    "type": hijack["type"],
+                }
+            ).items():
+                redis_instance.hset(redis_hijack_key, field, value)
+            redis_instance.sadd(
+                "hijack_{}_peers_seen".format(redis_hijack_key), *hijack["peers_seen"]
+            )
+            redis_instance.sadd("persistent-keys", hijack_key)
+        db = WithdrawalsDB(hijacks, announcements)
+        with patch("database.DB", MagicMock(return_value=db)), patch(
+            "redis.Redis", MagicMock(return_value=redis_instance)
+        ):
+            bulk_updater = database.DatabaseBulkUpdater(
+                MagicMock(), {}, MagicMock(), MagicMock()
+            )
+        return bulk_updater, db, redis_instance
+
+    def handle_bgp_withdrawals(self, hijacks, announcements, withdrawal_batches):
+        """
+        Handles the batches of withdrawals; returns the resulting state of the
+        hijacks, the handled withdrawals, redis and the withdrawn hijack notifications.
+        """
+        bulk_updater, db, redis_instance = self.make_bulk_updater(
+            hijacks, announcements
+        )
+        with patch("database.Producer") as mock_producer:
+            for withdrawals in withdrawal_batches:
+                bulk_updater.handle_bgp_withdrawals = dict.fromkeys(withdrawals)
+                self.assertEqual(
+                    bulk_updater._handle_bgp_withdrawals(), len(withdrawals)
+                )
+        redis_state = {}
+        for key in redis_instance.keys():
+            key_type = redis_instance.type(key)
+            if key_type == b"hash":
+                redis_state[key] = redis_instance.hgetall(key)
+            elif key_type == b"set":
+                redis_state[key] = redis_instance.smembers(key)
+        publish = mock_producer.return_value.__enter__.return_value.publish
+        notifications = sorted(
+            (kwargs["routing_key"], args[0]["key"], args[0]["end_tag"])
+            for args, kwargs in publish.call_args_list
+        )
+        return db.hijacks, db.withdrawals, redis_state, notifications
+
+    def test_handle_bgp_withdrawals(self):
+        def hijacks():
+            return {
+                "h1": {
+                    "prefix": "10.0.0.0/24",
+                    "hijack_as": 100,
+                    "type": "E|0|-|-",
+                    "peers_seen": [1, 2, 3, 4, 5],
+                },
+                "h2": {
+                    "prefix": "10.0.0.0/24",
+                    "hijack_as": 200,
+                    "type": "E|0|-|-",
+                    "peers_seen": [1, 2],
+                },
+                "h3": {
+                    "prefix": "10.0.1.0/24",
+                    "hijack_as": 300,
+                    "type": "E|0|-|-",
+                    "peers_seen": [6, 7],
+                },
+            }
+
+        def hijack_rows():
+            return {
+                hijack_key: dict(
+                    hijack,
+                    peers_withdrawn=[],
+                    time_last=timestamp(10),
+                    active=True,
+                    withdrawn=False,
+                )
+                for hijack_key, hijack in hijacks().items()
+            }
+
+        announcements = [
+            ("10.0.0.0/24", peer_asn, timestamp(10), ["h1"]) for peer_asn in range(3, 6)
+        ]
+        announcements += [
+            ("10.0.0.0/24", peer_asn, timestamp(10), ["h1", "h2"])
+            for peer_asn in [1, 2]
+        ]
+        # re-announced after its withdrawal
+        announcements.append(("10.0.1.0/24", 6, timestamp(30), ["h3"]))
+        announcements.append(("10.0.1.0/24", 7, timestamp(10), ["h3"]))
+        withdrawals = [
+            # across h1 and h2 (which is withdrawn by the second one)
+            ("10.0.0.0/24", 1, timestamp(20), "w1"),
+            ("10.0.0.0/24", 1, timestamp(21), "w2"),
+            ("10.0.0.0/24", 2, timestamp(22), "w3"),
+            # older than the latest announcement
+            ("10.0.1.0/24", 6, timestamp(20), "w4"),
+            ("10.0.1.0/24", 7, timestamp(25), "w5"),
+            # no hijack
+            ("10.0.2.0/24", 1, timestamp(20), "w6"),
+            # h1 is withdrawn by the second one, and then no longer active
+            ("10.0.0.0/24", 3, timestamp(23), "w7"),
+            ("10.0.0.0/24", 4, timestamp(24), "w8"),
+            ("10.0.0.0/24", 5, timestamp(25), "w9"),
+        ]
+
+        batch_state = self.handle_bgp_withdrawals(
+            hijack_rows(), announcements, [withdrawals]
+        )
+        # as handled one by one
+        self.assertEqual(
+            batch_state,
+            self.handle_bgp_withdrawals(
+                hijack_rows(),
+                announcements,
+                [[withdrawal] for withdrawal in withdrawals],
+            ),
+        )
+        hijack_state, withdrawal_state, redis_state, notifications = batch_state
+        self.assertEqual(hijack_state["h1"]["peers_withdrawn"], [1, 2, 3, 4])
+        self.assertEqual(hijack_state["h1"]["time_last"], timestamp(24))
+        self.assertEqual(hijack_state["h2"]["peers_withdrawn"], [1, 2])
+        self.assertEqual(hijack_state["h3"]["peers_withdrawn"], [7])
+        self.assertEqual(
+            [hijack_state[key]["withdrawn"] for key in ["h1", "h2", "h3"]],
+            [True, True, False],
+        )
+        self.assertEqual(withdrawal_state["w1"], {"h1", "h2"})
+        self.assertEqual(withdrawal_state["w6"], set())
+        self.assertEqual(withdrawal_state["w9"], set())
+        self.assertEqual(
+            notifications,
+            sorted(
+                (routing_key, hijack_key, "withdrawn")
+                for routing_key in ["mail-log", "hij-log"]
+                for hijack_key in ["h1", "h2"]
+            ),
+        )
+        # only h3 is left in redis, with the keys of its withdrawals
+        h3_redis_keys = redis_hijack_keys(redis_key("10.0.1.0/24", 300, "E|0|-|-"))
+        self.assertIn(h3_redis_keys[0].encode(), redis_state)
+        self.assertEqual(redis_state[h3_redis_keys[6].encode()], {b"w4", b"w5"})
+        self.assertEqual(redis_state[b"persistent-keys"], {b"h3"})
+
+    def test_handle_bgp_withdrawals_large_batch(self):
+        # more BGP update keys for a single hijack than Lua can unpack, as
+        # repeated withdrawals of a few of its peers
+        peers_seen = list(range(1, 101))
+        hijacks = {
+            "h1": {
+                "prefix": "10.0.0.0/24",
+                "hijack_as": 100,
+                "type": "E|0|-|-",
+                "peers_seen": peers_seen,
+                "peers_withdrawn": [],
+                "time_last": timestamp(10),
+                "active": True,
+                "withdrawn": False,
+            }
+        }
+        announcements = [
+            ("10.0.0.0/24", peer_asn, timestamp(10), ["h1"]) for peer_asn in peers_seen
+        ]
+        withdrawals = [
+            ("10.0.0.0/24", i % 10 + 1, timestamp(20 + i), "w{}".format(i))
+            for i in range(9000)
+        ]
+
+        hijack_state, withdrawal_state, redis_state, _ = self.handle_bgp_withdrawals(
+            hijacks, announcements, [withdrawals]
+        )
+        self.assertEqual(hijack_state["h1"]["peers_withdrawn"], list(range(1, 11)))
+        self.assertEqual(hijack_state["h1"]["time_last"], timestamp(29))
+        self.assertFalse(hijack_state["h1"]["withdrawn"])
+        self.assertEqual(len(withdrawal_state), 9000)
+        h1_redis_keys = redis_hijack_keys(redis_key("10.0.0.0/24", 100, "E|0|-|-"))
+        self.assertEqual(len(redis_state[h1_redis_keys[6].encode()]), 9000)
+
+
+def bgp_update_row(key, peer_asn, seconds):
+    return (
+        "10.0.0.0/24",
+        key,
+        100,
+        peer_asn,
+        [peer_asn, 100],
+        "ripe-ris|rrc00",
+        "A",
+        [],
+        timestamp(seconds),
+        [],
+        False,
+        "10.0.0.0/24",
+        None,
+    )
+
+
+def hijack_update(peers_seen, community_annotation, seconds):
+    return {
+        "key": "h1",
+        "prefix": "10.0.0.0/24",
+        "hijack_as": 200,
+        "type": "E|0|-|-",
+        "time_started": seconds,
+        "time_last": seconds,
+        "peers_seen": peers_seen,
+        "asns_inf": [peers_seen[-1]],
+        "num_asns_inf": 1,
+        "monitor_keys": ["k{}".format(seconds)],
+        "time_detected": 10,
+        "configured_prefix": "10.0.0.0/24",
+        "timestamp_of_config": 10,
+        "community_annotation": community_annotation,
+        "rpki_status": "NA",
+    }
+
+
+class DatabaseStagingTester(unittest.TestCase):
+    def setUp(self):
+        self.db = MagicMock()
+        self.db.execute.return_value = []
+        # the bulk updater runs in the test instead of its own process
+        with patch("database.DB", MagicMock(return_value=self.db)), patch(
+            "redis.Redis", MagicMock(return_value=fakeredis.FakeStrictRedis())
+        ), patch("database.wait_data_worker_dependencies"), patch(
+            "database.mp.Process"
+        ), patch(
+            "database.mp.Queue", queue.Queue
+        ):
+            self.data_worker = database.DatabaseDataWorker(
+                MagicMock(), {"data_worker_running": True}
+            )
+        self.bulk_updater = self.data_worker.bulk_updater
+        # the rows of the BGP update inserts
+        self.inserted_rows = []
+        self.db.copy_values.side_effect = lambda table, columns, rows: (
+            self.inserted_rows.extend(rows)
+        )
+
+    def stage(self, entry_type, entries):
+        message = MagicMock()
+        self.data_worker.stage_entries(message, entry_type, entries)
+        return message
+
+    def test_drain_staging_queue_duplicates(self):
+        self.stage(
+            "insert_bgp_entries",
+            [bgp_update_row("u1", 1, 10), bgp_update_row("u2", 2, 10)],
+        )
+        self.stage("insert_bgp_entries", [bgp_update_row("u1", 3, 20)])
+        self.stage("insert_hijacks_entries", [hijack_update([1, 2], "NA", 10)])
+        self.stage("insert_hijacks_entries", [hijack_update([1, 2, 3], "critical", 20)])
+        withdrawal = ("10.0.0.0/24", 1, timestamp(30), "w1")
+        self.stage("handle_bgp_withdrawals", [withdrawal])
+        self.stage("handle_bgp_withdrawals", [withdrawal])
+        self.stage("handled_bgp_entries", [("u2",)])
+        self.stage("handled_bgp_entries", [("u2",)])
+
+        self.bulk_updater._drain_staging_queue()
+        # the latest row of each key wins
+        self.assertEqual(
+            self.bulk_updater.insert_bgp_entries,
+            {"u1": bgp_update_row("u1", 3, 20), "u2": bgp_update_row("u2", 2, 10)},
+        )
+        self.assertEqual(list(self.bulk_updater.insert_hijacks_entries), ["h1"])
+        hijack = self.bulk_updater.insert_hijacks_entries["h1"]
+        self.assertEqual(hijack["peers_seen"], [1, 2, 3])
+        self.assertEqual(hijack["num_peers_seen"], 3)
+        self.assertEqual(hijack["community_annotation"], "critical")
+        self.assertEqual((hijack["time_started"], hijack["time_last"]), (10, 20))
+        self.assertEqual(hijack["asns_inf"], {2, 3})
+        self.assertEqual(hijack["monitor_keys"], {"k10", "k20"})
+        self.assertEqual(list(self.bulk_updater.handle_bgp_withdrawals), [withdrawal])
+        self.assertEqual(self.bulk_updater.handled_bgp_entries, {("u2",)})
+
+        # each key is inserted once
+        self.bulk_updater._insert_bgp_updates()
+        self.assertEqual([row[1] for row in self.inserted_rows], ["u1", "u2"])
+        self.assertEqual(self.inserted_rows[0][3], 3)
+
+    def test_ack_after_commit(self):
+        messages = [
+            self.stage("insert_bgp_entries", [bgp_update_row("u1", 1, 10)]),
+            self.stage(
+                "handle_bgp_withdrawals", [("10.0.0.0/24", 1, timestamp(30), "w1")]
+            ),
+        ]
+        # staged, but not committed yet
+        self.data_worker.ack_committed_messages()
+        for message in messages:
+            message.ack.assert_not_called()
+
+        # the insert fails, and is retried
+        self.db.copy_values.side_effect = Exception("connection lost")
+        self.bulk_updater.bulk_update()
+        self.assertTrue(self.bulk_updater.bulk_update_failed)
+        retried = self.stage("insert_bgp_entries", [bgp_update_row("u2", 2, 10)])
+        self.bulk_updater.bulk_update()
+        self.data_worker.ack_committed_messages()
+        for message in messages + [retried]:
+            message.ack.assert_not_called()
+
+        # acked once committed, along with the messages drained after the retry
+        self.db.copy_values.side_effect = lambda table, columns, rows: (
+            self.inserted_rows.extend(rows)
+        )
+        self.bulk_updater.bulk_update()
+        self.data_worker.ack_committed_messages()
+        for message in messages:
+            message.ack.assert_called_once_with()
+        retried.ack.assert_not_called()
+        self.bulk_updater.bulk_update()
+        self.data_worker.ack_committed_messages()
+        retried.ack.assert_called_once_with()
+        self.assertEqual([row[1] for row in self.inserted_rows], ["u1", "u2"])
+        self.assertEqual(self.data_worker.staged_messages, {})
+
+    def test_ack_dropped_rows(self):
+        message = self.stage("insert_bgp_entries", [bgp_update_row("u1", 1, 10)])
+        self.db.copy_values.side_effect = Exception("invalid row")
+        with patch("database.DB_BULK_UPDATE_MAX_RETRIES", 1):
+            self.bulk_updater.bulk_update()
+            self.data_worker.ack_committed_messages()
+            message.ack.assert_not_called()
+            # dropped after the retry, and then acked
+            self.bulk_updater.bulk_update()
+            self.data_worker.ack_committed_messages()
+        message.ack.assert_called_once_with()
+        self.assertEqual(self.bulk_updater.insert_bgp_entries, {})
+
+    def test_ack_without_rows(self):
+        message = self.stage("handle_bgp_withdrawals", [])
+        message.ack.assert_called_once_with()
+        self.assertTrue(self.data_worker.staging_queue.empty())
+        self.assertEqual(self.data_worker.staged_messages, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,6 @@
+CREATE INDEX IF NOT EXISTS key_idx
+ON bgp_updates(key);
+
+CREATE INDEX IF NOT EXISTS withdrawn_peer_idx
+ON bgp_updates(prefix, peer_asn, timestamp DESC)
+WHERE type = 'W' AND handled = true;
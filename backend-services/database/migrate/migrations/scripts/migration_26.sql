@@ -0,0 +1,22 @@
+CREATE INDEX IF NOT EXISTS hijack_key_gin_idx
+ON bgp_updates USING GIN (hijack_key);
+
+CREATE INDEX IF NOT EXISTS hijack_updates_idx
+ON bgp_updates(type)
+WHERE handled = true AND hijack_key <> ARRAY[]::text[];
+
+CREATE OR REPLACE FUNCTION search_bgpupdates_by_hijack_key(key text)
+RETURNS SETOF view_bgpupdates AS $$
+    SELECT *
+    FROM view_bgpupdates
+    WHERE
+        view_bgpupdates.hijack_key @> ARRAY[key]
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION search_bgpupdates_by_as_path_and_hijack_key(key text, as_paths BIGINT[])
+    RETURNS SETOF view_bgpupdates AS $$
+    SELECT *
+    FROM view_bgpupdates
+    WHERE
+        view_bgpupdates.hijack_key @> ARRAY[key] and as_paths <@ view_bgpupdates.as_path
+$$ LANGUAGE sql STABLE;
@@ -1,20 +1,24 @@
 import ipaddress
-import json as classic_json
 import multiprocessing as mp
+import os
 import re
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
 from typing import Callable
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import NoReturn
+from typing import Optional
 from typing import Tuple
 
+import pytricia
 import redis
+import requests
 import ujson as json
-from artemis_utils import exception_handler
 from artemis_utils import get_hash
-from artemis_utils import get_ip_version
 from artemis_utils import get_logger
 from artemis_utils.constants import DATABASE_HOST
 from artemis_utils.constants import NOTIFIER_HOST
@@ -29,10 +33,14 @@ from artemis_utils.envvars import RPKI_VALIDATOR_PORT
 from artemis_utils.envvars import TEST_ENV
 from artemis_utils.rabbitmq import create_exchange
 from artemis_utils.rabbitmq import create_queue
+from artemis_utils.redis import decode_redis_hijack
+from artemis_utils.redis import encode_redis_hijack
+from artemis_utils.redis import HIJACK_PURGE_SCRIPT
 from artemis_utils.redis import ping_redis
-from artemis_utils.redis import purge_redis_eph_pers_keys
+from artemis_utils.redis import purge_redis_hijack
+from artemis_utils.redis import redis_hijack_keys
+from artemis_utils.redis import REDIS_HIJACK_LUA_HELPERS
 from artemis_utils.redis import redis_key
-from artemis_utils.rpki import get_rpki_val_result
 from artemis_utils.service import wait_data_worker_dependencies
 from artemis_utils.updates import clean_as_path
 from artemis_utils.updates import key_generator
@@ -51,27 +59,430 @@ log = get_logger()
 # shared memory object locks
 shared_memory_locks = {"data_worker": mp.Lock()}
 
+# hijack cache counters, shared by the data worker and the REST handlers
+hijack_cache_stats = {"hits": mp.Value("L", 0), "misses": mp.Value("L", 0)}
+
 # global vars
 SERVICE_NAME = "detection"
-HIJACK_DIM_COMBINATIONS = [
-    ["S", "0", "-", "-"],
-    ["S", "0", "-", "L"],
-    ["S", "1", "-", "-"],
-    ["S", "1", "-", "L"],
-    ["S", "P", "-", "-"],
-    ["S", "-", "-", "-"],
-    ["S", "-", "-", "L"],
-    ["E", "0", "-", "-"],
-    ["E", "0", "-", "L"],
-    ["E", "1", "-", "-"],
-    ["E", "1", "-", "L"],
-    ["E", "P", "-", "-"],
-    ["E", "-", "-", "L"],
-    ["Q", "0", "-", "-"],
-    ["Q", "0", "-", "L"],
-]
+HIJACK_DIM_COMBINATIONS = {
+    ("S", "0", "-", "-"),
+    ("S", "0", "-", "L"),
+    ("S", "1", "-", "-"),
+    ("S", "1", "-", "L"),
+    ("S", "P", "-", "-"),
+    ("S", "-", "-", "-"),
+    ("S", "-", "-", "L"),
+    ("E", "0", "-", "-"),
+    ("E", "0", "-", "L"),
+    ("E", "1", "-", "-"),
+    ("E", "1", "-", "L"),
+    ("E", "P", "-", "-"),
+    ("E", "-", "-", "L"),
+    ("Q", "0", "-", "-"),
+    ("Q", "0", "-", "L"),
+}
 DATA_WORKER_DEPENDENCIES = [PREFIXTREE_HOST, DATABASE_HOST, NOTIFIER_HOST]
 
+# number of BGP update keys cached per hijack; past this cap the hijack
+# updates are looked up in the database (bgp_updates.hijack_key) instead
+HIJACK_BGPUPDATE_KEYS_CAP = int(os.getenv("HIJACK_BGPUPDATE_KEYS_CAP", 10000))
+# micro-batching of stored BGP updates; a batch is evaluated when it holds
+# DETECTION_BATCH_SIZE updates or its oldest update is DETECTION_BATCH_TIMEOUT
+# milliseconds old (batch size 1 disables batching)
+DETECTION_BATCH_SIZE = max(int(os.getenv("DETECTION_BATCH_SIZE", 1)), 1)
+DETECTION_BATCH_TIMEOUT = int(os.getenv("DETECTION_BATCH_TIMEOUT", 100))
+# number of decoded hijacks cached by the data worker; a cached hijack is
+# valid as long as its version matches the version field of its redis hash
+HIJACK_CACHE_SIZE = int(os.getenv("HIJACK_CACHE_SIZE", 10000))
+# ROA source of the local RPKI validation (a Routinator JSON/CSV export,
+# as a file path or URL); the RTR session is used if empty
+RPKI_ROAS_SOURCE = os.getenv("RPKI_ROAS_SOURCE", "")
+# interval (sec) between ROA snapshot refreshes
+RPKI_ROAS_REFRESH_INTERVAL = int(os.getenv("RPKI_ROAS_REFRESH_INTERVAL", 600))
+# interval (sec) between retries of a failed fetch of the prefixtree rule configurations
+PREFIX_NODE_CONFS_RETRY_INTERVAL = 5
+
+# atomically merges a hijack update into its redis entry, stamps it with a
+# new version and returns {1 if the hijack is new else 0, version,
+# hijack fields, peers seen, infected ASes count, community annotation};
+# the hijack fields and peers seen are nil if the cached version of the
+# caller was still current; prefix-peer pairs with a first hijack are
+# published as "+{prefix}_{peer}" on the prefix-peer-hijacks channel
+# KEYS: hijack, persistent-keys, hij_orig_neighb, hijack prefixes-peers,
+#       peers seen, infected ASes, BGP update keys, hijack version counter,
+#       prefix-peer hijacks (one per prefix-peer pair)
+# ARGV: hijack fields, peers seen, infected ASes, BGP update keys,
+#       community annotation matches, origin-neighbor pairs, prefix-peer pairs,
+#       BGP update keys cap, cached hijack version
+HIJACK_UPSERT_SCRIPT = (
+    REDIS_HIJACK_LUA_HELPERS
+    + """
+local update = cjson.decode(ARGV[1])
+local is_new = 0
+local annotation = "NA"
+local cached_version = redis.call("HGET", KEYS[1], "version")
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    is_new = 1
+    for field, value in pairs(update) do
+        redis.call("HSET", KEYS[1], field, value)
+    end
+    redis.call("SADD", KEYS[2], update.key)
+else
+    local current = redis.call(
+        "HMGET", KEYS[1], "time_started", "time_last", "community_annotation"
+    )
+    if tonumber(update.time_started) < tonumber(current[1]) then
+        redis.call("HSET", KEYS[1], "time_started", update.time_started)
+    end
+    if tonumber(update.time_last) > tonumber(current[2]) then
+        redis.call("HSET", KEYS[1], "time_last", update.time_last)
+    end
+    -- no monitor keys, since db already knows!
+    redis.call(
+        "HSET", KEYS[1],
+        "outdated_parent", update.outdated_parent,
+        "rpki_status", update.rpki_status
+    )
+    if current[3] and current[3] ~= "" then
+        annotation = current[3]
+    end
+end
+
+-- community annotations of lower index take precedence
+for _, match in ipairs(cjson.decode(ARGV[5])) do
+    if annotation == "NA" then
+        annotation = match[1]
+    else
+        local precedence = {}
+        for i, item in ipairs(match[2]) do
+            precedence[item] = precedence[item] or i
+        end
+        if precedence[annotation] == nil then
+            break
+        end
+        if precedence[match[1]] < precedence[annotation] then
+            annotation = match[1]
+        end
+    end
+end
+local version = redis.call("INCR", KEYS[8])
+redis.call(
+    "HSET", KEYS[1], "community_annotation", annotation, "version", version
+)
+
+sadd_all(KEYS[5], cjson.decode(ARGV[2]))
+-- added in chunks, since unpack is limited by the Lua C stack (~8000 values)
+local asns_inf = cjson.decode(ARGV[3])
+if #asns_inf == 0 then
+    redis.call("PFADD", KEYS[6])
+end
+for i = 1, #asns_inf, 1000 do
+    redis.call("PFADD", KEYS[6], unpack(asns_inf, i, math.min(i + 999, #asns_inf)))
+end
+add_bgpupdate_keys(KEYS[1], KEYS[7], tonumber(ARGV[8]), cjson.decode(ARGV[4]))
+sadd_all(KEYS[3], cjson.decode(ARGV[6]))
+for i, prefix_peer in ipairs(cjson.decode(ARGV[7])) do
+    redis.call("SADD", KEYS[4], prefix_peer)
+    if redis.call("SADD", KEYS[8 + i], KEYS[1]) == 1
+        and redis.call("SCARD", KEYS[8 + i]) == 1 then
+        redis.call("PUBLISH", "prefix-peer-hijacks", "+" .. prefix_peer)
+    end
+end
+if is_new == 0 and cached_version == ARGV[9] then
+    return {is_new, version, false, false, redis.call("PFCOUNT", KEYS[6]), annotation}
+end
+return {
+    is_new,
+    version,
+    redis.call("HGETALL", KEYS[1]),
+    redis.call("SMEMBERS", KEYS[5]),
+    redis.call("PFCOUNT", KEYS[6]),
+    annotation,
+}
+"""
+)
+
+
+def parse_stored_bgp_update(monitor_event: Dict) -> Dict:
+    """
+    Translates a stored BGP update, as received from the bgp-update exchange,
+    to the monitor event format used by detection.
+    """
+    monitor_event["path"] = monitor_event["as_path"]
+    monitor_event["timestamp"] = datetime(
+        *map(int, re.findall(r"\d+", monitor_event["timestamp"]))
+    ).timestamp()
+    return monitor_event
+
+
+def get_prefix_length(prefix: str) -> int:
+    """
+    Returns the length of a prefix without building an ip_network object.
+    """
+    if "/" in prefix:
+        return int(prefix.rsplit("/", 1)[1])
+    if ":" in prefix:
+        return 128
+    return 32
+
+
+def detect_path_type_P_hijack(orig_path: List, prepend_seqs: List) -> Tuple[int, str]:
+    """
+    Type-P hijack detection.
+    In case there is a type-P hijack (i.e. no pattern matches
+    an incoming BGP update), it returns a tuple with the
+    potential hijacker AS plus the hijack type (P).
+    The potential hijacker is the first AS that differs in the
+    most specific (best matching) pattern, starting from the origin
+    AS.
+    """
+    best_match_length = 0
+    for conf_seq in prepend_seqs:
+        if len(orig_path) >= len(conf_seq) + 1:
+            # isolate the monitor event pattern that
+            # should be matched to the configured pattern
+            # (excluding the origin which is the very first hop
+            # of the incoming AS-path)
+            monitor_event_seq = orig_path[len(orig_path) - len(conf_seq) - 1 : -1]
+            if monitor_event_seq == conf_seq:
+                # patterns match (no hijack of type P)
+                return -1, "-"
+            # after reversing the pattern sequences (i.e., start with
+            # origin), find the greatest length of consecutive matches
+            this_best_match_length = 0
+            for observed_as, conf_as in zip(monitor_event_seq[::-1], conf_seq[::-1]):
+                if observed_as != conf_as:
+                    break
+                this_best_match_length += 1
+            # update the best matching length for all patterns found till now
+            best_match_length = max(best_match_length, this_best_match_length)
+    # the hijacker is the first AS that breaks the most specific (best matching) pattern
+    return orig_path[len(orig_path) - best_match_length - 2], "P"
+
+
+def compile_prefix_node_conf(prefix_node_len: int, conf: Dict) -> Callable:
+    """
+    Compiles a prefix node rule into a specialised matcher function.
+    The matcher receives the cleaned AS-path, the original AS-path and
+    the prefix length of a BGP update and returns the hijack dimensions
+    (prefix, path, dplane, policy) together with the potential hijacker.
+    """
+    origin_asns = frozenset(conf["origin_asns"])
+    # [-1] origin means "allow everything", while no origin means squatting
+    any_origin = conf["origin_asns"] == [-1]
+    squatting = not conf["origin_asns"]
+    neighbors = frozenset(conf["neighbors"])
+    # [] or [-1] neighbors means "allow everything"
+    any_neighbor = (not conf["neighbors"]) or conf["neighbors"] == [-1]
+    prepend_seqs = [list(conf_seq) for conf_seq in conf["prepend_seq"]]
+    no_export = "no-export" in conf["policies"]
+
+    def match(path: List, orig_path: List, prefix_len: int) -> Tuple[Tuple, int]:
+        path_len = len(path)
+
+        # prefix dimension
+        if squatting:
+            prefix_dim = "Q"
+        elif prefix_node_len < prefix_len:
+            prefix_dim = "S"
+        else:
+            prefix_dim = "E"
+
+        # path dimension (type-N and type-U are not supported)
+        path_hijacker = -1
+        path_dim = "-"
+        if path_len > 0:
+            if not any_origin and path[-1] not in origin_asns:
+                path_hijacker = path[-1]
+                path_dim = "0"
+            elif path_len > 1:
+                if not any_neighbor and path[-2] not in neighbors:
+                    path_hijacker = path[-2]
+                    path_dim = "1"
+                elif prepend_seqs:
+                    path_hijacker, path_dim = detect_path_type_P_hijack(
+                        orig_path, prepend_seqs
+                    )
+
+        # policy dimension (only route leaks are supported)
+        if no_export and path_len > 3:
+            # show pol hijacker only if the path hijacker is uncertain
+            if path_hijacker == -1:
+                path_hijacker = path[-2]
+            return (prefix_dim, path_dim, "-", "L"), path_hijacker
+
+        # data plane dimension is not supported
+        return (prefix_dim, path_dim, "-", "-"), path_hijacker
+
+    return match
+
+
+def compile_prefix_node(prefix_node: Dict) -> List[Callable]:
+    """
+    Compiles all rules of a prefix node into matcher functions.
+    """
+    prefix_node_len = get_prefix_length(prefix_node["prefix"])
+    return [
+        compile_prefix_node_conf(prefix_node_len, conf)
+        for conf in prefix_node["data"]["confs"]
+    ]
+
+
+def compile_community_annotations(prefix_node: Dict) -> Callable:
+    """
+    Compiles the community annotation rules of a prefix node into an inverted
+    index of community -> candidate rules and returns an
+    annotate(communities) function.
+    annotate returns the (annotation, annotation precedence list) pairs of the
+    rules matched by a set of BGP update communities, in configuration order.
+    """
+    # (annotation, precedence list, "in" communities, "out" communities)
+    rules = []
+    # a rule is a candidate only if one (any) of its "in" communities is seen
+    candidate_rules = {}
+    # rules without "in" communities are always candidates
+    unconditional_rules = []
+    for conf in prefix_node["data"]["confs"]:
+        annotation_elements = conf.get("community_annotations", [])
+        annotations = [
+            annotation
+            for annotation_element in annotation_elements
+            for annotation in annotation_element
+        ]
+        for annotation_element in annotation_elements:
+            for annotation in annotation_element:
+                for community_rule in annotation_element[annotation]:
+                    in_communities = frozenset(community_rule.get("in", []))
+                    out_communities = frozenset(community_rule.get("out", []))
+                    if in_communities:
+                        candidate_rules.setdefault(
+                            next(iter(in_communities)), []
+                        ).append(len(rules))
+                    else:
+                        unconditional_rules.append(len(rules))
+                    rules.append(
+                        (annotation, annotations, in_communities, out_communities)
+                    )
+
+    def annotate(communities: set) -> List[Tuple]:
+        if not rules:
+            return []
+        candidates = set(unconditional_rules)
+        for community in communities:
+            candidates.update(candidate_rules.get(community, ()))
+        matches = []
+        for rule in sorted(candidates):
+            annotation, annotations, in_communities, out_communities = rules[rule]
+            if in_communities <= communities and out_communities.isdisjoint(
+                communities
+            ):
+                matches.append((annotation, annotations))
+        return matches
+
+    return annotate
+
+
+def update_prefix_peer_hijacks(prefix_peer_hijacks: Dict, change: str) -> NoReturn:
+    """
+    Applies a "+{prefix}_{peer}" or "-{prefix}_{peer}" change, as published on
+    the prefix-peer-hijacks channel, to a peer asn -> {prefixes} index.
+    """
+    prefix, peer_asn = change[1:].rsplit("_", 1)
+    if change[0] == "+":
+        prefix_peer_hijacks.setdefault(int(peer_asn), set()).add(prefix)
+    else:
+        prefix_peer_hijacks.get(int(peer_asn), set()).discard(prefix)
+
+
+def parse_roas(roas_export: str) -> List[Tuple[str, int, int]]:
+    """
+    Parses a Routinator JSON or CSV ROA export to (prefix, max length, asn) ROAs.
+    """
+    roas = []
+    if roas_export.lstrip().startswith("{"):
+        for roa in json.loads(roas_export)["roas"]:
+            roas.append(
+                (
+                    roa["prefix"],
+                    int(roa["maxLength"]),
+                    int(str(roa["asn"]).upper().lstrip("AS")),
+                )
+            )
+    else:
+        for line in roas_export.splitlines():
+            fields = line.strip().split(",")
+            # skip the header and empty lines
+            if len(fields) < 3 or not fields[2].isdigit():
+                continue
+            roas.append(
+                (fields[1], int(fields[2]), int(fields[0].upper().lstrip("AS")))
+            )
+    return roas
+
+
+def load_roas(source: str) -> List[Tuple[str, int, int]]:
+    """
+    Loads the ROAs of a Routinator JSON or CSV export (file path or URL).
+    """
+    if source.startswith(("http://", "https://")):
+        r = requests.get(source, timeout=60)
+        r.raise_for_status()
+        return parse_roas(r.text)
+    with open(source) as f:
+        return parse_roas(f.read())
+
+
+def get_rtr_roas(rtrmanager) -> Iterable[Tuple[str, int, int]]:
+    """
+    Returns the (prefix, max length, asn) ROAs synced by an RTR session.
+    """
+    for records in (rtrmanager.ipv4_records(), rtrmanager.ipv6_records()):
+        for record in records:
+            yield (
+                "{}/{}".format(record.prefix, record.min_len),
+                record.max_len,
+                record.asn,
+            )
+
+
+def build_roa_index(roas: Iterable[Tuple[str, int, int]]) -> Dict:
+    """
+    Builds a per IP version pytricia index of ROA prefix -> [(asn, max length)].
+    """
+    roa_index = {"v4": pytricia.PyTricia(32), "v6": pytricia.PyTricia(128)}
+    for prefix, max_len, asn in roas:
+        tree = roa_index["v6" if ":" in prefix else "v4"]
+        if tree.has_key(prefix):
+            tree[prefix].append((asn, max_len))
+        else:
+            tree[prefix] = [(asn, max_len)]
+    return roa_index
+
+
+def get_rpki_status(roa_index: Dict, asn: int, prefix: str) -> str:
+    """
+    Validates the origin of a prefix against the covering ROAs of an index
+    (RFC 6811): VD (valid), IA (invalid AS), IL (invalid length) or NF (not found).
+    """
+    tree = roa_index["v6" if ":" in prefix else "v4"]
+    prefix_len = get_prefix_length(prefix)
+    covered = False
+    length_invalid = False
+    roa_prefix = tree.get_key(prefix)
+    while roa_prefix is not None:
+        for roa_asn, max_len in tree[roa_prefix]:
+            covered = True
+            if roa_asn == asn:
+                if prefix_len <= max_len:
+                    return "VD"
+                length_invalid = True
+        roa_prefix = tree.parent(roa_prefix)
+    if not covered:
+        return "NF"
+    if length_invalid:
+        return "IL"
+    return "IA"
+
 
 class ConfigHandler(RequestHandler):
     """
@@ -119,7 +530,8 @@ class HealthHandler(RequestHandler):
     def get(self):
         """
         Extract the status of a service via a GET request.
-        :return: {"status" : <unconfigured|running|stopped><,reconfiguring>}
+        :return: {"status" : <unconfigured|running|stopped><,reconfiguring>,
+                  "hijack_cache": {"hits": <hits>, "misses": <misses>}}
         """
         status = "stopped"
         shared_memory_locks["data_worker"].acquire()
@@ -128,7 +540,15 @@ class HealthHandler(RequestHandler):
         shared_memory_locks["data_worker"].release()
         if self.shared_memory_manager_dict["service_reconfiguring"]:
             status += ",reconfiguring"
-        self.write({"status": status})
+        self.write(
+            {
+                "status": status,
+                "hijack_cache": {
+                    "hits": hijack_cache_stats["hits"].value,
+                    "misses": hijack_cache_stats["misses"].value,
+                },
+            }
+        )
 
 
 class ControlHandler(RequestHandler):
@@ -273,6 +693,9 @@ class DetectionDataWorker(ConsumerProducerMixin):
 
         # EXCHANGES
         self.update_exchange = create_exchange("bgp-update", connection, declare=True)
+        self.update_hashing = create_exchange(
+            "bgp-update-hashing", connection, "x-consistent-hash", declare=True
+        )
         self.hijack_exchange = create_exchange(
             "hijack-update", connection, declare=True
         )
@@ -288,17 +711,14 @@ class DetectionDataWorker(ConsumerProducerMixin):
         self.command_exchange = create_exchange("command", connection, declare=True)
 
         # QUEUES
+        # every replica owns a (weight 1) share of the configured prefixes;
+        # the shares are rebalanced by rabbitmq as replicas join or leave
         self.update_queue = create_queue(
             SERVICE_NAME,
-            exchange=self.update_exchange,
-            routing_key="stored-update-with-prefix-node",
-            priority=1,
-        )
-        self.hijack_ongoing_queue = create_queue(
-            SERVICE_NAME,
-            exchange=self.hijack_exchange,
-            routing_key="ongoing-with-prefix-node",
+            exchange=self.update_hashing,
+            routing_key="1",
             priority=1,
+            random=True,
         )
         self.stop_queue = create_queue(
             "{}-{}".format(SERVICE_NAME, uuid()),
@@ -313,8 +733,43 @@ class DetectionDataWorker(ConsumerProducerMixin):
 
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
         ping_redis(self.redis)
-
-        if RPKI_VALIDATOR_ENABLED == "true":
+        self.redis_upsert_hijack = self.redis.register_script(HIJACK_UPSERT_SCRIPT)
+        self.redis_purge_hijack = self.redis.register_script(HIJACK_PURGE_SCRIPT)
+
+        # compiled rule matchers per (prefix length, conf ids, configuration version)
+        self.compiled_prefix_nodes = {}
+        self.compiled_config_timestamp = -1
+        # rule configurations (by conf id) of the prefix node references of the
+        # annotated updates, of the latest and the previous configuration
+        self.prefix_node_confs = {}
+        self.latest_prefix_node_confs = {}
+        # configuration timestamp of the latest fetched rule configurations
+        self.prefix_node_confs_timestamp = -1
+        # the rule configurations are fetched in the background upon request
+        self.prefix_node_confs_requested = threading.Event()
+        # unacked messages (in order) that wait for the rule configurations
+        # of a newer configuration
+        self.pending_hashed_updates = []
+
+        # unacked stored BGP updates of the current batch and, while a batch
+        # is evaluated, its hijack updates grouped per redis hijack key
+        self.bgp_update_batch = []
+        self.bgp_update_batch_started = None
+        self.hijack_batch = None
+
+        # LRU cache of decoded hijacks: redis hijack key -> (version, hijack)
+        self.hijack_cache = OrderedDict()
+
+        # local index of the prefix-peer pairs of ongoing hijacks
+        # (peer asn -> {prefixes}); None while not in sync with redis
+        self.prefix_peer_hijacks = None
+
+        # immutable ROA snapshot, swapped as a whole upon refresh
+        self.roas = None
+        self.roa_index = None
+        self.roa_index_changed = threading.Event()
+
+        if RPKI_VALIDATOR_ENABLED == "true" and not RPKI_ROAS_SOURCE:
             from rtrlib import RTRManager
 
             while True:
@@ -338,20 +793,18 @@ class DetectionDataWorker(ConsumerProducerMixin):
                     log.info("Retrying RTR connection in 30 seconds...")
                     time.sleep(30)
 
+        if RPKI_VALIDATOR_ENABLED == "true":
+            self.refresh_roa_index()
+            threading.Thread(target=self.refresh_roa_index_loop, daemon=True).start()
+
         log.info("data worker initiated")
 
     def get_consumers(self, Consumer: Consumer, channel: Connection) -> List[Consumer]:
         return [
             Consumer(
                 queues=[self.update_queue],
-                on_message=self.handle_bgp_update,
-                prefetch_count=100,
-                accept=["ujson"],
-            ),
-            Consumer(
-                queues=[self.hijack_ongoing_queue],
-                on_message=self.handle_ongoing_hijacks,
-                prefetch_count=10,
+                on_message=self.handle_hashed_update,
+                prefetch_count=max(100, DETECTION_BATCH_SIZE),
                 accept=["ujson"],
             ),
             Consumer(
@@ -363,6 +816,13 @@ class DetectionDataWorker(ConsumerProducerMixin):
         ]
 
     def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        self.request_ongoing_hijacks()
+
+    def request_ongoing_hijacks(self) -> NoReturn:
+        """
+        Requests the BGP updates of all ongoing hijacks from the database,
+        in order to re-check them with the current detection state.
+        """
         self.producer.publish(
             "",
             exchange=self.hijack_exchange,
@@ -371,6 +831,175 @@ class DetectionDataWorker(ConsumerProducerMixin):
             serializer="ujson",
         )
 
+    def run(self, *args, **kwargs):
+        threading.Thread(target=self.sync_prefix_peer_hijacks, daemon=True).start()
+        threading.Thread(target=self.fetch_prefix_node_confs_loop, daemon=True).start()
+        self.prefix_node_confs_requested.set()
+        return super().run(*args, **kwargs)
+
+    def consume(self, *args, **kwargs):
+        # wake up at least once per batch timeout to flush partial batches
+        if DETECTION_BATCH_SIZE > 1:
+            kwargs["safety_interval"] = DETECTION_BATCH_TIMEOUT / 1000.0
+        return super().consume(*args, **kwargs)
+
+    def on_iteration(self):
+        self.handle_pending_hashed_updates()
+        if self.roa_index_changed.is_set():
+            self.roa_index_changed.clear()
+            self.revalidate_ongoing_hijacks()
+        if (
+            self.bgp_update_batch
+            and time.monotonic() - self.bgp_update_batch_started
+            >= DETECTION_BATCH_TIMEOUT / 1000.0
+        ):
+            self.flush_bgp_update_batch()
+
+    def refresh_roa_index(self) -> NoReturn:
+        """
+        Loads the current ROAs and swaps in a new ROA index if they changed.
+        """
+        try:
+            if RPKI_ROAS_SOURCE:
+                roas = frozenset(load_roas(RPKI_ROAS_SOURCE))
+            else:
+                roas = frozenset(get_rtr_roas(self.rtrmanager))
+            if roas == self.roas:
+                return
+            roa_index = build_roa_index(roas)
+            revalidate = self.roas is not None
+            self.roas = roas
+            self.roa_index = roa_index
+            log.info("ROA index refreshed with {} ROAs".format(len(roas)))
+            if revalidate:
+                self.roa_index_changed.set()
+        except Exception:
+            log.exception("exception")
+
+    def refresh_roa_index_loop(self) -> NoReturn:
+        while True:
+            time.sleep(RPKI_ROAS_REFRESH_INTERVAL)
+            self.refresh_roa_index()
+
+    def revalidate_ongoing_hijacks(self) -> NoReturn:
+        """
+        Re-validates the RPKI status of all ongoing hijacks; their updates
+        are re-checked against the current ROA index and the new status is
+        merged into redis and the database like any other hijack update.
+        """
+        log.info("ROAs changed, re-validating ongoing hijacks")
+        self.request_ongoing_hijacks()
+
+    def sync_prefix_peer_hijacks(self) -> NoReturn:
+        """
+        Keeps the local prefix-peer hijack index in sync with redis.
+        The index is bootstrapped from the prefix-peer hijack sets and then
+        updated through the prefix-peer-hijacks channel, which is subscribed
+        before the bootstrap so that no change is missed in between.
+        """
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe("prefix-peer-hijacks")
+                prefix_peer_hijacks = {}
+                for key in self.redis.scan_iter(
+                    match="prefix_*_peer_*_hijacks", count=1000
+                ):
+                    prefix, peer_asn = (
+                        key.decode("utf-8")[len("prefix_") : -len("_hijacks")]
+                    ).rsplit("_peer_", 1)
+                    prefix_peer_hijacks.setdefault(int(peer_asn), set()).add(prefix)
+                self.prefix_peer_hijacks = prefix_peer_hijacks
+                log.info("prefix-peer hijack index synced")
+                for message in pubsub.listen():
+                    update_prefix_peer_hijacks(
+                        prefix_peer_hijacks, message["data"].decode("utf-8")
+                    )
+            except Exception:
+                log.exception("exception")
+            self.prefix_peer_hijacks = None
+            time.sleep(1)
+
+    def fetch_prefix_node_confs(self) -> NoReturn:
+        """
+        Fetches the rule configurations (by conf id) of the latest configuration
+        from prefixtree, keeping the ones of the previous configuration for the
+        updates still annotated with it.
+        """
+        r = requests.get(
+            "http://{}:{}/prefixTreeConfs".format(PREFIXTREE_HOST, REST_PORT),
+            timeout=10,
+        )
+        prefix_tree_confs = r.json()
+        confs = prefix_tree_confs["confs"]
+        prefix_node_confs = dict(self.latest_prefix_node_confs)
+        prefix_node_confs.update(confs)
+        # swapped as a whole, before the timestamp that releases the pending updates
+        self.prefix_node_confs = prefix_node_confs
+        self.latest_prefix_node_confs = confs
+        self.prefix_node_confs_timestamp = prefix_tree_confs["timestamp"]
+
+    def fetch_prefix_node_confs_loop(self) -> NoReturn:
+        while True:
+            self.prefix_node_confs_requested.wait()
+            self.prefix_node_confs_requested.clear()
+            try:
+                self.fetch_prefix_node_confs()
+            except Exception:
+                log.exception("could not fetch the prefixtree rule configurations")
+                time.sleep(PREFIX_NODE_CONFS_RETRY_INTERVAL)
+                self.prefix_node_confs_requested.set()
+
+    def has_newer_prefix_nodes(self, message: Dict) -> bool:
+        """
+        Checks if a message carries prefix node references of a configuration
+        newer than the fetched rule configurations.
+        """
+        payload = message.payload
+        for update in payload if isinstance(payload, list) else [payload]:
+            if (
+                isinstance(update, dict)
+                and "prefix_node" in update
+                and "conf_ids" in update["prefix_node"]
+                and update["prefix_node"]["timestamp"]
+                > self.prefix_node_confs_timestamp
+            ):
+                return True
+        return False
+
+    def handle_pending_hashed_updates(self) -> NoReturn:
+        """
+        Handles the pending messages, in order, as soon as the rule configurations
+        of their configuration are fetched.
+        """
+        while self.pending_hashed_updates and not self.has_newer_prefix_nodes(
+            self.pending_hashed_updates[0]
+        ):
+            self.dispatch_hashed_update(self.pending_hashed_updates.pop(0))
+        if self.pending_hashed_updates:
+            self.prefix_node_confs_requested.set()
+
+    def handle_hashed_update(self, message: Dict) -> NoReturn:
+        """
+        Callback function for the updates of the configured prefixes owned by
+        this replica; stored BGP updates and ongoing hijack updates share the
+        same queue so that they are sharded the same way.
+        The messages with prefix node references of a newer configuration are
+        kept unacked until its rule configurations are fetched (off the consumer
+        loop), and so are the messages that follow them.
+        """
+        if self.pending_hashed_updates or self.has_newer_prefix_nodes(message):
+            self.pending_hashed_updates.append(message)
+            self.prefix_node_confs_requested.set()
+            return
+        self.dispatch_hashed_update(message)
+
+    def dispatch_hashed_update(self, message: Dict) -> NoReturn:
+        if message.headers.get("type") == "ongoing-with-prefix-node":
+            self.handle_ongoing_hijacks(message)
+        else:
+            self.handle_bgp_update_message(message)
+
     def handle_ongoing_hijacks(self, message: Dict) -> NoReturn:
         """
         Handles ongoing hijacks from the database.
@@ -380,6 +1009,44 @@ class DetectionDataWorker(ConsumerProducerMixin):
         for update in message.payload:
             self.handle_bgp_update(update)
 
+    def handle_bgp_update_message(self, message: Dict) -> NoReturn:
+        """
+        Callback function for stored BGP updates; the updates are either
+        handled one by one or buffered in micro-batches.
+        """
+        if DETECTION_BATCH_SIZE == 1:
+            self.handle_bgp_update(message)
+            return
+        if not self.bgp_update_batch:
+            self.bgp_update_batch_started = time.monotonic()
+        self.bgp_update_batch.append(message)
+        if len(self.bgp_update_batch) >= DETECTION_BATCH_SIZE:
+            self.flush_bgp_update_batch()
+
+    def flush_bgp_update_batch(self) -> NoReturn:
+        """
+        Evaluates the buffered BGP updates, commits every hijack of the batch
+        once with its merged updates and then acks the batch.
+        """
+        messages = self.bgp_update_batch
+        self.bgp_update_batch = []
+        self.hijack_batch = {}
+        try:
+            for message in messages:
+                try:
+                    self.handle_bgp_update(parse_stored_bgp_update(message.payload))
+                except Exception:
+                    log.exception("exception")
+            for redis_hijack_key, hijack_updates in self.hijack_batch.items():
+                try:
+                    self.commit_hijack_updates(redis_hijack_key, hijack_updates)
+                except Exception:
+                    log.exception("exception")
+        finally:
+            self.hijack_batch = None
+            for message in messages:
+                message.ack()
+
     def handle_bgp_update(self, message: Dict) -> NoReturn:
         """
         Callback function that runs the main logic of
@@ -389,11 +1056,7 @@ class DetectionDataWorker(ConsumerProducerMixin):
             monitor_event = message
         else:
             message.ack()
-            monitor_event = message.payload
-            monitor_event["path"] = monitor_event["as_path"]
-            monitor_event["timestamp"] = datetime(
-                *map(int, re.findall(r"\d+", monitor_event["timestamp"]))
-            ).timestamp()
+            monitor_event = parse_stored_bgp_update(message.payload)
 
         raw = monitor_event.copy()
 
@@ -417,81 +1080,37 @@ class DetectionDataWorker(ConsumerProducerMixin):
                 prefix_node = monitor_event["prefix_node"]
                 monitor_event["matched_prefix"] = prefix_node["prefix"]
 
-                final_hij_dimensions = [
-                    "-",
-                    "-",
-                    "-",
-                    "-",
-                ]  # prefix, path, dplane, policy
-                for prefix_node_conf in prefix_node["data"]["confs"]:
+                compiled_node = self.get_compiled_prefix_node(prefix_node)
+                if compiled_node is None:
+                    # the rules of the update cannot be resolved: drop it
+                    return
+                matchers, _ = compiled_node
+
+                final_hij_dimensions = None
+                prefix_len = get_prefix_length(monitor_event["prefix"])
+                for matcher in matchers:
                     try:
-                        path_hijacker = -1
-                        pol_hijacker = -1
-                        hij_dimensions = [
-                            "-",
-                            "-",
-                            "-",
-                            "-",
-                        ]  # prefix, path, dplane, policy
-                        hij_dimension_index = 0
-                        for func_dim in self.__hijack_dimension_checker_gen():
-                            if hij_dimension_index == 0:
-                                # prefix dimension
-                                for func_pref in func_dim():
-                                    hij_dimensions[hij_dimension_index] = func_pref(
-                                        monitor_event, prefix_node, prefix_node_conf
-                                    )
-                                    if hij_dimensions[hij_dimension_index] != "-":
-                                        break
-                            elif hij_dimension_index == 1:
-                                # path type dimension
-                                for func_path in func_dim(len(monitor_event["path"])):
-                                    (
-                                        path_hijacker,
-                                        hij_dimensions[hij_dimension_index],
-                                    ) = func_path(
-                                        monitor_event, prefix_node, prefix_node_conf
-                                    )
-                                    if hij_dimensions[hij_dimension_index] != "-":
-                                        break
-                            elif hij_dimension_index == 2:
-                                # data plane dimension
-                                for func_dplane in func_dim():
-                                    hij_dimensions[hij_dimension_index] = func_dplane(
-                                        monitor_event, prefix_node, prefix_node_conf
-                                    )
-                                    if hij_dimensions[hij_dimension_index] != "-":
-                                        break
-                            elif hij_dimension_index == 3:
-                                # policy dimension
-                                for func_pol in func_dim(len(monitor_event["path"])):
-                                    (
-                                        pol_hijacker,
-                                        hij_dimensions[hij_dimension_index],
-                                    ) = func_pol(
-                                        monitor_event, prefix_node, prefix_node_conf
-                                    )
-                                    if hij_dimensions[hij_dimension_index] != "-":
-                                        break
-                            hij_dimension_index += 1
-                        # check if dimension combination in hijack combinations for this rule,
-                        # but do not commit hijack yet (record the last possible hijack issue)
-                        if hij_dimensions in HIJACK_DIM_COMBINATIONS:
-                            final_hij_dimensions = hij_dimensions[::]
-                            is_hijack = True
-                            # show pol hijacker only if the path hijacker is uncertain
-                            hijacker = path_hijacker
-                            if path_hijacker == -1 and pol_hijacker != -1:
-                                hijacker = pol_hijacker
-                        # benign rule matching beats hijack detection
-                        else:
-                            is_hijack = False
-                            break
+                        hij_dimensions, rule_hijacker = matcher(
+                            monitor_event["path"],
+                            monitor_event["orig_path"],
+                            prefix_len,
+                        )
                     except Exception:
                         log.exception("exception")
+                        continue
+                    # check if dimension combination in hijack combinations for this rule,
+                    # but do not commit hijack yet (record the last possible hijack issue)
+                    if hij_dimensions in HIJACK_DIM_COMBINATIONS:
+                        final_hij_dimensions = hij_dimensions
+                        is_hijack = True
+                        hijacker = rule_hijacker
+                    # benign rule matching beats hijack detection
+                    else:
+                        is_hijack = False
+                        break
                 if is_hijack:
                     try:
-                        hij_dimensions = final_hij_dimensions
+                        hij_dimensions = list(final_hij_dimensions)
                         self.commit_hijack(monitor_event, hijacker, hij_dimensions)
                     except Exception:
                         log.exception("exception")
@@ -512,9 +1131,8 @@ class DetectionDataWorker(ConsumerProducerMixin):
                         monitor_event["hijack_as"],
                         monitor_event["hij_type"],
                     )
-                    outdated_hijack = self.redis.get(redis_hijack_key)
-                    purge_redis_eph_pers_keys(
-                        self.redis, redis_hijack_key, monitor_event["hij_key"]
+                    outdated_hijack = self.purge_hijack(
+                        redis_hijack_key, monitor_event["hij_key"]
                     )
                     # mark in DB only if it is the first time this hijack was purged (pre-existent in redis)
                     if outdated_hijack:
@@ -528,12 +1146,8 @@ class DetectionDataWorker(ConsumerProducerMixin):
                 != monitor_event["final_redis_hijack_key"]
             ):
                 try:
-                    outdated_hijack = self.redis.get(
-                        monitor_event["initial_redis_hijack_key"]
-                    )
                     # outdated hijack, but still a hijack; need key change
-                    purge_redis_eph_pers_keys(
-                        self.redis,
+                    outdated_hijack = self.purge_hijack(
                         monitor_event["initial_redis_hijack_key"],
                         monitor_event["hij_key"],
                     )
@@ -546,14 +1160,13 @@ class DetectionDataWorker(ConsumerProducerMixin):
                 except Exception:
                     log.exception("exception")
             elif not is_hijack:
+                # the hijacks deferred by the batch must be visible to the implicit withdrawal check
+                self.commit_pending_hijack_updates(monitor_event["prefix"])
                 self.gen_implicit_withdrawal(monitor_event)
                 self.mark_handled(raw)
 
             if outdated_hijack:
                 try:
-                    outdated_hijack = classic_json.loads(
-                        outdated_hijack.decode("utf-8")
-                    )
                     outdated_hijack["end_tag"] = "outdated"
                     self.producer.publish(
                         outdated_hijack,
@@ -588,292 +1201,74 @@ class DetectionDataWorker(ConsumerProducerMixin):
                 serializer="ujson",
             )
 
-    def __hijack_dimension_checker_gen(self) -> Callable:
-        """
-        Generator that returns hijack dimension checking functions.
-        """
-        yield self.__hijack_prefix_checker_gen
-        yield self.__hijack_path_checker_gen
-        yield self.__hijack_dplane_checker_gen
-        yield self.__hijack_pol_checker_gen
-
-    def __hijack_prefix_checker_gen(self) -> Callable:
-        """
-        Generator that returns prefix dimension detection functions.
-        """
-        yield self.detect_prefix_squatting_hijack
-        yield self.detect_prefix_subprefix_hijack
-
-    def __hijack_path_checker_gen(self, path_len: int) -> Callable:
-        """
-        Generator that returns path dimension detection functions.
-        """
-        if path_len > 0:
-            yield self.detect_path_type_0_hijack
-            if path_len > 1:
-                yield self.detect_path_type_1_hijack
-                yield self.detect_path_type_P_hijack
-                if path_len > 2:
-                    yield self.detect_path_type_N_hijack
-        yield self.detect_path_type_U_hijack
-
-    def __hijack_dplane_checker_gen(self) -> Callable:
+    def get_compiled_prefix_node(
+        self, prefix_node: Dict
+    ) -> Optional[Tuple[List[Callable], Callable]]:
         """
-        Generator that returns data plane dimension detection functions.
+        Returns the compiled rule matchers and community annotator of a prefix node
+        (or prefix node reference), or None if its rule configurations cannot be
+        resolved. Both depend only on the prefix length and the rule
+        configurations of the node, so they are compiled once per (prefix length,
+        conf ids) and configuration version, and the range nodes of a configured
+        prefix share them; the cache is dropped as soon as a newer configuration is seen.
         """
-        yield self.detect_dplane_blackholing_hijack
-        yield self.detect_dplane_imposture_hijack
-        yield self.detect_dplane_mitm_hijack
+        node_key = (
+            get_prefix_length(prefix_node["prefix"]),
+            # prefix nodes with inline rule configurations are cached per prefix
+            tuple(prefix_node["conf_ids"])
+            if "conf_ids" in prefix_node
+            else prefix_node["prefix"],
+            prefix_node["timestamp"],
+        )
+        compiled_node = self.compiled_prefix_nodes.get(node_key)
+        if compiled_node is None:
+            if prefix_node["timestamp"] > self.compiled_config_timestamp:
+                self.compiled_prefix_nodes.clear()
+                self.compiled_config_timestamp = prefix_node["timestamp"]
+            if "data" not in prefix_node:
+                prefix_node = self.resolve_prefix_node(prefix_node)
+                if prefix_node is None:
+                    return None
+            compiled_node = (
+                compile_prefix_node(prefix_node),
+                compile_community_annotations(prefix_node),
+            )
+            self.compiled_prefix_nodes[node_key] = compiled_node
+        return compiled_node
 
-    def __hijack_pol_checker_gen(self, path_len: int) -> Callable:
-        """
-        Generator that returns policy dimension detection functions.
+    def resolve_prefix_node(self, prefix_node: Dict) -> Optional[Dict]:
         """
-        if path_len > 3:
-            yield self.detect_pol_leak_hijack
-        yield self.detect_pol_other_hijack
-
-    @exception_handler(log)
-    def detect_prefix_squatting_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> str:
+        Resolves a prefix node reference (configured prefix, configuration timestamp
+        and conf ids) to the prefix node with its rule configurations, or None if
+        they are unknown (the rule configurations are fetched before the updates
+        of a newer configuration are handled, see handle_hashed_update).
         """
-        Squatting hijack detection.
-        """
-        # check if there are origin_asns defined (even wildcards)
-        if prefix_node_conf["origin_asns"]:
-            return "-"
-        return "Q"
-
-    @exception_handler(log)
-    def detect_prefix_subprefix_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> str:
-        """
-        Subprefix or exact prefix hijack detection.
-        """
-        mon_prefix = ipaddress.ip_network(monitor_event["prefix"])
-        if ipaddress.ip_network(prefix_node["prefix"]).prefixlen < mon_prefix.prefixlen:
-            return "S"
-        return "E"
-
-    @exception_handler(log)
-    def detect_path_type_0_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        """
-        Origin hijack detection.
-        """
-        origin_asn = monitor_event["path"][-1]
-        if origin_asn in prefix_node_conf["origin_asns"] or prefix_node_conf[
-            "origin_asns"
-        ] == [-1]:
-            return -1, "-"
-        return origin_asn, "0"
-
-    @exception_handler(log)
-    def detect_path_type_1_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        """
-        Type-1 hijack detection.
-        """
-        origin_asn = monitor_event["path"][-1]
-        first_neighbor_asn = monitor_event["path"][-2]
-        # [] or [-1] neighbors means "allow everything"
-        if (
-            origin_asn in prefix_node_conf["origin_asns"]
-            or prefix_node_conf["origin_asns"] == [-1]
-        ) and (
-            (not prefix_node_conf["neighbors"])
-            or prefix_node_conf["neighbors"] == [-1]
-            or first_neighbor_asn in prefix_node_conf["neighbors"]
-        ):
-            return -1, "-"
-        return first_neighbor_asn, "1"
-
-    @exception_handler(log)
-    def detect_path_type_P_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        """
-        Type-P hijack detection.
-        In case there is a type-P hijack (i.e. no pattern matches
-        an incoming BGP update), it returns a tuple with the
-        potential hijacker AS plus the hijack type (P).
-        The potential hijacker is the first AS that differs in the
-        most specific (best matching) pattern, starting from the origin
-        AS.
-        """
-        if "orig_path" not in monitor_event:
-            return -1, "-"
-        orig_path = monitor_event["orig_path"]
-        pattern_matched = False
-        pattern_hijacker = -1
-        best_match_length = 0
-        if len(prefix_node_conf["prepend_seq"]) > 0:
-            for conf_seq in prefix_node_conf["prepend_seq"]:
-                if len(orig_path) >= len(conf_seq) + 1:
-                    # isolate the monitor event pattern that
-                    # should be matched to the configured pattern
-                    # (excluding the origin which is the very first hop
-                    # of the incoming AS-path)
-                    monitor_event_seq = orig_path[
-                        len(orig_path) - len(conf_seq) - 1 : -1
-                    ]
-                    if monitor_event_seq == conf_seq:
-                        # patterns match, break (no hijack of type P)
-                        pattern_matched = True
-                        break
-                    else:
-                        # calculate the actual differences in the current pattern;
-                        # this creates a list of elements with values 0 on matched
-                        # elements and !0 otherwise
-                        pattern_diffs = [
-                            observed_as - conf_as
-                            for observed_as, conf_as in zip(monitor_event_seq, conf_seq)
-                        ]
-                        this_best_match_length = 0
-                        # after reversing the pattern difference sequence (i.e., start with
-                        # origin), find the greatest length of consecutive 0s (i.e., non-differences/matches)
-                        for diff in pattern_diffs[::-1]:
-                            if diff == 0:
-                                # match found, continue increasing the best match length
-                                this_best_match_length += 1
-                            else:
-                                # first difference, break here and register the length
-                                break
-                        # update the best matching length for all patterns found till now
-                        best_match_length = max(
-                            best_match_length, this_best_match_length
-                        )
-        # no hijack (either pattern matching achieved or no configured pattern provided)
-        if len(prefix_node_conf["prepend_seq"]) == 0 or pattern_matched:
-            return -1, "-"
-        # the hijacker is the first AS that breaks the most specific (best matching) pattern
-        pattern_hijacker = orig_path[len(orig_path) - best_match_length - 2]
-        return pattern_hijacker, "P"
-
-    @exception_handler(log)
-    def detect_path_type_N_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        # Placeholder for type-N detection (not supported)
-        return -1, "-"
-
-    @exception_handler(log)
-    def detect_path_type_U_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        # Placeholder for type-U detection (not supported)
-        return -1, "-"
-
-    @exception_handler(log)
-    def detect_dplane_blackholing_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> str:
-        # Placeholder for blackholing detection  (not supported)
-        return "-"
-
-    @exception_handler(log)
-    def detect_dplane_imposture_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> str:
-        # Placeholder for imposture detection  (not supported)
-        return "-"
-
-    @exception_handler(log)
-    def detect_dplane_mitm_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> str:
-        # Placeholder for mitm detection  (not supported)
-        return "-"
-
-    @exception_handler(log)
-    def detect_pol_leak_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        """
-        Route leak hijack detection
-        """
-        if "no-export" in prefix_node_conf["policies"]:
-            return monitor_event["path"][-2], "L"
-        return -1, "-"
-
-    @exception_handler(log)
-    def detect_pol_other_hijack(
-        self,
-        monitor_event: Dict,
-        prefix_node: Dict,
-        prefix_node_conf: Dict,
-        *args,
-        **kwargs
-    ) -> Tuple[int, str]:
-        # Placeholder for policy violation detection (not supported)
-        return -1, "-"
+        conf_ids = prefix_node["conf_ids"]
+        unknown_conf_ids = [
+            conf_id for conf_id in conf_ids if conf_id not in self.prefix_node_confs
+        ]
+        if unknown_conf_ids:
+            log.warning(
+                "unknown conf ids {} of prefix node {} (configuration {})".format(
+                    unknown_conf_ids, prefix_node["prefix"], prefix_node["timestamp"]
+                )
+            )
+            return None
+        return {
+            "prefix": prefix_node["prefix"],
+            "data": {
+                "confs": [self.prefix_node_confs[conf_id] for conf_id in conf_ids]
+            },
+            "timestamp": prefix_node["timestamp"],
+        }
 
     def commit_hijack(
         self, monitor_event: Dict, hijacker: int, hij_dimensions: List[str]
     ) -> NoReturn:
         """
         Commit new or update an existing hijack to the database.
-        It uses redis server to store ongoing hijacks information
-        to not stress the db.
+        While a batch is evaluated, the hijack update is deferred and
+        committed together with the other updates of the same hijack.
         """
         hij_type = "|".join(hij_dimensions)
         redis_hijack_key = redis_key(monitor_event["prefix"], hijacker, hij_type)
@@ -881,14 +1276,44 @@ class DetectionDataWorker(ConsumerProducerMixin):
         if "hij_key" in monitor_event:
             monitor_event["final_redis_hijack_key"] = redis_hijack_key
 
+        hijack_update = (monitor_event, hijacker, hij_dimensions)
+        if self.hijack_batch is not None:
+            self.hijack_batch.setdefault(redis_hijack_key, []).append(hijack_update)
+        else:
+            self.commit_hijack_updates(redis_hijack_key, [hijack_update])
+
+    def commit_pending_hijack_updates(self, prefix: str) -> NoReturn:
+        """
+        Commits the hijack updates deferred by the current batch for a prefix
+        (and its direct supernet), so that their prefix-peers are indexed.
+        """
+        if not self.hijack_batch:
+            return
+        prefixes = {prefix, str(ipaddress.ip_network(prefix).supernet())}
+        pending_hijack_keys = [
+            redis_hijack_key
+            for redis_hijack_key, hijack_updates in self.hijack_batch.items()
+            if hijack_updates[0][0]["prefix"] in prefixes
+        ]
+        for redis_hijack_key in pending_hijack_keys:
+            hijack_updates = self.hijack_batch.pop(redis_hijack_key)
+            try:
+                self.commit_hijack_updates(redis_hijack_key, hijack_updates)
+            except Exception:
+                log.exception("exception")
+
+    def get_hijack_value(
+        self, monitor_event: Dict, hijacker: int, hij_dimensions: List[str]
+    ) -> Dict:
+        """
+        Returns the scalar hijack fields of a single hijack update.
+        """
         hijack_value = {
             "prefix": monitor_event["prefix"],
             "hijack_as": hijacker,
-            "type": hij_type,
+            "type": "|".join(hij_dimensions),
             "time_started": monitor_event["timestamp"],
             "time_last": monitor_event["timestamp"],
-            "peers_seen": {monitor_event["peer_asn"]},
-            "monitor_keys": {monitor_event["key"]},
             "configured_prefix": monitor_event["matched_prefix"],
             "timestamp_of_config": monitor_event["prefix_node"]["timestamp"],
             "end_tag": None,
@@ -896,36 +1321,12 @@ class DetectionDataWorker(ConsumerProducerMixin):
             "rpki_status": "NA",
         }
 
-        if (
-            RPKI_VALIDATOR_ENABLED == "true"
-            and self.rtrmanager
-            and monitor_event["path"]
-        ):
+        roa_index = self.roa_index
+        if roa_index and monitor_event["path"]:
             try:
-                asn = monitor_event["path"][-1]
-                if "/" in monitor_event["prefix"]:
-                    network, netmask = monitor_event["prefix"].split("/")
-                # /32 or /128
-                else:
-                    ip_version = get_ip_version(monitor_event["prefix"])
-                    network = monitor_event["prefix"]
-                    netmask = 32
-                    if ip_version == "v6":
-                        netmask = 128
-                redis_rpki_asn_prefix_key = "rpki_as{}_p{}".format(
-                    asn, monitor_event["prefix"]
+                hijack_value["rpki_status"] = get_rpki_status(
+                    roa_index, monitor_event["path"][-1], monitor_event["prefix"]
                 )
-                redis_rpki_status = self.redis.get(redis_rpki_asn_prefix_key)
-                if not redis_rpki_status:
-                    rpki_status = get_rpki_val_result(
-                        self.rtrmanager, asn, network, int(netmask)
-                    )
-                else:
-                    rpki_status = redis_rpki_status.decode("utf-8")
-                hijack_value["rpki_status"] = rpki_status
-                # the default refresh interval for the RPKI RTR manager is 3600 seconds
-                self.redis.set(redis_rpki_asn_prefix_key, rpki_status, ex=3600)
-
             except Exception:
                 log.exception("exception")
 
@@ -936,95 +1337,51 @@ class DetectionDataWorker(ConsumerProducerMixin):
         ):
             hijack_value["outdated_parent"] = monitor_event["hij_key"]
 
-        # identify the number of infected ases
-        hijack_value["asns_inf"] = set()
-        if hij_dimensions[1] in {"0", "1"}:
-            hijack_value["asns_inf"] = set(
-                monitor_event["path"][: -(int(hij_dimensions[1]) + 1)]
-            )
-        elif hij_dimensions[3] == "L":
-            hijack_value["asns_inf"] = set(monitor_event["path"][:-2])
-        # assume the worst-case scenario of a type-2 hijack
-        elif len(monitor_event["path"]) > 2:
-            hijack_value["asns_inf"] = set(monitor_event["path"][:-3])
-
-        # make the following operation atomic using blpop (blocking)
-        # first, make sure that the semaphore is initialized
-        if self.redis.getset("{}token_active".format(redis_hijack_key), 1) != b"1":
-            redis_pipeline = self.redis.pipeline()
-            redis_pipeline.lpush("{}token".format(redis_hijack_key), "token")
-            # lock, by extracting the token (other processes that access
-            # it at the same time will be blocked)
-            # attention: it is important that this command is batched in the
-            # pipeline since the db may async delete
-            # the token
-            redis_pipeline.blpop("{}token".format(redis_hijack_key))
-            redis_pipeline.execute()
-        else:
-            # lock, by extracting the token (other processes that access it
-            # at the same time will be blocked)
-            token = self.redis.blpop("{}token".format(redis_hijack_key), timeout=60)
-            # if timeout after 60 seconds, return without hijack alert
-            # since this means that sth has been purged in the meanwhile (e.g., due to outdated hijack
-            # in another instance; a detector cannot be stuck for a whole minute in a single hijack BGP update)
-            if not token:
-                log.info(
-                    "Monitor event {} encountered redis token timeout and will be cleared as benign for hijack {}".format(
-                        str(monitor_event), redis_hijack_key
-                    )
-                )
-                return
+        return hijack_value
 
-        # proceed now that we have clearance
-        redis_pipeline = self.redis.pipeline()
-        try:
-            result = self.redis.get(redis_hijack_key)
-            if result:
-                result = classic_json.loads(result.decode("utf-8"))
-                result["time_started"] = min(
-                    result["time_started"], hijack_value["time_started"]
-                )
-                result["time_last"] = max(
-                    result["time_last"], hijack_value["time_last"]
-                )
-                result["peers_seen"] = set(result["peers_seen"])
-                result["peers_seen"].update(hijack_value["peers_seen"])
-
-                result["asns_inf"] = set(result["asns_inf"])
-                result["asns_inf"].update(hijack_value["asns_inf"])
-
-                # no update since db already knows!
-                result["monitor_keys"] = hijack_value["monitor_keys"]
-                self.comm_annotate_hijack(monitor_event, result)
-                result["outdated_parent"] = hijack_value["outdated_parent"]
-
-                result["bgpupdate_keys"] = set(result["bgpupdate_keys"])
-                result["bgpupdate_keys"].add(monitor_event["key"])
-
-                result["rpki_status"] = hijack_value["rpki_status"]
+    def commit_hijack_updates(
+        self, redis_hijack_key: str, hijack_updates: List[Tuple]
+    ) -> NoReturn:
+        """
+        Merges the (monitor event, hijacker, dimensions) updates of a hijack
+        into redis in a single atomic step and publishes the hijack once.
+        It uses redis server to store ongoing hijacks information
+        to not stress the db.
+        """
+        hijack_value = None
+        peers_seen = set()
+        asns_inf = set()
+        monitor_keys = []
+        annotations = []
+        orig_neighbs = set()
+        for monitor_event, hijacker, hij_dimensions in hijack_updates:
+            update_value = self.get_hijack_value(
+                monitor_event, hijacker, hij_dimensions
+            )
+            if hijack_value is None:
+                hijack_value = update_value
             else:
-                hijack_value["time_detected"] = time.time()
-                hijack_value["key"] = get_hash(
-                    [
-                        monitor_event["prefix"],
-                        hijacker,
-                        hij_type,
-                        "{0:.6f}".format(hijack_value["time_detected"]),
-                    ]
+                hijack_value["time_started"] = min(
+                    hijack_value["time_started"], update_value["time_started"]
                 )
-                hijack_value["bgpupdate_keys"] = {monitor_event["key"]}
-                redis_pipeline.sadd("persistent-keys", hijack_value["key"])
-                result = hijack_value
-                self.comm_annotate_hijack(monitor_event, result)
-                self.producer.publish(
-                    result,
-                    exchange=self.hijack_notification_exchange,
-                    routing_key="mail-log",
-                    retry=False,
-                    priority=1,
-                    serializer="ujson",
+                hijack_value["time_last"] = max(
+                    hijack_value["time_last"], update_value["time_last"]
                 )
-            redis_pipeline.set(redis_hijack_key, json.dumps(result))
+                hijack_value["outdated_parent"] = update_value["outdated_parent"]
+                hijack_value["rpki_status"] = update_value["rpki_status"]
+
+            peers_seen.add(monitor_event["peer_asn"])
+            monitor_keys.append(monitor_event["key"])
+            annotations.extend(self.get_community_annotations(monitor_event))
+
+            # identify the number of infected ases
+            if hij_dimensions[1] in {"0", "1"}:
+                asns_inf.update(monitor_event["path"][: -(int(hij_dimensions[1]) + 1)])
+            elif hij_dimensions[3] == "L":
+                asns_inf.update(monitor_event["path"][:-2])
+            # assume the worst-case scenario of a type-2 hijack
+            elif len(monitor_event["path"]) > 2:
+                asns_inf.update(monitor_event["path"][:-3])
 
             # store the origin, neighbor combination for this hijack BGP update
             origin = None
@@ -1033,46 +1390,127 @@ class DetectionDataWorker(ConsumerProducerMixin):
                 origin = monitor_event["path"][-1]
             if len(monitor_event["path"]) > 1:
                 neighbor = monitor_event["path"][-2]
-            redis_pipeline.sadd(
-                "hij_orig_neighb_{}".format(redis_hijack_key),
-                "{}_{}".format(origin, neighbor),
-            )
+            orig_neighbs.add("{}_{}".format(origin, neighbor))
+
+        # used only if the hijack is new
+        hijack_value["time_detected"] = time.time()
+        hijack_value["key"] = get_hash(
+            [
+                hijack_value["prefix"],
+                hijack_value["hijack_as"],
+                hijack_value["type"],
+                "{0:.6f}".format(hijack_value["time_detected"]),
+            ]
+        )
 
-            # store the prefix and peer ASN for this hijack BGP update
-            redis_pipeline.sadd(
-                "prefix_{}_peer_{}_hijacks".format(
-                    monitor_event["prefix"], monitor_event["peer_asn"]
+        # merge the hijack in redis in a single atomic step; the merged
+        # hijack is only sent back if the cached one is missing or stale
+        peers_seen = sorted(peers_seen)
+        cached_version, cached_hijack = self.hijack_cache.get(
+            redis_hijack_key, ("", None)
+        )
+        (
+            is_new,
+            version,
+            hijack_fields,
+            peers_seen_all,
+            num_asns_inf,
+            annotation,
+        ) = self.redis_upsert_hijack(
+            keys=redis_hijack_keys(redis_hijack_key)
+            + ["hijack-version"]
+            + [
+                "prefix_{}_peer_{}_hijacks".format(hijack_value["prefix"], peer_asn)
+                for peer_asn in peers_seen
+            ],
+            args=[
+                json.dumps(encode_redis_hijack(hijack_value)),
+                json.dumps(peers_seen),
+                json.dumps(list(asns_inf)),
+                json.dumps(monitor_keys),
+                json.dumps(annotations),
+                json.dumps(list(orig_neighbs)),
+                json.dumps(
+                    [
+                        "{}_{}".format(hijack_value["prefix"], peer_asn)
+                        for peer_asn in peers_seen
+                    ]
                 ),
-                redis_hijack_key,
+                HIJACK_BGPUPDATE_KEYS_CAP,
+                cached_version,
+            ],
+        )
+        if hijack_fields is None:
+            stat = hijack_cache_stats["hits"]
+            with stat.get_lock():
+                stat.value += 1
+            hijack = cached_hijack
+            # apply the merge of the upsert script to the cached hijack
+            hijack["time_started"] = min(
+                hijack["time_started"], hijack_value["time_started"]
             )
-            redis_pipeline.sadd(
-                "hijack_{}_prefixes_peers".format(redis_hijack_key),
-                "{}_{}".format(monitor_event["prefix"], monitor_event["peer_asn"]),
+            hijack["time_last"] = max(hijack["time_last"], hijack_value["time_last"])
+            hijack["outdated_parent"] = hijack_value["outdated_parent"]
+            hijack["rpki_status"] = hijack_value["rpki_status"]
+            hijack["community_annotation"] = annotation.decode("utf-8")
+            hijack["peers_seen"].extend(
+                set(peers_seen).difference(hijack["peers_seen"])
             )
-        except Exception:
-            log.exception("exception")
-        finally:
-            # execute whatever has been accumulated in redis till now
-            redis_pipeline.execute()
-
-            # publish hijack
-            self.publish_hijack_fun(result, redis_hijack_key)
+            self.hijack_cache.move_to_end(redis_hijack_key)
+        else:
+            stat = hijack_cache_stats["misses"]
+            with stat.get_lock():
+                stat.value += 1
+            hijack = decode_redis_hijack(hijack_fields, peers_seen_all)
+        self.hijack_cache[redis_hijack_key] = (str(version), hijack)
+        if len(self.hijack_cache) > HIJACK_CACHE_SIZE:
+            self.hijack_cache.popitem(last=False)
+
+        # index the prefix-peer pairs of the hijack before the channel does
+        prefix_peer_hijacks = self.prefix_peer_hijacks
+        if prefix_peer_hijacks is not None:
+            for peer_asn in peers_seen:
+                update_prefix_peer_hijacks(
+                    prefix_peer_hijacks,
+                    "+{}_{}".format(hijack_value["prefix"], peer_asn),
+                )
 
+        result = dict(hijack, peers_seen=list(hijack["peers_seen"]))
+        # infected ASes are only counted in redis; the database merges the
+        # ASes of every hijack update
+        result["asns_inf"] = list(asns_inf)
+        result["num_asns_inf"] = num_asns_inf
+        result["monitor_keys"] = monitor_keys
+        if is_new:
             self.producer.publish(
                 result,
                 exchange=self.hijack_notification_exchange,
-                routing_key="hij-log",
+                routing_key="mail-log",
                 retry=False,
                 priority=1,
                 serializer="ujson",
             )
 
-            # unlock, by pushing back the token (at most one other process
-            # waiting will be unlocked)
-            redis_pipeline = self.redis.pipeline()
-            redis_pipeline.set("{}token_active".format(redis_hijack_key), 1)
-            redis_pipeline.lpush("{}token".format(redis_hijack_key), "token")
-            redis_pipeline.execute()
+        # publish hijack
+        self.publish_hijack_fun(result, redis_hijack_key)
+
+        self.producer.publish(
+            result,
+            exchange=self.hijack_notification_exchange,
+            routing_key="hij-log",
+            retry=False,
+            priority=1,
+            serializer="ujson",
+        )
+
+    def purge_hijack(self, redis_hijack_key: str, hij_key: str) -> Optional[Dict]:
+        """
+        Purges a hijack from redis and from the hijack cache.
+        Hijacks purged by other services are evicted lazily, since their
+        cached version no longer matches the one in redis.
+        """
+        self.hijack_cache.pop(redis_hijack_key, None)
+        return purge_redis_hijack(self.redis_purge_hijack, redis_hijack_key, hij_key)
 
     def mark_handled(self, monitor_event: Dict) -> NoReturn:
         """
@@ -1133,8 +1571,18 @@ class DetectionDataWorker(ConsumerProducerMixin):
         """
         # log.debug('{}'.format(monitor_event['key']))
         prefix = monitor_event["prefix"]
-        super_prefix = ipaddress.ip_network(prefix).supernet()
         peer_asn = monitor_event["peer_asn"]
+        # skip redis unless the local index has a candidate hijack
+        prefix_peer_hijacks = self.prefix_peer_hijacks
+        if prefix_peer_hijacks is not None:
+            prefixes = prefix_peer_hijacks.get(peer_asn)
+            if not prefixes:
+                return
+            super_prefix = ipaddress.ip_network(prefix).supernet()
+            if prefix not in prefixes and str(super_prefix) not in prefixes:
+                return
+        else:
+            super_prefix = ipaddress.ip_network(prefix).supernet()
         # if the the update's prefix matched exactly or is directly more specific than an originally hijacked prefix
         if self.redis.exists(
             "prefix_{}_peer_{}_hijacks".format(prefix, peer_asn)
@@ -1166,49 +1614,32 @@ class DetectionDataWorker(ConsumerProducerMixin):
                 serializer="ujson",
             )
 
-    def comm_annotate_hijack(self, monitor_event: Dict, hijack: Dict) -> NoReturn:
+    def get_community_annotations(self, monitor_event: Dict) -> List[Tuple]:
         """
-        Annotates a hijack based on community checks (modifies "community_annotation"
-        field in-place)
+        Returns the community annotations matched by a BGP update, in order,
+        each with the annotation precedence list of its rule (lower index wins).
+        The annotations are merged into the hijack by the redis upsert script.
         """
+        matches = []
         try:
-            if hijack.get("community_annotation", "NA") in [None, "", "NA"]:
-                hijack["community_annotation"] = "NA"
-            bgp_update_communities = set()
-            for comm_as_value in monitor_event["communities"]:
-                community = "{}:{}".format(comm_as_value[0], comm_as_value[1])
-                bgp_update_communities.add(community)
-
             if "prefix_node" in monitor_event:
-                prefix_node = monitor_event["prefix_node"]
-                for item in prefix_node["data"]["confs"]:
-                    annotations = []
-                    for annotation_element in item.get("community_annotations", []):
-                        for annotation in annotation_element:
-                            annotations.append(annotation)
-                    for annotation_element in item.get("community_annotations", []):
-                        for annotation in annotation_element:
-                            for community_rule in annotation_element[annotation]:
-                                in_communities = set(community_rule.get("in", []))
-                                out_communities = set(community_rule.get("out", []))
-                                if (
-                                    in_communities <= bgp_update_communities
-                                    and out_communities.isdisjoint(
-                                        bgp_update_communities
-                                    )
-                                ):
-                                    if hijack["community_annotation"] == "NA":
-                                        hijack["community_annotation"] = annotation
-                                    elif annotations.index(
-                                        annotation
-                                    ) < annotations.index(
-                                        hijack["community_annotation"]
-                                    ):
-                                        hijack["community_annotation"] = annotation
+                compiled_node = self.get_compiled_prefix_node(
+                    monitor_event["prefix_node"]
+                )
+                if compiled_node is None:
+                    return matches
+                _, annotate = compiled_node
+                matches = annotate(
+                    {
+                        "{}:{}".format(comm_as_value[0], comm_as_value[1])
+                        for comm_as_value in monitor_event["communities"]
+                    }
+                )
             else:
                 log.error("unconfigured BGP update received '{}'".format(monitor_event))
         except Exception:
             log.exception("exception")
+        return matches
 
     def stop_consumer_loop(self, message: Dict) -> NoReturn:
         """
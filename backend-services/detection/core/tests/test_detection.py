@@ -677,6 +677,427 @@ class BGPHandlerTester(unittest.TestCase):
         self.assertEqual(mock_commit_hijack.call_args[0][1], 100)
         self.assertEqual(mock_commit_hijack.call_args[0][2], ["S", "P", "-", "-"])
 
+    @patch("detection.DETECTION_BATCH_SIZE", 2)
+    @patch("detection.DetectionDataWorker.commit_hijack_updates")
+    def test_handle_bgp_update_batch(self, mock_commit_hijack_updates):
+        messages = []
+        for key, peer_asn in [("1", 4), ("2", 5)]:
+            message = MagicMock()
+            message.payload = {
+                "key": key,
+                "timestamp": "2021-01-01 00:00:0{}".format(key),
+                "communities": [],
+                "service": "a",
+                "type": "A",
+                "as_path": [peer_asn, 3, 2, 100],
+                "prefix": "10.0.0.0/25",
+                "peer_asn": peer_asn,
+                "prefix_node": {
+                    "prefix": "10.0.0.0/24",
+                    "data": {
+                        "confs": [
+                            {
+                                "prefixes": ["10.0.0.0/24"],
+                                "origin_asns": [1],
+                                "neighbors": [2],
+                                "prepend_seq": [],
+                                "mitigation": ["manual"],
+                                "policies": [],
+                                "community_annotations": [],
+                            }
+                        ]
+                    },
+                    "timestamp": 1,
+                },
+            }
+            messages.append(message)
+
+        self.detectionDataWorker.handle_bgp_update_message(messages[0])
+        self.assertFalse(mock_commit_hijack_updates.called)
+        self.assertFalse(messages[0].ack.called)
+
+        self.detectionDataWorker.handle_bgp_update_message(messages[1])
+        self.assertEqual(mock_commit_hijack_updates.call_count, 1)
+        redis_hijack_key, hijack_updates = mock_commit_hijack_updates.call_args[0]
+        self.assertEqual(
+            redis_hijack_key, detection.redis_key("10.0.0.0/25", 100, "S|0|-|-")
+        )
+        self.assertEqual(
+            [monitor_event["key"] for monitor_event, _, _ in hijack_updates],
+            ["1", "2"],
+        )
+        self.assertTrue(all(message.ack.called for message in messages))
+        self.assertIsNone(self.detectionDataWorker.hijack_batch)
+
+    @patch("detection.DETECTION_BATCH_SIZE", 2)
+    @patch("detection.DetectionDataWorker.gen_implicit_withdrawal")
+    @patch("detection.DetectionDataWorker.mark_handled")
+    @patch("detection.DetectionDataWorker.commit_hijack_updates")
+    def test_handle_bgp_update_batch_implicit_withdrawal(
+        self,
+        mock_commit_hijack_updates,
+        mock_mark_handled,
+        mock_gen_implicit_withdrawal,
+    ):
+        committed = []
+        mock_commit_hijack_updates.side_effect = lambda *args: committed.append(args[0])
+        committed_before_check = []
+        mock_gen_implicit_withdrawal.side_effect = lambda monitor_event: (
+            committed_before_check.append(list(committed))
+        )
+        messages = []
+        # a hijack and then a benign update from the same peer in one batch
+        for key, origin_asn in [("1", 100), ("2", 1)]:
+            message = MagicMock()
+            message.payload = {
+                "key": key,
+                "timestamp": "2021-01-01 00:00:0{}".format(key),
+                "communities": [],
+                "service": "a",
+                "type": "A",
+                "as_path": [4, 3, 2, origin_asn],
+                "prefix": "10.0.0.0/24",
+                "peer_asn": 4,
+                "prefix_node": {
+                    "prefix": "10.0.0.0/24",
+                    "data": {
+                        "confs": [
+                            {
+                                "prefixes": ["10.0.0.0/24"],
+                                "origin_asns": [1],
+                                "neighbors": [2],
+                                "prepend_seq": [],
+                                "mitigation": ["manual"],
+                                "policies": [],
+                                "community_annotations": [],
+                            }
+                        ]
+                    },
+                    "timestamp": 1,
+                },
+            }
+            messages.append(message)
+
+        for message in messages:
+            self.detectionDataWorker.handle_bgp_update_message(message)
+
+        # the hijack is committed before the implicit withdrawal check, and only once
+        self.assertEqual(
+            committed_before_check,
+            [[detection.redis_key("10.0.0.0/24", 100, "E|0|-|-")]],
+        )
+        self.assertEqual(mock_commit_hijack_updates.call_count, 1)
+        self.assertTrue(all(message.ack.called for message in messages))
+
+    @patch("detection.DetectionDataWorker.handle_ongoing_hijacks")
+    @patch("detection.DetectionDataWorker.handle_bgp_update_message")
+    def test_handle_hashed_update(
+        self, mock_handle_bgp_update_message, mock_handle_ongoing_hijacks
+    ):
+        stored_message = MagicMock()
+        stored_message.headers = {"type": "stored-update-with-prefix-node"}
+        ongoing_message = MagicMock()
+        ongoing_message.headers = {"type": "ongoing-with-prefix-node"}
+
+        self.detectionDataWorker.handle_hashed_update(stored_message)
+        self.detectionDataWorker.handle_hashed_update(ongoing_message)
+
+        mock_handle_bgp_update_message.assert_called_once_with(stored_message)
+        mock_handle_ongoing_hijacks.assert_called_once_with(ongoing_message)
+
+    def test_commit_hijack_updates_cache_hit(self):
+        monitor_event = {
+            "key": "2",
+            "timestamp": 5,
+            "communities": [],
+            "path": [5, 3, 2, 100],
+            "prefix": "10.0.0.0/25",
+            "peer_asn": 5,
+            "matched_prefix": "10.0.0.0/24",
+            "prefix_node": {
+                "prefix": "10.0.0.0/24",
+                "data": {"confs": []},
+                "timestamp": 1,
+            },
+        }
+        redis_hijack_key = detection.redis_key("10.0.0.0/25", 100, "S|0|-|-")
+        cached_hijack = {
+            "prefix": "10.0.0.0/25",
+            "hijack_as": 100,
+            "type": "S|0|-|-",
+            "time_started": 1.0,
+            "time_last": 1.0,
+            "community_annotation": "NA",
+            "outdated_parent": None,
+            "rpki_status": "NA",
+            "peers_seen": [4],
+        }
+        self.detectionDataWorker.hijack_cache[redis_hijack_key] = ("7", cached_hijack)
+        self.detectionDataWorker.redis_upsert_hijack = MagicMock(
+            return_value=[0, 8, None, None, 2, b"NA"]
+        )
+        self.detectionDataWorker.publish_hijack_fun = MagicMock()
+
+        self.detectionDataWorker.commit_hijack_updates(
+            redis_hijack_key, [(monitor_event, 100, ["S", "0", "-", "-"])]
+        )
+
+        args = self.detectionDataWorker.redis_upsert_hijack.call_args[1]["args"]
+        self.assertEqual(args[-1], "7")
+        result = self.detectionDataWorker.publish_hijack_fun.call_args[0][0]
+        self.assertEqual(result["time_started"], 1.0)
+        self.assertEqual(result["time_last"], 5)
+        self.assertEqual(sorted(result["peers_seen"]), [4, 5])
+        self.assertEqual(result["num_asns_inf"], 2)
+        self.assertEqual(result["monitor_keys"], ["2"])
+        self.assertEqual(
+            self.detectionDataWorker.hijack_cache[redis_hijack_key][0], "8"
+        )
+
+    def test_get_rpki_status(self):
+        roas = detection.parse_roas(
+            "ASN,IP Prefix,Max Length,Trust Anchor\n"
+            "AS1,10.0.0.0/16,24,ripe\n"
+            "AS2,10.0.0.0/8,8,ripe\n"
+            "AS3,2001:db8::/32,48,ripe\n"
+        )
+        self.assertEqual(
+            roas,
+            detection.parse_roas(
+                '{"roas": [{"asn": "AS1", "prefix": "10.0.0.0/16", "maxLength": 24, "ta": "ripe"},'
+                '{"asn": "AS2", "prefix": "10.0.0.0/8", "maxLength": 8, "ta": "ripe"},'
+                '{"asn": "AS3", "prefix": "2001:db8::/32", "maxLength": 48, "ta": "ripe"}]}'
+            ),
+        )
+        roa_index = detection.build_roa_index(roas)
+
+        self.assertEqual(detection.get_rpki_status(roa_index, 1, "10.0.1.0/24"), "VD")
+        self.assertEqual(detection.get_rpki_status(roa_index, 2, "10.0.0.0/8"), "VD")
+        self.assertEqual(detection.get_rpki_status(roa_index, 1, "10.0.1.0/25"), "IL")
+        self.assertEqual(detection.get_rpki_status(roa_index, 4, "10.0.1.0/24"), "IA")
+        self.assertEqual(detection.get_rpki_status(roa_index, 1, "11.0.0.0/24"), "NF")
+        self.assertEqual(
+            detection.get_rpki_status(roa_index, 3, "2001:db8:1::/48"), "VD"
+        )
+        self.assertEqual(detection.get_rpki_status(roa_index, 3, "2001:db8::1"), "IL")
+
+    @patch("detection.DetectionDataWorker.producer")
+    def test_gen_implicit_withdrawal_prefix_peer_index(self, mock_producer):
+        message = {
+            "key": "2",
+            "timestamp": 2,
+            "communities": [],
+            "service": "a",
+            "type": "A",
+            "path": [4, 3, 2, 1],
+            "prefix": "6.0.0.0/25",
+            "peer_asn": 4,
+        }
+        self.detectionDataWorker.redis.exists = MagicMock(return_value=True)
+        self.detectionDataWorker.prefix_peer_hijacks = {}
+        detection.update_prefix_peer_hijacks(
+            self.detectionDataWorker.prefix_peer_hijacks, "+6.0.0.0/24_5"
+        )
+
+        # no hijack for this peer; redis is not queried
+        self.detectionDataWorker.gen_implicit_withdrawal(message)
+        self.assertFalse(self.detectionDataWorker.redis.exists.called)
+        self.assertFalse(mock_producer.publish.called)
+
+        detection.update_prefix_peer_hijacks(
+            self.detectionDataWorker.prefix_peer_hijacks, "+6.0.0.0/24_4"
+        )
+        self.detectionDataWorker.gen_implicit_withdrawal(message)
+        self.assertTrue(self.detectionDataWorker.redis.exists.called)
+        self.assertTrue(mock_producer.publish.called)
+
+        detection.update_prefix_peer_hijacks(
+            self.detectionDataWorker.prefix_peer_hijacks, "-6.0.0.0/24_4"
+        )
+        self.detectionDataWorker.redis.exists.reset_mock()
+        self.detectionDataWorker.gen_implicit_withdrawal(message)
+        self.assertFalse(self.detectionDataWorker.redis.exists.called)
+
+    def test_compile_community_annotations(self):
+        prefix_node = {
+            "prefix": "10.0.0.0/24",
+            "data": {
+                "confs": [
+                    {
+                        "community_annotations": [
+                            {"critical": [{"in": ["1:1", "1:2"]}, {"in": ["1:3"]}]},
+                            {"low": [{"out": ["1:4"]}]},
+                        ]
+                    }
+                ]
+            },
+            "timestamp": 1,
+        }
+        annotate = detection.compile_community_annotations(prefix_node)
+        precedence = ["critical", "low"]
+
+        self.assertEqual(annotate({"1:4"}), [])
+        self.assertEqual(annotate(set()), [("low", precedence)])
+        self.assertEqual(annotate({"1:1", "1:4"}), [])
+        self.assertEqual(
+            annotate({"1:1", "1:2"}), [("critical", precedence), ("low", precedence)]
+        )
+        self.assertEqual(annotate({"1:3", "1:4"}), [("critical", precedence)])
+
+    @patch("detection.DetectionDataWorker.commit_hijack")
+    @patch("detection.requests.get")
+    def test_handle_bgp_update_prefix_node_reference(
+        self, mock_get, mock_commit_hijack
+    ):
+        conf = {
+            "origin_asns": [1],
+            "neighbors": [2],
+            "prepend_seq": [],
+            "mitigation": "manual",
+            "policies": [],
+            "community_annotations": [],
+        }
+        mock_get.return_value.json.return_value = {
+            "timestamp": 1,
+            "confs": {"c1": conf},
+        }
+        self.detectionDataWorker.fetch_prefix_node_confs()
+        message = {
+            "key": "1",
+            "timestamp": 1,
+            "orig_path": [],
+            "communities": [],
+            "service": "a",
+            "type": "A",
+            "path": [4, 3, 2, 100],
+            "prefix": "10.0.0.0/25",
+            "peer_asn": 4,
+            "prefix_node": {
+                "prefix": "10.0.0.0/24",
+                "conf_ids": ["c1"],
+                "timestamp": 1,
+            },
+        }
+        self.detectionDataWorker.handle_bgp_update(dict(message))
+
+        self.assertEqual(mock_commit_hijack.call_args[0][1], 100)
+        self.assertEqual(mock_commit_hijack.call_args[0][2], ["S", "0", "-", "-"])
+
+        # the confs of the previous configuration are still resolved
+        mock_get.return_value.json.return_value = {
+            "timestamp": 2,
+            "confs": {"c2": dict(conf, origin_asns=[100])},
+        }
+        self.detectionDataWorker.fetch_prefix_node_confs()
+        message["prefix_node"] = {
+            "prefix": "10.0.0.0/24",
+            "conf_ids": ["c2"],
+            "timestamp": 2,
+        }
+        mock_commit_hijack.reset_mock()
+        self.detectionDataWorker.handle_bgp_update(dict(message))
+        self.assertEqual(mock_commit_hijack.call_args[0][2], ["S", "-", "-", "-"])
+        self.assertEqual(
+            self.detectionDataWorker.resolve_prefix_node(
+                {"prefix": "10.0.0.0/24", "conf_ids": ["c1"], "timestamp": 1}
+            )["data"]["confs"],
+            [conf],
+        )
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("detection.DetectionDataWorker.commit_hijack")
+    @patch("detection.requests.get")
+    def test_handle_bgp_update_unknown_conf_ids(self, mock_get, mock_commit_hijack):
+        message = {
+            "key": "1",
+            "timestamp": 1,
+            "orig_path": [],
+            "communities": [],
+            "service": "a",
+            "type": "A",
+            "path": [4, 3, 2, 100],
+            "prefix": "10.0.0.0/25",
+            "peer_asn": 4,
+            "prefix_node": {
+                "prefix": "10.0.0.0/24",
+                "conf_ids": ["c1"],
+                "timestamp": 2,
+            },
+        }
+        # the update is dropped, without fetching the confs on the hot path
+        with patch.object(detection.log, "warning") as mock_warning:
+            self.detectionDataWorker.handle_bgp_update(dict(message))
+        mock_warning.assert_called_once()
+        mock_get.assert_not_called()
+        mock_commit_hijack.assert_not_called()
+
+    @patch("detection.DetectionDataWorker.dispatch_hashed_update")
+    @patch("detection.requests.get")
+    def test_handle_hashed_update_pending_confs(
+        self, mock_get, mock_dispatch_hashed_update
+    ):
+        worker = self.detectionDataWorker
+        newer_message = MagicMock(
+            payload=[
+                {
+                    "prefix": "10.0.0.0/24",
+                    "prefix_node": {
+                        "prefix": "10.0.0.0/24",
+                        "conf_ids": ["c1"],
+                        "timestamp": 1,
+                    },
+                }
+            ],
+            headers={},
+        )
+        next_message = MagicMock(payload={"prefix": "10.0.0.0/24"}, headers={})
+        # the messages wait (unacked and in order) for the confs to be fetched
+        worker.handle_hashed_update(newer_message)
+        worker.handle_hashed_update(next_message)
+        self.assertTrue(worker.prefix_node_confs_requested.is_set())
+        mock_get.side_effect = Exception("prefixtree is down")
+        with self.assertRaises(Exception):
+            worker.fetch_prefix_node_confs()
+        worker.on_iteration()
+        mock_dispatch_hashed_update.assert_not_called()
+        self.assertEqual(worker.pending_hashed_updates, [newer_message, next_message])
+
+        mock_get.side_effect = None
+        mock_get.return_value.json.return_value = {"timestamp": 1, "confs": {}}
+        worker.fetch_prefix_node_confs()
+        worker.on_iteration()
+        self.assertEqual(
+            [call[0][0] for call in mock_dispatch_hashed_update.call_args_list],
+            [newer_message, next_message],
+        )
+        self.assertEqual(worker.pending_hashed_updates, [])
+        newer_message.ack.assert_not_called()
+        next_message.ack.assert_not_called()
+
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("detection.compile_prefix_node")
+    def test_get_compiled_prefix_node_range_nodes(self, mock_compile_prefix_node):
+        self.detectionDataWorker.prefix_node_confs = {
+            "c1": {"community_annotations": []},
+            "c2": {"community_annotations": []},
+        }
+        # range nodes of the same configured prefix length and rules share
+        # their compiled matchers
+        for prefix in ["10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24"]:
+            self.detectionDataWorker.get_compiled_prefix_node(
+                {"prefix": prefix, "conf_ids": ["c1"], "timestamp": 1}
+            )
+        self.assertEqual(mock_compile_prefix_node.call_count, 1)
+        self.detectionDataWorker.get_compiled_prefix_node(
+            {"prefix": "10.0.0.0/25", "conf_ids": ["c1"], "timestamp": 1}
+        )
+        self.detectionDataWorker.get_compiled_prefix_node(
+            {"prefix": "10.0.0.0/24", "conf_ids": ["c2"], "timestamp": 1}
+        )
+        self.assertEqual(mock_compile_prefix_node.call_count, 3)
+        self.assertEqual(len(self.detectionDataWorker.compiled_prefix_nodes), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
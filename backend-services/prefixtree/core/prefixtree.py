@@ -1,4 +1,13 @@
+import hashlib
 import multiprocessing as mp
+import os
+import pickle
+import re
+import socket
+import time
+from collections import OrderedDict
+from ipaddress import collapse_addresses
+from ipaddress import ip_network
 from typing import Dict
 from typing import List
 from typing import NoReturn
@@ -7,10 +16,10 @@ import pytricia
 import redis
 import requests
 import ujson as json
+from artemis_utils import ArtemisError
 from artemis_utils import flatten
 from artemis_utils import get_ip_version
 from artemis_utils import get_logger
-from artemis_utils import search_worst_prefix
 from artemis_utils.constants import CONFIGURATION_HOST
 from artemis_utils.envvars import RABBITMQ_URI
 from artemis_utils.envvars import REDIS_HOST
@@ -20,7 +29,6 @@ from artemis_utils.rabbitmq import create_exchange
 from artemis_utils.rabbitmq import create_queue
 from artemis_utils.redis import ping_redis
 from artemis_utils.translations import translate_asn_range
-from artemis_utils.translations import translate_rfc2622
 from kombu import Connection
 from kombu import Consumer
 from kombu import Producer
@@ -43,6 +51,7 @@ serialization.register(
 shared_memory_locks = {
     "data_worker": mp.Lock(),
     "prefix_tree": mp.Lock(),
+    "prefix_tree_confs": mp.Lock(),
     "autoignore": mp.Lock(),
     "monitored_prefixes": mp.Lock(),
     "configured_prefix_count": mp.Lock(),
@@ -50,22 +59,591 @@ shared_memory_locks = {
     "service_reconfiguring": mp.Lock(),
 }
 
+# versions of the tree snapshots published in shared memory; they are increased (while
+# holding the respective lock) when a new snapshot is published, and are read without
+# locking by the data worker to find out if it needs to swap in the new snapshot
+shared_memory_versions = {
+    "prefix_tree": mp.RawValue("L", 0),
+    "autoignore": mp.RawValue("L", 0),
+}
+
+# unconfigured prefix cache counters, shared by the data workers and the REST handlers
+# (incremented under their lock, since += is not atomic across the worker processes)
+unconfigured_prefix_cache_stats = {"hits": mp.Value("L", 0), "misses": mp.Value("L", 0)}
+
 # global vars
 SERVICE_NAME = "prefixtree"
+# number of prefixes known to match no configured prefix that are cached by the
+# data worker (for the current prefix tree version)
+UNCONFIGURED_PREFIX_CACHE_SIZE = int(
+    os.getenv("UNCONFIGURED_PREFIX_CACHE_SIZE", 100000)
+)
+# percentage of the address space of a monitored prefix that may be covered by no
+# configured prefix, when aggregating the configured prefixes into monitored prefixes
+MONITORED_PREFIXES_OVERAPPROXIMATION = float(
+    os.getenv("MONITORED_PREFIXES_OVERAPPROXIMATION", 0)
+)
+# number of data worker processes, forked from a parent process that holds the prefix
+# trees so that they share them (copy-on-write)
+PREFIXTREE_WORKERS = int(os.getenv("PREFIXTREE_WORKERS", 1))
+# file of the compiled prefix tree snapshot of the latest configuration, so that it is
+# loaded instead of re-compiled upon restart (empty to disable)
+PREFIXTREE_SNAPSHOT_FILE = os.getenv(
+    "PREFIXTREE_SNAPSHOT_FILE", "/var/lib/artemis/prefixtree/prefixtree-snapshot.pickle"
+)
+# format version of the snapshot file, to be increased when its content changes
+PREFIXTREE_SNAPSHOT_FORMAT = 1
+# RFC2622 range operators: ^-, ^+, ^n and ^n-m
+PREFIX_RANGE_REGEX = re.compile(r"^(\S*)\^(?:(-)|(\+)|(\d+)(?:-(\d+))?)$")
+# max number of prefix tree deltas kept in shared memory, so that the data worker
+# can catch up with the latest prefix tree by applying them instead of reloading it
+PREFIX_TREE_DELTAS = 16
 
 
-def pytricia_to_dict(pyt_tree):
-    pyt_dict = {}
-    for prefix in pyt_tree:
-        pyt_dict[prefix] = pyt_tree[prefix]
-    return pyt_dict
+def translate_prefix_range(prefix):
+    """
+    Translates an (RFC2622) prefix to its base prefix and the range of lengths
+    of the more specifics of the base prefix that it stands for,
+    e.g., 10.0.0.0/8^- -> (10.0.0.0/8, 9, 32).
+    Unlike translate_rfc2622, the more specifics themselves are not calculated.
+    """
+    match = PREFIX_RANGE_REGEX.match(prefix)
+    if match:
+        try:
+            network = ip_network(match.group(1))
+        except ValueError:
+            network = None
+        if network:
+            if match.group(2):
+                return str(network), network.prefixlen + 1, network.max_prefixlen
+            if match.group(3):
+                return str(network), network.prefixlen, network.max_prefixlen
+            min_length = int(match.group(4))
+            max_length = int(match.group(5) or min_length)
+            if min_length < network.prefixlen:
+                raise ArtemisError("invalid-n-small", prefix)
+            if max_length > network.max_prefixlen:
+                raise ArtemisError("invalid-n-large", prefix)
+            return str(network), min_length, max_length
+    network = ip_network(prefix, strict=False)
+    return prefix, network.prefixlen, network.prefixlen
+
+
+def add_prefix_range(dict_tree, prefix, rule):
+    """
+    Adds an (RFC2622) prefix of a rule to a (picklable) dict tree of
+    base prefix -> {"prefix": <str>, "prefix_len": <int>, "ranges": [[rule, min_len, max_len], ...]}.
+    """
+    base_prefix, min_length, max_length = translate_prefix_range(prefix)
+    network = ip_network(base_prefix, strict=False)
+    ip_version = "v{}".format(network.version)
+    node = dict_tree[ip_version].setdefault(
+        str(network),
+        {"prefix": base_prefix, "prefix_len": network.prefixlen, "ranges": []},
+    )
+    node["ranges"].append([rule, min_length, max_length])
 
 
-def dict_to_pytricia(dict_tree, size=32):
-    pyt_tree = pytricia.PyTricia(size)
-    for prefix in dict_tree:
-        pyt_tree.insert(prefix, dict_tree[prefix])
-    return pyt_tree
+def truncate_prefix(prefix, prefix_len):
+    """
+    Returns the (less specific) prefix of the given length that contains a prefix.
+    """
+    address = prefix.split("/")[0]
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    packed_address = socket.inet_pton(family, address)
+    host_bits = len(packed_address) * 8 - prefix_len
+    network_address = int.from_bytes(packed_address, "big") >> host_bits << host_bits
+    return "{}/{}".format(
+        socket.inet_ntop(family, network_address.to_bytes(len(packed_address), "big")),
+        prefix_len,
+    )
+
+
+def find_prefix_range_rules(pyt_tree, prefix):
+    """
+    Finds the configured prefix that matches a prefix, i.e., the most specific one
+    among the configured prefixes and the more specifics of the configured prefix
+    ranges, and the (sorted) rules that configure it.
+    Returns (None, []) if no configured prefix matches.
+    """
+    base_prefix = pyt_tree.get_key(prefix)
+    if base_prefix is None:
+        return None, []
+    base_node = pyt_tree[base_prefix]
+    # no prefix ranges contain the prefix: it matches its most specific base prefix
+    if base_node["exact_rules"] is not None:
+        return base_node["prefix"], base_node["exact_rules"]
+    prefix_len = int(prefix.split("/")[1])
+    base_nodes = []
+    matched_len = -1
+    while base_prefix is not None:
+        base_node = pyt_tree[base_prefix]
+        for _, min_length, max_length in base_node["ranges"]:
+            if min_length <= prefix_len:
+                matched_len = max(matched_len, min(prefix_len, max_length))
+        base_nodes.append(base_node)
+        base_prefix = pyt_tree.parent(base_prefix)
+    if matched_len < 0:
+        return None, []
+    matched_prefix = None
+    rules = []
+    for base_node in base_nodes:
+        if base_node["prefix_len"] == matched_len:
+            matched_prefix = base_node["prefix"]
+        for rule, min_length, max_length in base_node["ranges"]:
+            if min_length <= matched_len <= max_length:
+                rules.append(rule)
+    if matched_prefix is None:
+        matched_prefix = truncate_prefix(prefix, matched_len)
+    return matched_prefix, sorted(rules)
+
+
+def count_prefix_ranges(pyt_tree):
+    """
+    Counts the configured prefixes of a tree, including all the more specifics
+    of its prefix ranges.
+    """
+    count = 0
+    for base_prefix in pyt_tree:
+        base_node = pyt_tree[base_prefix]
+        lengths = set()
+        for _, min_length, max_length in base_node["ranges"]:
+            lengths.update(range(min_length, max_length + 1))
+        # the more specifics of a length are counted once, at their least specific base
+        parent_prefix = pyt_tree.parent(base_prefix)
+        while parent_prefix is not None and lengths:
+            for _, min_length, max_length in pyt_tree[parent_prefix]["ranges"]:
+                lengths.difference_update(range(min_length, max_length + 1))
+            parent_prefix = pyt_tree.parent(parent_prefix)
+        for length in lengths:
+            count += 2 ** (length - base_node["prefix_len"])
+    return count
+
+
+def aggregate_prefixes(prefixes, overapproximation=0):
+    """
+    Returns the minimal set of supernets covering the given prefixes (of the same IP
+    version). Adjacent prefixes are merged into their common supernet, as well as
+    prefixes whose common supernet is covered by them up to the given percentage of
+    its address space that may be over-approximated.
+    """
+    networks = list(collapse_addresses(ip_network(prefix) for prefix in prefixes))
+    if overapproximation <= 0 or len(networks) < 2:
+        return sorted(str(network) for network in networks)
+    # (network address, prefix length) integer pairs, to group them cheaply
+    network_class = type(networks[0])
+    max_len = networks[0].max_prefixlen
+    networks = [
+        (int(network.network_address), network.prefixlen) for network in networks
+    ]
+    # bottom-up, so that every supernet is considered after its subnets
+    for supernet_len in range(max(length for _, length in networks) - 1, -1, -1):
+        if len(networks) < 2:
+            break
+        host_bits = max_len - supernet_len
+        supernets = {}
+        for address, length in networks:
+            if length > supernet_len:
+                supernets.setdefault(address >> host_bits, []).append(length)
+        merged = set()
+        for supernet, lengths in supernets.items():
+            if len(lengths) < 2:
+                continue
+            uncovered = 2 ** host_bits - sum(
+                2 ** (max_len - length) for length in lengths
+            )
+            if 100 * uncovered <= overapproximation * 2 ** host_bits:
+                merged.add(supernet)
+        if merged:
+            networks = [
+                (address, length)
+                for address, length in networks
+                if length <= supernet_len or address >> host_bits not in merged
+            ]
+            networks.extend(
+                (supernet << host_bits, supernet_len) for supernet in merged
+            )
+    networks = [network_class(network) for network in networks]
+    return sorted(str(network) for network in networks)
+
+
+def set_exact_rules(pyt_tree, prefix):
+    """
+    Sets the rules of a base prefix that is not contained by any prefix range (of it
+    or of its less specifics), so that it is looked up directly, otherwise None.
+    """
+    base_node = pyt_tree[prefix]
+    base_node["exact_rules"] = sorted(rule for rule, _, _ in base_node["ranges"])
+    parent_prefix = prefix
+    while parent_prefix is not None:
+        parent_node = pyt_tree[parent_prefix]
+        if any(
+            min_length != parent_node["prefix_len"]
+            or max_length != parent_node["prefix_len"]
+            for _, min_length, max_length in parent_node["ranges"]
+        ):
+            base_node["exact_rules"] = None
+            return
+        parent_prefix = pyt_tree.parent(parent_prefix)
+
+
+def dict_to_prefix_tree(dict_tree):
+    """
+    Turns a (picklable) prefix tree snapshot of the configuration into pytricia trees.
+    """
+    prefix_tree = dict(dict_tree)
+    for ip_version, size in [("v4", 32), ("v6", 128)]:
+        pyt_tree = pytricia.PyTricia(size)
+        for prefix in dict_tree[ip_version]:
+            pyt_tree.insert(prefix, dict(dict_tree[ip_version][prefix]))
+        for prefix in pyt_tree:
+            set_exact_rules(pyt_tree, prefix)
+        prefix_tree[ip_version] = pyt_tree
+    return prefix_tree
+
+
+def compute_prefix_tree_delta(old_dict_tree, new_dict_tree):
+    """
+    Computes the changes between two prefix tree snapshots: the inserted, updated
+    or deleted (None) base prefixes, the changed items of the lists (of confs or
+    rule keys) and the rest of the changed values.
+    """
+    delta = {"lists": {}, "values": {}}
+    for key in new_dict_tree:
+        new_value = new_dict_tree[key]
+        old_value = old_dict_tree.get(key)
+        if key in ["v4", "v6"]:
+            old_value = old_value or {}
+            delta[key] = {
+                prefix: new_value[prefix]
+                for prefix in new_value
+                if old_value.get(prefix) != new_value[prefix]
+            }
+            for prefix in old_value:
+                if prefix not in new_value:
+                    delta[key][prefix] = None
+        elif isinstance(new_value, list):
+            old_value = old_value or []
+            delta["lists"][key] = (
+                len(new_value),
+                {
+                    index: item
+                    for index, item in enumerate(new_value)
+                    if index >= len(old_value) or old_value[index] != item
+                },
+            )
+        elif new_value != old_value:
+            delta["values"][key] = new_value
+    return delta
+
+
+def apply_prefix_tree_delta(prefix_tree, delta):
+    """
+    Applies the changes of a delta to a prefix tree, in O(changed base prefixes
+    and their more specifics).
+    """
+    prefix_tree.update(delta["values"])
+    for key, (length, changes) in delta["lists"].items():
+        items = prefix_tree[key]
+        del items[length:]
+        items.extend([None] * (length - len(items)))
+        for index, item in changes.items():
+            items[index] = item
+    for ip_version in ["v4", "v6"]:
+        pyt_tree = prefix_tree[ip_version]
+        # the more specifics of changed base prefixes may (no longer) be contained
+        # by their prefix ranges
+        changed_prefixes = set()
+        for prefix, base_node in delta[ip_version].items():
+            if pyt_tree.has_key(prefix):
+                changed_prefixes.update(pyt_tree.children(prefix))
+                pyt_tree.delete(prefix)
+            if base_node is not None:
+                pyt_tree.insert(prefix, dict(base_node))
+                changed_prefixes.add(prefix)
+                changed_prefixes.update(pyt_tree.children(prefix))
+        for prefix in changed_prefixes:
+            if pyt_tree.has_key(prefix):
+                set_exact_rules(pyt_tree, prefix)
+
+
+def publish_prefix_tree(shared_memory_manager_dict, name, key, dict_tree):
+    """
+    Publishes a new prefix tree snapshot to the shared memory, along with its
+    delta from the previous snapshot.
+    """
+    shared_memory_locks[name].acquire()
+    try:
+        delta = compute_prefix_tree_delta(
+            shared_memory_manager_dict.get(key, {}), dict_tree
+        )
+        delta_changes = len(delta["v4"]) + len(delta["v6"])
+        version = shared_memory_versions[name].value + 1
+        deltas = shared_memory_manager_dict.get("{}_deltas".format(key), [])
+        # if most of the tree has changed, reloading it is cheaper than applying the delta
+        if delta_changes > (len(dict_tree["v4"]) + len(dict_tree["v6"])) / 2:
+            deltas = []
+        else:
+            deltas = (deltas + [(version, delta)])[-PREFIX_TREE_DELTAS:]
+        shared_memory_manager_dict[key] = dict_tree
+        shared_memory_manager_dict["{}_deltas".format(key)] = deltas
+        shared_memory_versions[name].value = version
+    finally:
+        shared_memory_locks[name].release()
+
+
+def fetch_prefix_tree_update(shared_memory_manager_dict, name, key, from_version):
+    """
+    Fetches the update of a prefix tree from a version to the latest one:
+    (latest version, deltas since that version, None), or
+    (latest version, None, latest snapshot) if these deltas are not available.
+    """
+    shared_memory_locks[name].acquire()
+    try:
+        version = shared_memory_versions[name].value
+        deltas = [
+            delta
+            for delta_version, delta in shared_memory_manager_dict.get(
+                "{}_deltas".format(key), []
+            )
+            if delta_version > from_version
+        ]
+        if from_version < 0 or len(deltas) != version - from_version:
+            return version, None, shared_memory_manager_dict[key]
+        return version, deltas, None
+    finally:
+        shared_memory_locks[name].release()
+
+
+def lookup_prefix_node(prefix_tree, prefix):
+    """
+    Returns the prefix node (configured prefix and rule configurations)
+    that matches a prefix, or None.
+    """
+    matched_prefix, rules = find_prefix_range_rules(
+        prefix_tree[get_ip_version(prefix)], prefix
+    )
+    if matched_prefix is None:
+        return None
+    return {
+        "prefix": matched_prefix,
+        "data": {"confs": [prefix_tree["confs"][rule] for rule in rules]},
+        "timestamp": prefix_tree["timestamp"],
+    }
+
+
+def lookup_prefix_node_reference(prefix_tree, prefix):
+    """
+    Returns a reference to the prefix node that matches a prefix, or None:
+    the configured prefix, the timestamp of the configuration and the ids of the
+    rule configurations, which are resolved by the consumers of the annotated updates.
+    """
+    matched_prefix, rules = find_prefix_range_rules(
+        prefix_tree[get_ip_version(prefix)], prefix
+    )
+    if matched_prefix is None:
+        return None
+    return {
+        "prefix": matched_prefix,
+        "conf_ids": [prefix_tree["conf_ids"][rule] for rule in rules],
+        "timestamp": prefix_tree["timestamp"],
+    }
+
+
+def lookup_autoignore_prefix_node(autoignore_prefix_tree, prefix):
+    """
+    Returns the autoignore prefix node (configured prefix and autoignore rule key)
+    that matches a prefix, or None.
+    """
+    matched_prefix, rules = find_prefix_range_rules(
+        autoignore_prefix_tree[get_ip_version(prefix)], prefix
+    )
+    if matched_prefix is None:
+        return None
+    # the first configured rule takes precedence
+    return {
+        "prefix": matched_prefix,
+        "rule_key": autoignore_prefix_tree["rule_keys"][rules[0]],
+    }
+
+
+def load_prefix_tree_update(
+    shared_memory_manager_dict, name, key, prefix_tree, from_version
+):
+    """
+    Brings a local (pytricia) prefix tree up to date with the latest snapshot, by
+    applying the deltas since its version or by parsing the snapshot anew; returns
+    the up-to-date tree (the same object, if the deltas were applied) and its version.
+    """
+    version, deltas, dict_tree = fetch_prefix_tree_update(
+        shared_memory_manager_dict, name, key, from_version
+    )
+    if deltas is None:
+        # need to turn to pytricia tree since the snapshot is a (picklable) dict
+        return dict_to_prefix_tree(dict_tree), version
+    for delta in deltas:
+        apply_prefix_tree_delta(prefix_tree, delta)
+    return prefix_tree, version
+
+
+def get_config_hash(config):
+    """
+    Returns the hash of the contents of a configuration, along with the settings
+    that affect its compilation; the parse timestamp, raw configuration and
+    comment of the configuration do not affect its compilation.
+    """
+    return hashlib.md5(
+        json.dumps(
+            {
+                "config": {
+                    key: value
+                    for key, value in config.items()
+                    if key not in ["timestamp", "raw_config", "comment"]
+                },
+                "monitored_prefixes_overapproximation": MONITORED_PREFIXES_OVERAPPROXIMATION,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+def compile_prefixtree(config):
+    """
+    Compiles a configuration to the (picklable) prefix tree snapshot of prefixtree:
+    {
+        "prefix_tree": <dict>,
+        "monitored_prefixes": <list>,
+        "configured_prefix_count": <int>,
+        "autoignore_rules": <dict>,
+        "autoignore_prefix_tree": <dict>
+    }
+    """
+    # calculate prefix tree; prefix ranges are kept as such (base prefix
+    # and lengths) instead of calculating all their more specifics
+    dict_prefix_tree = {
+        "v4": {},
+        "v6": {},
+        "confs": [],
+        "conf_ids": [],
+        "timestamp": config["timestamp"],
+    }
+    rules = config.get("rules", [])
+    for rule in rules:
+        rule_translated_origin_asn_set = set()
+        for asn in rule["origin_asns"]:
+            this_translated_asn_list = flatten(translate_asn_range(asn))
+            rule_translated_origin_asn_set.update(set(this_translated_asn_list))
+        rule["origin_asns"] = list(rule_translated_origin_asn_set)
+        rule_translated_neighbor_set = set()
+        for asn in rule["neighbors"]:
+            this_translated_asn_list = flatten(translate_asn_range(asn))
+            rule_translated_neighbor_set.update(set(this_translated_asn_list))
+        rule["neighbors"] = list(rule_translated_neighbor_set)
+
+        conf_obj = {
+            "origin_asns": rule["origin_asns"],
+            "neighbors": rule["neighbors"],
+            "prepend_seq": rule.get("prepend_seq", []),
+            "policies": list(set(rule.get("policies", []))),
+            "community_annotations": rule.get("community_annotations", []),
+            "mitigation": rule.get("mitigation", "manual"),
+        }
+        for prefix in rule["prefixes"]:
+            add_prefix_range(dict_prefix_tree, prefix, len(dict_prefix_tree["confs"]))
+        dict_prefix_tree["confs"].append(conf_obj)
+        # content-based, so that unchanged rules keep their ids across configurations
+        dict_prefix_tree["conf_ids"].append(
+            hashlib.md5(json.dumps(conf_obj, sort_keys=True).encode()).hexdigest()
+        )
+    prefix_tree = dict_to_prefix_tree(dict_prefix_tree)
+
+    # calculate the monitored and configured prefixes
+    configured_prefix_count = 0
+    monitored_prefixes = []
+    for ip_version in ["v4", "v6"]:
+        configured_prefix_count += count_prefix_ranges(prefix_tree[ip_version])
+        # one pass over the base prefixes, which cover their prefix ranges
+        monitored_prefixes.extend(
+            aggregate_prefixes(
+                prefix_tree[ip_version], MONITORED_PREFIXES_OVERAPPROXIMATION
+            )
+        )
+
+    # (IPv6) prefix ranges may exceed the BIGINT configured prefixes stat
+    configured_prefix_count = min(configured_prefix_count, 2 ** 63 - 1)
+
+    # extract autoignore rules
+    autoignore_rules = config.get("autoignore", {})
+
+    # calculate autoignore prefix tree
+    dict_autoignore_prefix_tree = {"v4": {}, "v6": {}, "rule_keys": []}
+    for key in autoignore_rules:
+        rule = autoignore_rules[key]
+        for prefix in rule["prefixes"]:
+            add_prefix_range(
+                dict_autoignore_prefix_tree,
+                prefix,
+                len(dict_autoignore_prefix_tree["rule_keys"]),
+            )
+        dict_autoignore_prefix_tree["rule_keys"].append(key)
+
+    return {
+        "prefix_tree": dict_prefix_tree,
+        "monitored_prefixes": monitored_prefixes,
+        "configured_prefix_count": configured_prefix_count,
+        "autoignore_rules": autoignore_rules,
+        "autoignore_prefix_tree": dict_autoignore_prefix_tree,
+    }
+
+
+def load_prefixtree_snapshot(config_hash):
+    """
+    Loads the compiled prefix tree snapshot of a configuration from the snapshot
+    file, if it exists for this configuration (hash), otherwise returns None.
+    """
+    if not PREFIXTREE_SNAPSHOT_FILE or not os.path.isfile(PREFIXTREE_SNAPSHOT_FILE):
+        return None
+    try:
+        with open(PREFIXTREE_SNAPSHOT_FILE, "rb") as f:
+            # the header is pickled separately, so that the snapshot of
+            # another configuration is not loaded at all
+            header = pickle.load(f)
+            if header != {
+                "format": PREFIXTREE_SNAPSHOT_FORMAT,
+                "config_hash": config_hash,
+            }:
+                return None
+            return pickle.load(f)
+    except Exception:
+        log.exception("could not load prefix tree snapshot")
+        return None
+
+
+def store_prefixtree_snapshot(config_hash, snapshot):
+    """
+    Stores the compiled prefix tree snapshot of a configuration (hash) to the
+    snapshot file, replacing the previous one.
+    """
+    if not PREFIXTREE_SNAPSHOT_FILE:
+        return
+    # unique, since the replicas of prefixtree may share the snapshot volume
+    tmp_file = "{}.{}.tmp".format(PREFIXTREE_SNAPSHOT_FILE, uuid())
+    try:
+        # the snapshot volume may not be mounted (e.g., in the testing setups)
+        os.makedirs(
+            os.path.dirname(os.path.abspath(PREFIXTREE_SNAPSHOT_FILE)), exist_ok=True
+        )
+        with open(tmp_file, "wb") as f:
+            pickle.dump(
+                {"format": PREFIXTREE_SNAPSHOT_FORMAT, "config_hash": config_hash},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # atomic, so that a crash never leaves a partial snapshot behind
+        os.replace(tmp_file, PREFIXTREE_SNAPSHOT_FILE)
+    except Exception:
+        log.exception("could not store prefix tree snapshot")
 
 
 def configure_prefixtree(msg, shared_memory_manager_dict):
@@ -78,113 +656,61 @@ def configure_prefixtree(msg, shared_memory_manager_dict):
             shared_memory_manager_dict["service_reconfiguring"] = True
             shared_memory_locks["service_reconfiguring"].release()
 
-            # calculate prefix tree
-            prefix_tree = {"v4": pytricia.PyTricia(32), "v6": pytricia.PyTricia(128)}
-            rules = config.get("rules", [])
-            for rule in rules:
-                rule_translated_origin_asn_set = set()
-                for asn in rule["origin_asns"]:
-                    this_translated_asn_list = flatten(translate_asn_range(asn))
-                    rule_translated_origin_asn_set.update(set(this_translated_asn_list))
-                rule["origin_asns"] = list(rule_translated_origin_asn_set)
-                rule_translated_neighbor_set = set()
-                for asn in rule["neighbors"]:
-                    this_translated_asn_list = flatten(translate_asn_range(asn))
-                    rule_translated_neighbor_set.update(set(this_translated_asn_list))
-                rule["neighbors"] = list(rule_translated_neighbor_set)
-
-                conf_obj = {
-                    "origin_asns": rule["origin_asns"],
-                    "neighbors": rule["neighbors"],
-                    "prepend_seq": rule.get("prepend_seq", []),
-                    "policies": list(set(rule.get("policies", []))),
-                    "community_annotations": rule.get("community_annotations", []),
-                    "mitigation": rule.get("mitigation", "manual"),
-                }
-                for prefix in rule["prefixes"]:
-                    for translated_prefix in translate_rfc2622(prefix):
-                        ip_version = get_ip_version(translated_prefix)
-                        if prefix_tree[ip_version].has_key(translated_prefix):
-                            node = prefix_tree[ip_version][translated_prefix]
-                        else:
-                            node = {
-                                "prefix": translated_prefix,
-                                "data": {"confs": []},
-                                "timestamp": config["timestamp"],
-                            }
-                            prefix_tree[ip_version].insert(translated_prefix, node)
-                        node["data"]["confs"].append(conf_obj)
-
-            # calculate the monitored and configured prefixes
-            configured_prefix_count = 0
-            monitored_prefixes = set()
-            for ip_version in prefix_tree:
-                for prefix in prefix_tree[ip_version]:
-                    configured_prefix_count += 1
-                    monitored_prefix = search_worst_prefix(
-                        prefix, prefix_tree[ip_version]
-                    )
-                    if monitored_prefix:
-                        monitored_prefixes.add(monitored_prefix)
-
-            # extract autoignore rules
-            autoignore_rules = config.get("autoignore", {})
-
-            # calculate autoignore prefix tree
-            autoignore_prefix_tree = {
-                "v4": pytricia.PyTricia(32),
-                "v6": pytricia.PyTricia(128),
+            # e.g., upon restart, the configuration has already been compiled
+            config_hash = get_config_hash(config)
+            snapshot = load_prefixtree_snapshot(config_hash)
+            if snapshot is None:
+                snapshot = compile_prefixtree(config)
+                store_prefixtree_snapshot(config_hash, snapshot)
+            else:
+                # the snapshot may have been compiled from a previous parse
+                snapshot["prefix_tree"]["timestamp"] = config["timestamp"]
+                log.info("prefix tree snapshot loaded from file")
+            dict_prefix_tree = snapshot["prefix_tree"]
+
+            # the rule configurations are served before the new tree version is
+            # published, so that the conf ids of the annotated updates can be resolved
+            shared_memory_locks["prefix_tree_confs"].acquire()
+            shared_memory_manager_dict["prefix_tree_confs"] = {
+                "timestamp": config["timestamp"],
+                "confs": dict(
+                    zip(dict_prefix_tree["conf_ids"], dict_prefix_tree["confs"])
+                ),
             }
-
-            for key in autoignore_rules:
-                rule = autoignore_rules[key]
-                for prefix in rule["prefixes"]:
-                    for translated_prefix in translate_rfc2622(prefix):
-                        ip_version = get_ip_version(translated_prefix)
-                        if not autoignore_prefix_tree[ip_version].has_key(
-                            translated_prefix
-                        ):
-                            node = {"prefix": translated_prefix, "rule_key": key}
-                            autoignore_prefix_tree[ip_version].insert(
-                                translated_prefix, node
-                            )
+            shared_memory_locks["prefix_tree_confs"].release()
 
             # note that the object should be picklable (e.g., dict instead of pytricia tree,
             # see also: https://github.com/jsommers/pytricia/issues/20)
-            shared_memory_locks["prefix_tree"].acquire()
-            dict_prefix_tree = {
-                "v4": pytricia_to_dict(prefix_tree["v4"]),
-                "v6": pytricia_to_dict(prefix_tree["v6"]),
-            }
-            shared_memory_manager_dict["prefix_tree"] = dict_prefix_tree
-            # Splitting the recalculate indicator to ensure both v4 and v6 trees are updated
-            shared_memory_manager_dict["prefix_tree_recalculate_v4"] = True
-            shared_memory_manager_dict["prefix_tree_recalculate_v6"] = True
-            shared_memory_locks["prefix_tree"].release()
+            publish_prefix_tree(
+                shared_memory_manager_dict,
+                "prefix_tree",
+                "prefix_tree",
+                dict_prefix_tree,
+            )
 
             shared_memory_locks["monitored_prefixes"].acquire()
-            shared_memory_manager_dict["monitored_prefixes"] = list(monitored_prefixes)
+            shared_memory_manager_dict["monitored_prefixes"] = snapshot[
+                "monitored_prefixes"
+            ]
             shared_memory_locks["monitored_prefixes"].release()
 
             shared_memory_locks["configured_prefix_count"].acquire()
-            shared_memory_manager_dict[
+            shared_memory_manager_dict["configured_prefix_count"] = snapshot[
                 "configured_prefix_count"
-            ] = configured_prefix_count
+            ]
             shared_memory_locks["configured_prefix_count"].release()
 
-            # note that the object should be picklable (e.g., dict instead of pytricia tree,
-            # see also: https://github.com/jsommers/pytricia/issues/20)
-            dict_autoignore_prefix_tree = {
-                "v4": pytricia_to_dict(autoignore_prefix_tree["v4"]),
-                "v6": pytricia_to_dict(autoignore_prefix_tree["v6"]),
-            }
             shared_memory_locks["autoignore"].acquire()
-            shared_memory_manager_dict["autoignore_rules"] = autoignore_rules
-            shared_memory_manager_dict[
-                "autoignore_prefix_tree"
-            ] = dict_autoignore_prefix_tree
-            shared_memory_manager_dict["autoignore_recalculate"] = True
+            shared_memory_manager_dict["autoignore_rules"] = snapshot[
+                "autoignore_rules"
+            ]
             shared_memory_locks["autoignore"].release()
+            publish_prefix_tree(
+                shared_memory_manager_dict,
+                "autoignore",
+                "autoignore_prefix_tree",
+                snapshot["autoignore_prefix_tree"],
+            )
 
             shared_memory_locks["config_timestamp"].acquire()
             shared_memory_manager_dict["config_timestamp"] = config["timestamp"]
@@ -219,8 +745,7 @@ class ConfigHandler(RequestHandler):
                 "v4": <dict>,
                 "v6": <dict>
             },
-            "prefix_tree_recalculate_v4": <bool>,
-            "prefix_tree_recalculate_v6": <bool>,
+            "prefix_tree_version": <int>,
             "monitored_prefixes": <list>,
             "configured_prefix_count": <int>,
             "autoignore_rules": <dict>,
@@ -228,7 +753,7 @@ class ConfigHandler(RequestHandler):
                 "v4": <dict>,
                 "v6": <dict>
             },
-            "autoignore_recalculate": <bool>,
+            "autoignore_version": <int>,
             "config_timestamp": <timestamp>
         }
         """
@@ -236,12 +761,7 @@ class ConfigHandler(RequestHandler):
 
         ret_dict["prefix_tree"] = self.shared_memory_manager_dict["prefix_tree"]
 
-        ret_dict["prefix_tree_recalculate_v4"] = self.shared_memory_manager_dict[
-            "prefix_tree_recalculate_v4"
-        ]
-        ret_dict["prefix_tree_recalculate_v6"] = self.shared_memory_manager_dict[
-            "prefix_tree_recalculate_v6"
-        ]
+        ret_dict["prefix_tree_version"] = shared_memory_versions["prefix_tree"].value
 
         ret_dict["monitored_prefixes"] = self.shared_memory_manager_dict[
             "monitored_prefixes"
@@ -257,9 +777,7 @@ class ConfigHandler(RequestHandler):
         ret_dict["autoignore_prefix_tree"] = self.shared_memory_manager_dict[
             "autoignore_prefix_tree"
         ]
-        ret_dict["autoignore_recalculate"] = self.shared_memory_manager_dict[
-            "autoignore_recalculate"
-        ]
+        ret_dict["autoignore_version"] = shared_memory_versions["autoignore"].value
 
         ret_dict["config_timestamp"] = self.shared_memory_manager_dict[
             "config_timestamp"
@@ -292,7 +810,8 @@ class HealthHandler(RequestHandler):
     def get(self):
         """
         Extract the status of a service via a GET request.
-        :return: {"status" : <unconfigured|running|stopped><,reconfiguring>}
+        :return: {"status" : <unconfigured|running|stopped><,reconfiguring>,
+                  "unconfigured_prefix_cache": {"hits": <hits>, "misses": <misses>}}
         """
         status = "stopped"
         shared_memory_locks["data_worker"].acquire()
@@ -301,7 +820,15 @@ class HealthHandler(RequestHandler):
         shared_memory_locks["data_worker"].release()
         if self.shared_memory_manager_dict["service_reconfiguring"]:
             status += ",reconfiguring"
-        self.write({"status": status})
+        self.write(
+            {
+                "status": status,
+                "unconfigured_prefix_cache": {
+                    "hits": unconfigured_prefix_cache_stats["hits"].value,
+                    "misses": unconfigured_prefix_cache_stats["misses"].value,
+                },
+            }
+        )
 
 
 class ControlHandler(RequestHandler):
@@ -324,15 +851,7 @@ class ControlHandler(RequestHandler):
 
     def run_data_worker_process(self):
         try:
-            with Connection(RABBITMQ_URI) as connection:
-                shared_memory_locks["data_worker"].acquire()
-                data_worker = PrefixTreeDataWorker(
-                    connection, self.shared_memory_manager_dict
-                )
-                self.shared_memory_manager_dict["data_worker_running"] = True
-                shared_memory_locks["data_worker"].release()
-                log.info("data worker started")
-                data_worker.run()
+            PrefixTreeDataWorkerPool(self.shared_memory_manager_dict).run()
         except Exception:
             log.exception("exception")
         finally:
@@ -429,6 +948,34 @@ class MonitoredPrefixesHandler(RequestHandler):
         )
 
 
+class PrefixTreeConfsHandler(RequestHandler):
+    """
+    REST request handler for the rule configurations of the prefix tree.
+    """
+
+    def initialize(self, shared_memory_manager_dict):
+        self.shared_memory_manager_dict = shared_memory_manager_dict
+
+    def get(self):
+        """
+        Provides the rule configurations of the prefix tree (in the form of a JSON dict),
+        by conf id, to the consumers of annotated updates that need to resolve them.
+        Format:
+        {
+            "timestamp": <timestamp>,
+            "confs": {
+                <conf_id>: <dict>,
+                ...
+            }
+        }
+        """
+        shared_memory_locks["prefix_tree_confs"].acquire()
+        try:
+            self.write(self.shared_memory_manager_dict["prefix_tree_confs"])
+        finally:
+            shared_memory_locks["prefix_tree_confs"].release()
+
+
 class PrefixTree:
     """
     Prefix Tree Service.
@@ -440,14 +987,27 @@ class PrefixTree:
         self.shared_memory_manager_dict = shared_memory_manager.dict()
         self.shared_memory_manager_dict["data_worker_running"] = False
         self.shared_memory_manager_dict["service_reconfiguring"] = False
-        self.shared_memory_manager_dict["prefix_tree"] = {"v4": {}, "v6": {}}
-        self.shared_memory_manager_dict["prefix_tree_recalculate_v4"] = True
-        self.shared_memory_manager_dict["prefix_tree_recalculate_v6"] = True
+        self.shared_memory_manager_dict["prefix_tree"] = {
+            "v4": {},
+            "v6": {},
+            "confs": [],
+            "conf_ids": [],
+            "timestamp": -1,
+        }
+        self.shared_memory_manager_dict["prefix_tree_deltas"] = []
+        self.shared_memory_manager_dict["prefix_tree_confs"] = {
+            "timestamp": -1,
+            "confs": {},
+        }
         self.shared_memory_manager_dict["monitored_prefixes"] = list()
         self.shared_memory_manager_dict["configured_prefix_count"] = 0
         self.shared_memory_manager_dict["autoignore_rules"] = {}
-        self.shared_memory_manager_dict["autoignore_prefix_tree"] = {"v4": {}, "v6": {}}
-        self.shared_memory_manager_dict["autoignore_recalculate"] = True
+        self.shared_memory_manager_dict["autoignore_prefix_tree"] = {
+            "v4": {},
+            "v6": {},
+            "rule_keys": [],
+        }
+        self.shared_memory_manager_dict["autoignore_prefix_tree_deltas"] = []
         self.shared_memory_manager_dict["config_timestamp"] = -1
 
         log.info("service initiated")
@@ -480,6 +1040,11 @@ class PrefixTree:
                     MonitoredPrefixesHandler,
                     dict(shared_memory_manager_dict=self.shared_memory_manager_dict),
                 ),
+                (
+                    "/prefixTreeConfs",
+                    PrefixTreeConfsHandler,
+                    dict(shared_memory_manager_dict=self.shared_memory_manager_dict),
+                ),
             ]
         )
 
@@ -490,67 +1055,179 @@ class PrefixTree:
         IOLoop.current().start()
 
 
+class PrefixTreeDataWorkerPool:
+    """
+    Pool of data worker processes, forked from a parent process that holds the
+    latest prefix trees, so that the workers share the tree pages (copy-on-write)
+    instead of building their own trees; the workers are re-forked upon
+    re-configuration.
+    """
+
+    def __init__(self, shared_memory_manager_dict: Dict) -> NoReturn:
+        self.shared_memory_manager_dict = shared_memory_manager_dict
+        self.prefix_trees = {
+            "prefix_tree": None,
+            "prefix_tree_version": -1,
+            "autoignore_prefix_tree": None,
+            "autoignore_version": -1,
+        }
+        # (process, retire event) of the current workers
+        self.workers = []
+        self.retired_workers = []
+        # the suffix of the autoconf/autoignore queues that the workers share
+        # (generated once, so that re-forked workers consume from the same queues)
+        self.queue_suffix = uuid()
+
+    def load_prefix_trees(self):
+        prefix_tree, prefix_tree_version = load_prefix_tree_update(
+            self.shared_memory_manager_dict,
+            "prefix_tree",
+            "prefix_tree",
+            self.prefix_trees["prefix_tree"],
+            self.prefix_trees["prefix_tree_version"],
+        )
+        autoignore_prefix_tree, autoignore_version = load_prefix_tree_update(
+            self.shared_memory_manager_dict,
+            "autoignore",
+            "autoignore_prefix_tree",
+            self.prefix_trees["autoignore_prefix_tree"],
+            self.prefix_trees["autoignore_version"],
+        )
+        self.prefix_trees = {
+            "prefix_tree": prefix_tree,
+            "prefix_tree_version": prefix_tree_version,
+            "autoignore_prefix_tree": autoignore_prefix_tree,
+            "autoignore_version": autoignore_version,
+        }
+        log.info(
+            "pytricia trees loaded from configuration (versions {}, {})".format(
+                prefix_tree_version, autoignore_version
+            )
+        )
+
+    def prefix_trees_changed(self):
+        return (
+            shared_memory_versions["prefix_tree"].value
+            != self.prefix_trees["prefix_tree_version"]
+            or shared_memory_versions["autoignore"].value
+            != self.prefix_trees["autoignore_version"]
+        )
+
+    def fork_workers(self):
+        """
+        Forks new workers with the current trees and retires the previous ones; the
+        retired workers stop consuming within a second, while the new ones consume
+        from the same queues.
+        """
+        retired_workers = self.workers
+        self.workers = []
+        for _ in range(PREFIXTREE_WORKERS):
+            retire_event = mp.Event()
+            worker_process = mp.Process(
+                target=run_data_worker,
+                args=(
+                    self.shared_memory_manager_dict,
+                    self.prefix_trees,
+                    retire_event,
+                    self.queue_suffix,
+                ),
+            )
+            worker_process.start()
+            self.workers.append((worker_process, retire_event))
+        for worker_process, retire_event in retired_workers:
+            retire_event.set()
+            self.retired_workers.append(worker_process)
+
+    def run(self):
+        self.load_prefix_trees()
+        self.fork_workers()
+        shared_memory_locks["data_worker"].acquire()
+        self.shared_memory_manager_dict["data_worker_running"] = True
+        shared_memory_locks["data_worker"].release()
+        log.info("data worker started ({} processes)".format(PREFIXTREE_WORKERS))
+        try:
+            # the pool stops as soon as a worker stops (e.g., upon a stop command)
+            while all(worker_process.is_alive() for worker_process, _ in self.workers):
+                time.sleep(1)
+                self.retired_workers = [
+                    worker_process
+                    for worker_process in self.retired_workers
+                    if worker_process.is_alive()
+                ]
+                if self.prefix_trees_changed():
+                    self.load_prefix_trees()
+                    self.fork_workers()
+        finally:
+            for worker_process, retire_event in self.workers:
+                retire_event.set()
+                self.retired_workers.append(worker_process)
+            for worker_process in self.retired_workers:
+                worker_process.join()
+
+
+def run_data_worker(
+    shared_memory_manager_dict, prefix_trees, retire_event, queue_suffix
+):
+    try:
+        with Connection(RABBITMQ_URI) as connection:
+            data_worker = PrefixTreeDataWorker(
+                connection,
+                shared_memory_manager_dict,
+                prefix_trees,
+                retire_event,
+                queue_suffix,
+            )
+            data_worker.run()
+    except Exception:
+        log.exception("exception")
+
+
 class PrefixTreeDataWorker(ConsumerProducerMixin):
     """
     RabbitMQ Consumer/Producer for the prefix tree Service.
     """
 
     def __init__(
-        self, connection: Connection, shared_memory_manager_dict: Dict
+        self,
+        connection: Connection,
+        shared_memory_manager_dict: Dict,
+        prefix_trees: Dict,
+        retire_event: mp.Event,
+        queue_suffix: str,
     ) -> NoReturn:
         self.connection = connection
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
         ping_redis(self.redis)
+        # SMISMEMBER needs redis >= 6.2; with an older (e.g., external) redis,
+        # the autoconf update keys are checked one by one (in the same pipeline)
+        try:
+            self.redis.execute_command(
+                "SMISMEMBER", "autoconf-update-keys-to-process", ""
+            )
+            self.redis_smismember = True
+        except redis.ResponseError:
+            log.warning("redis < 6.2, falling back to SISMEMBER")
+            self.redis_smismember = False
         self.shared_memory_manager_dict = shared_memory_manager_dict
-
-        self.prefix_tree = {"v4": pytricia.PyTricia(32), "v6": pytricia.PyTricia(128)}
-        shared_memory_locks["prefix_tree"].acquire()
-        # We could go with an "and" condition but for now let's keep it loose with an "or"
-        # so that both v4 and v6 are built:
-        if (
-            self.shared_memory_manager_dict["prefix_tree_recalculate_v4"]
-            or self.shared_memory_manager_dict["prefix_tree_recalculate_v6"]
-        ):
-            for ip_version in ["v4", "v6"]:
-                if ip_version == "v4":
-                    size = 32
-                else:
-                    size = 128
-                self.prefix_tree[ip_version] = dict_to_pytricia(
-                    self.shared_memory_manager_dict["prefix_tree"][ip_version], size
-                )
-                log.info(
-                    "{} pytricia tree parsed from configuration".format(ip_version)
-                )
-                self.shared_memory_manager_dict["prefix_tree_recalculate_v4"] = False
-                self.shared_memory_manager_dict["prefix_tree_recalculate_v6"] = False
-        shared_memory_locks["prefix_tree"].release()
-
-        self.autoignore_prefix_tree = {
-            "v4": pytricia.PyTricia(32),
-            "v6": pytricia.PyTricia(128),
-        }
-        shared_memory_locks["autoignore"].acquire()
-        if self.shared_memory_manager_dict["autoignore_recalculate"]:
-            for ip_version in ["v4", "v6"]:
-                if ip_version == "v4":
-                    size = 32
-                else:
-                    size = 128
-                self.autoignore_prefix_tree[ip_version] = dict_to_pytricia(
-                    self.shared_memory_manager_dict["autoignore_prefix_tree"][
-                        ip_version
-                    ],
-                    size,
-                )
-                log.info(
-                    "{} pytricia tree parsed from configuration".format(ip_version)
-                )
-                self.shared_memory_manager_dict["autoignore_recalculate"] = False
-        shared_memory_locks["autoignore"].release()
+        # set by the parent process when this worker is replaced
+        self.retire_event = retire_event
+
+        # local copies of the latest tree snapshots (and their versions), as
+        # inherited from the parent process
+        self.prefix_tree = prefix_trees["prefix_tree"]
+        self.prefix_tree_version = prefix_trees["prefix_tree_version"]
+        # LRU cache of the prefixes that match no configured prefix
+        self.unconfigured_prefixes = OrderedDict()
+        self.check_prefix_tree_version()
+        self.autoignore_prefix_tree = prefix_trees["autoignore_prefix_tree"]
+        self.autoignore_version = prefix_trees["autoignore_version"]
+        self.check_autoignore_version()
 
         # EXCHANGES
         self.update_exchange = create_exchange("bgp-update", connection, declare=True)
+        self.update_hashing = create_exchange(
+            "bgp-update-hashing", connection, "x-consistent-hash", declare=True
+        )
         self.hijack_exchange = create_exchange(
             "hijack-update", connection, declare=True
         )
@@ -601,19 +1278,19 @@ class PrefixTreeDataWorker(ConsumerProducerMixin):
             routing_key="stop-{}".format(SERVICE_NAME),
             priority=1,
         )
+        # the workers of the pool compete on a single (per service instance)
+        # queue for each of these fanout-like messages
         self.autoconf_update_queue = create_queue(
-            SERVICE_NAME,
+            "{}-{}".format(SERVICE_NAME, queue_suffix),
             exchange=self.autoconf_exchange,
             routing_key="update",
             priority=4,
-            random=True,
         )
         self.ongoing_hijack_prefixes_queue = create_queue(
-            SERVICE_NAME,
+            "{}-{}".format(SERVICE_NAME, queue_suffix),
             exchange=self.autoignore_exchange,
             routing_key="ongoing-hijack-prefixes",
             priority=1,
-            random=True,
         )
 
         log.info("data worker initiated")
@@ -670,65 +1347,144 @@ class PrefixTreeDataWorker(ConsumerProducerMixin):
             ),
         ]
 
-    def find_prefix_node(self, prefix):
-        ip_version = get_ip_version(prefix)
-        prefix_node = None
-        shared_memory_locks["prefix_tree"].acquire()
-        if ip_version == "v4":
-            size = 32
-        else:
-            size = 128
-        # need to turn to pytricia tree since this means that the tree has changed due to re-configuration
-        # Switching to per ip_version prefix trees' recalculate indicators.
-        # This is important as we want to ensure that changes in v4 will not lock out v6 tree builds
-        # and vice-versa.
-        if self.shared_memory_manager_dict[f"prefix_tree_recalculate_{ip_version}"]:
-            self.prefix_tree[ip_version] = dict_to_pytricia(
-                self.shared_memory_manager_dict["prefix_tree"][ip_version], size
+    def on_iteration(self):
+        if self.retire_event.is_set():
+            self.should_stop = True
+
+    def load_prefix_tree(self):
+        """
+        Swaps in (or applies the deltas of) the latest prefix tree snapshot
+        of the configuration.
+        """
+        prefix_tree, version = load_prefix_tree_update(
+            self.shared_memory_manager_dict,
+            "prefix_tree",
+            "prefix_tree",
+            self.prefix_tree,
+            self.prefix_tree_version,
+        )
+        log.info(
+            "pytricia trees {} from configuration (version {})".format(
+                "updated" if prefix_tree is self.prefix_tree else "parsed", version
             )
-            log.info("{} pytricia tree re-parsed from configuration".format(ip_version))
-            self.shared_memory_manager_dict[
-                f"prefix_tree_recalculate_{ip_version}"
-            ] = False
-        if prefix in self.prefix_tree[ip_version]:
-            prefix_node = self.prefix_tree[ip_version][prefix]
-        shared_memory_locks["prefix_tree"].release()
-        return prefix_node
+        )
+        self.prefix_tree = prefix_tree
+        self.prefix_tree_version = version
+        self.unconfigured_prefixes.clear()
 
-    def find_autoignore_prefix_node(self, prefix):
-        ip_version = get_ip_version(prefix)
-        prefix_node = None
-        shared_memory_locks["autoignore"].acquire()
-        if ip_version == "v4":
-            size = 32
-        else:
-            size = 128
-        # need to turn to pytricia tree since this means that the tree has changed due to re-configuration
-        if self.shared_memory_manager_dict["autoignore_recalculate"]:
-            self.autoignore_prefix_tree[ip_version] = dict_to_pytricia(
-                self.shared_memory_manager_dict["autoignore_prefix_tree"][ip_version],
-                size,
+    def load_autoignore_prefix_tree(self):
+        """
+        Swaps in (or applies the deltas of) the latest autoignore prefix tree
+        snapshot of the configuration.
+        """
+        autoignore_prefix_tree, version = load_prefix_tree_update(
+            self.shared_memory_manager_dict,
+            "autoignore",
+            "autoignore_prefix_tree",
+            self.autoignore_prefix_tree,
+            self.autoignore_version,
+        )
+        log.info(
+            "autoignore pytricia trees {} from configuration (version {})".format(
+                "updated"
+                if autoignore_prefix_tree is self.autoignore_prefix_tree
+                else "parsed",
+                version,
             )
-            log.info(
-                "{} autoignore pytricia tree re-parsed from configuration".format(
-                    ip_version
+        )
+        self.autoignore_prefix_tree = autoignore_prefix_tree
+        self.autoignore_version = version
+
+    def find_prefix_node(self, prefix):
+        return self.find_configured_prefix(prefix, lookup_prefix_node)
+
+    def find_prefix_node_reference(self, prefix):
+        return self.find_configured_prefix(prefix, lookup_prefix_node_reference)
+
+    def find_prefix_node_references(self, bgp_updates):
+        """
+        Annotates a batch of bgp updates with (references to) the associated
+        configuration nodes, checking the prefix tree snapshot once per batch;
+        returns the (bgp update, prefix node) pairs of the batch.
+        """
+        self.check_prefix_tree_version()
+        annotated_bgp_updates = []
+        for bgp_update in bgp_updates:
+            try:
+                prefix_node = self.lookup_configured_prefix(
+                    bgp_update["prefix"], lookup_prefix_node_reference
                 )
-            )
-            self.shared_memory_manager_dict["autoignore_recalculate"] = False
-        if prefix in self.autoignore_prefix_tree[ip_version]:
-            prefix_node = self.autoignore_prefix_tree[ip_version][prefix]
-        shared_memory_locks["autoignore"].release()
+                if prefix_node:
+                    bgp_update["prefix_node"] = prefix_node
+                annotated_bgp_updates.append((bgp_update, prefix_node))
+            except Exception:
+                log.exception("exception")
+        return annotated_bgp_updates
+
+    def check_prefix_tree_version(self):
+        # the trees only change upon re-configuration, so the lookup itself
+        # neither locks nor accesses the shared memory manager
+        if shared_memory_versions["prefix_tree"].value != self.prefix_tree_version:
+            self.load_prefix_tree()
+
+    def find_configured_prefix(self, prefix, lookup):
+        self.check_prefix_tree_version()
+        return self.lookup_configured_prefix(prefix, lookup)
+
+    def lookup_configured_prefix(self, prefix, lookup):
+        # most prefixes of broad monitors match no configured prefix
+        if prefix in self.unconfigured_prefixes:
+            stat = unconfigured_prefix_cache_stats["hits"]
+            with stat.get_lock():
+                stat.value += 1
+            self.unconfigured_prefixes.move_to_end(prefix)
+            return None
+        prefix_node = lookup(self.prefix_tree, prefix)
+        if prefix_node is None:
+            stat = unconfigured_prefix_cache_stats["misses"]
+            with stat.get_lock():
+                stat.value += 1
+            self.unconfigured_prefixes[prefix] = None
+            if len(self.unconfigured_prefixes) > UNCONFIGURED_PREFIX_CACHE_SIZE:
+                self.unconfigured_prefixes.popitem(last=False)
         return prefix_node
 
+    def check_autoignore_version(self):
+        if shared_memory_versions["autoignore"].value != self.autoignore_version:
+            self.load_autoignore_prefix_tree()
+
+    def find_autoignore_prefix_node(self, prefix):
+        self.check_autoignore_version()
+        return lookup_autoignore_prefix_node(self.autoignore_prefix_tree, prefix)
+
     def annotate_bgp_update(self, message: Dict) -> NoReturn:
         """
-        Callback function that annotates an incoming bgp update with the associated
-        configuration node (otherwise it discards it).
+        Callback function that annotates an incoming bgp update (or a batch of
+        bgp updates) with (a reference to) the associated configuration node
+        (otherwise it discards it). Batches (e.g., of the RIPE RIS tap, when
+        RIS_BATCH_UPDATES is enabled) are published as batches, so that consumers
+        only receive lists of updates from producers that send them.
         """
         message.ack()
+        if isinstance(message.payload, list):
+            bgp_updates = [
+                bgp_update
+                for bgp_update, prefix_node in self.find_prefix_node_references(
+                    message.payload
+                )
+                if prefix_node
+            ]
+            if bgp_updates:
+                self.producer.publish(
+                    bgp_updates,
+                    exchange=self.update_exchange,
+                    routing_key="update-with-prefix-node",
+                    serializer="ujson",
+                )
+            return
         bgp_update = message.payload
         try:
-            prefix_node = self.find_prefix_node(bgp_update["prefix"])
+            prefix_node = self.find_prefix_node_reference(bgp_update["prefix"])
             if prefix_node:
                 bgp_update["prefix_node"] = prefix_node
                 self.producer.publish(
@@ -744,19 +1500,21 @@ class PrefixTreeDataWorker(ConsumerProducerMixin):
 
     def annotate_stored_bgp_update(self, message: Dict) -> NoReturn:
         """
-        Callback function that annotates an incoming (stored) bgp update with the associated
-        configuration node (otherwise it discards it).
+        Callback function that annotates an incoming (stored) bgp update with (a reference
+        to) the associated configuration node (otherwise it discards it).
         """
         message.ack()
         bgp_update = message.payload
         try:
-            prefix_node = self.find_prefix_node(bgp_update["prefix"])
+            prefix_node = self.find_prefix_node_reference(bgp_update["prefix"])
             if prefix_node:
                 bgp_update["prefix_node"] = prefix_node
+                # shard detection input by configured prefix
                 self.producer.publish(
                     bgp_update,
-                    exchange=self.update_exchange,
-                    routing_key="stored-update-with-prefix-node",
+                    exchange=self.update_hashing,
+                    routing_key=prefix_node["prefix"],
+                    headers={"type": "stored-update-with-prefix-node"},
                     serializer="ujson",
                 )
             else:
@@ -768,25 +1526,29 @@ class PrefixTreeDataWorker(ConsumerProducerMixin):
 
     def annotate_ongoing_hijack_updates(self, message: Dict) -> NoReturn:
         """
-        Callback function that annotates incoming ongoing hijack updates with the associated
-        configuration nodes (otherwise it discards them).
+        Callback function that annotates incoming ongoing hijack updates with (references
+        to) the associated configuration nodes (otherwise it discards them).
         """
         message.ack()
-        bgp_updates = []
-        for bgp_update in message.payload:
-            try:
-                prefix_node = self.find_prefix_node(bgp_update["prefix"])
-                if prefix_node:
-                    bgp_update["prefix_node"] = prefix_node
-                bgp_updates.append(bgp_update)
-            except Exception:
-                log.exception("exception")
-        self.producer.publish(
-            bgp_updates,
-            exchange=self.hijack_exchange,
-            routing_key="ongoing-with-prefix-node",
-            serializer="ujson",
-        )
+        # group by configured prefix, so that every detection shard
+        # re-checks the ongoing hijacks of the prefixes it owns
+        bgp_updates = {}
+        for bgp_update, prefix_node in self.find_prefix_node_references(
+            message.payload
+        ):
+            if prefix_node:
+                hash_prefix = prefix_node["prefix"]
+            else:
+                hash_prefix = bgp_update["prefix"]
+            bgp_updates.setdefault(hash_prefix, []).append(bgp_update)
+        for hash_prefix, prefix_bgp_updates in bgp_updates.items():
+            self.producer.publish(
+                prefix_bgp_updates,
+                exchange=self.update_hashing,
+                routing_key=hash_prefix,
+                headers={"type": "ongoing-with-prefix-node"},
+                serializer="ujson",
+            )
 
     def annotate_mitigation_request(self, message: Dict) -> NoReturn:
         """
@@ -849,20 +1611,44 @@ class PrefixTreeDataWorker(ConsumerProducerMixin):
         bgp_updates = message.payload
         if not isinstance(bgp_updates, list):
             bgp_updates = [bgp_updates]
+        if not bgp_updates:
+            return
+        bgp_update_keys = [bgp_update["key"] for bgp_update in bgp_updates]
+        # check the whole batch with a single round trip
+        redis_pipeline = self.redis.pipeline()
+        redis_pipeline.mget(bgp_update_keys)
+        redis_pipeline.exists("autoconf-update-keys-to-process")
+        if self.redis_smismember:
+            # (redis-py has no wrapper for SMISMEMBER yet)
+            redis_pipeline.execute_command(
+                "SMISMEMBER", "autoconf-update-keys-to-process", *bgp_update_keys
+            )
+        else:
+            for bgp_update_key in bgp_update_keys:
+                redis_pipeline.sismember(
+                    "autoconf-update-keys-to-process", bgp_update_key
+                )
+        results = redis_pipeline.execute()
+        seen_updates, keys_to_process_exist = results[:2]
+        if self.redis_smismember:
+            updates_to_process = results[2]
+        else:
+            updates_to_process = results[2:]
+        self.check_prefix_tree_version()
         bgp_updates_to_send_to_conf = list()
         delete_from_redis_without_sending_to_autoconf = set()
-        for bgp_update in bgp_updates:
-            # if you have seen the exact same update before, do nothing
-            if self.redis.get(bgp_update["key"]):
-                return
-            if self.redis.exists(
-                "autoconf-update-keys-to-process"
-            ) and not self.redis.sismember(
-                "autoconf-update-keys-to-process", bgp_update["key"]
-            ):
-                return
-
-            prefix_node = self.find_prefix_node(bgp_update["prefix"])
+        for bgp_update, seen_update, update_to_process in zip(
+            bgp_updates, seen_updates, updates_to_process
+        ):
+            # if you have seen the exact same update before, skip it
+            if seen_update:
+                continue
+            if keys_to_process_exist and not update_to_process:
+                continue
+
+            prefix_node = self.lookup_configured_prefix(
+                bgp_update["prefix"], lookup_prefix_node
+            )
             add_update = True
             # small optimization: if prefix exist in prefix tree and we have an update for existing origin, discard it
             # attention: subprefixes belong to existing prefix nodes, so the check should also account
@@ -886,11 +1672,11 @@ class PrefixTreeDataWorker(ConsumerProducerMixin):
                 delete_from_redis_without_sending_to_autoconf.add(bgp_update["key"])
             else:
                 bgp_updates_to_send_to_conf.append(bgp_update)
-        if self.redis.exists("autoconf-update-keys-to-process"):
-            redis_pipeline = self.redis.pipeline()
-            for bgp_update_key in delete_from_redis_without_sending_to_autoconf:
-                redis_pipeline.srem("autoconf-update-keys-to-process", bgp_update_key)
-            redis_pipeline.execute()
+        if keys_to_process_exist and delete_from_redis_without_sending_to_autoconf:
+            self.redis.srem(
+                "autoconf-update-keys-to-process",
+                *delete_from_redis_without_sending_to_autoconf
+            )
         self.producer.publish(
             bgp_updates_to_send_to_conf,
             exchange=self.autoconf_exchange,
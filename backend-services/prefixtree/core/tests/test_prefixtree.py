@@ -0,0 +1,417 @@
+import copy
+import os
+import random
+import tempfile
+import unittest
+from ipaddress import ip_network
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import fakeredis
+import prefixtree
+
+# the (small) address spaces of the random configurations, so that their prefix
+# ranges overlap and can be expanded to all their more specifics
+BASE_NETWORKS = [ip_network("10.0.0.0/20"), ip_network("2001:db8::/44")]
+
+
+def random_prefix(rng, base_network):
+    """
+    Returns a random prefix of a base network, up to 6 bits more specific.
+    """
+    prefix_len = base_network.prefixlen + rng.randint(0, 6)
+    subnet = rng.getrandbits(prefix_len - base_network.prefixlen)
+    address = int(base_network.network_address) + (
+        subnet << (base_network.max_prefixlen - prefix_len)
+    )
+    return ip_network((address, prefix_len))
+
+
+def random_prefix_range(rng, network):
+    """
+    Returns a random (RFC2622) prefix range of a prefix, or the prefix itself.
+    """
+    if rng.random() < 0.5:
+        return str(network)
+    operators = ["", "^{}".format(network.prefixlen + rng.randint(0, 2))]
+    min_len = network.prefixlen + rng.randint(0, 3)
+    operators.append("^{}-{}".format(min_len, min_len + rng.randint(0, 3)))
+    # only the ranges whose more specifics can be expanded
+    if network.max_prefixlen - network.prefixlen <= 8:
+        operators.extend(["^-", "^+"])
+    return "{}{}".format(network, rng.choice(operators))
+
+
+def random_dict_tree(rng, rule_count):
+    dict_tree = {
+        "v4": {},
+        "v6": {},
+        "confs": [],
+        "conf_ids": [],
+        "timestamp": rng.random(),
+    }
+    for rule in range(rule_count):
+        for _ in range(rng.randint(1, 3)):
+            network = random_prefix(rng, rng.choice(BASE_NETWORKS))
+            prefixtree.add_prefix_range(
+                dict_tree, random_prefix_range(rng, network), rule
+            )
+        dict_tree["confs"].append({"origin_asns": [rng.randint(1, 3)]})
+        dict_tree["conf_ids"].append("conf-{}".format(rng.randint(1, 3)))
+    return dict_tree
+
+
+def expand_dict_tree(dict_tree):
+    """
+    Returns the oracle of a prefix tree: all the configured prefixes, i.e.,
+    the configured prefixes and the more specifics of the prefix ranges,
+    with the rules that configure them (once per prefix range, as in the
+    expanded prefix trees of translate_rfc2622).
+    """
+    expanded_tree = {}
+    for ip_version in ["v4", "v6"]:
+        for base_prefix, base_node in dict_tree[ip_version].items():
+            network = ip_network(base_prefix)
+            for rule, min_len, max_len in base_node["ranges"]:
+                for prefix_len in range(min_len, max_len + 1):
+                    for subnet in network.subnets(new_prefix=prefix_len):
+                        expanded_tree.setdefault(subnet, []).append(rule)
+    return expanded_tree
+
+
+def lookup_expanded_tree(expanded_tree, prefix):
+    network = ip_network(prefix)
+    for prefix_len in range(network.prefixlen, -1, -1):
+        supernet = network.supernet(new_prefix=prefix_len)
+        if supernet in expanded_tree:
+            return str(supernet), sorted(expanded_tree[supernet])
+    return None, []
+
+
+def covered_by_prefixes(prefixes, prefix, granularity):
+    """
+    Checks whether the address space of a prefix is covered by a list of
+    prefixes, at the granularity of the most specific random prefix.
+    """
+    networks = [ip_network(p) for p in prefixes]
+    network = ip_network(prefix)
+    subnets = [network]
+    if network.prefixlen < granularity:
+        subnets = network.subnets(new_prefix=granularity)
+    return all(any(subnet.subnet_of(n) for n in networks) for subnet in subnets)
+
+
+def prefix_tree_contents(prefix_tree):
+    contents = dict(prefix_tree)
+    for ip_version in ["v4", "v6"]:
+        contents[ip_version] = {
+            prefix: prefix_tree[ip_version][prefix]
+            for prefix in prefix_tree[ip_version]
+        }
+    return contents
+
+
+class PrefixTreeTester(unittest.TestCase):
+    def test_find_prefix_range_rules(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            dict_tree = random_dict_tree(rng, rng.randint(1, 6))
+            prefix_tree = prefixtree.dict_to_prefix_tree(dict_tree)
+            expanded_tree = expand_dict_tree(dict_tree)
+            for base_network in BASE_NETWORKS:
+                ip_version = "v{}".format(base_network.version)
+                for _ in range(200):
+                    # also less specifics and prefixes outside of the base network
+                    prefix = random_prefix(rng, base_network.supernet(2))
+                    prefix = prefix.supernet(
+                        new_prefix=max(prefix.prefixlen - rng.randint(0, 2), 0)
+                    )
+                    if rng.random() < 0.5:
+                        prefix = next(
+                            prefix.subnets(
+                                new_prefix=min(
+                                    prefix.prefixlen + rng.randint(0, 10),
+                                    prefix.max_prefixlen,
+                                )
+                            )
+                        )
+                    self.assertEqual(
+                        prefixtree.find_prefix_range_rules(
+                            prefix_tree[ip_version], str(prefix)
+                        ),
+                        lookup_expanded_tree(expanded_tree, prefix),
+                        prefix,
+                    )
+            self.assertEqual(
+                prefixtree.count_prefix_ranges(prefix_tree["v4"])
+                + prefixtree.count_prefix_ranges(prefix_tree["v6"]),
+                len(expanded_tree),
+            )
+
+    def test_apply_prefix_tree_delta(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            old_dict_tree = random_dict_tree(rng, rng.randint(1, 6))
+            new_dict_tree = copy.deepcopy(old_dict_tree)
+            for ip_version in ["v4", "v6"]:
+                for prefix in list(new_dict_tree[ip_version]):
+                    if rng.random() < 0.3:
+                        del new_dict_tree[ip_version][prefix]
+            added_tree = random_dict_tree(rng, rng.randint(0, 4))
+            for ip_version in ["v4", "v6"]:
+                for base_node in added_tree[ip_version].values():
+                    for rule, min_len, max_len in base_node["ranges"]:
+                        new_dict_tree[ip_version].setdefault(
+                            base_node["prefix"],
+                            {
+                                "prefix": base_node["prefix"],
+                                "prefix_len": base_node["prefix_len"],
+                                "ranges": [],
+                            },
+                        )["ranges"].append([rule, min_len, max_len])
+            del new_dict_tree["confs"][rng.randint(0, len(new_dict_tree["confs"])) :]
+            new_dict_tree["confs"].extend(added_tree["confs"])
+            new_dict_tree["conf_ids"] = added_tree["conf_ids"]
+            new_dict_tree["timestamp"] = added_tree["timestamp"]
+
+            prefix_tree = prefixtree.dict_to_prefix_tree(copy.deepcopy(old_dict_tree))
+            prefixtree.apply_prefix_tree_delta(
+                prefix_tree,
+                prefixtree.compute_prefix_tree_delta(old_dict_tree, new_dict_tree),
+            )
+            self.assertEqual(
+                prefix_tree_contents(prefix_tree),
+                prefix_tree_contents(
+                    prefixtree.dict_to_prefix_tree(copy.deepcopy(new_dict_tree))
+                ),
+            )
+
+    def test_aggregate_prefixes(self):
+        # adjacent
+        self.assertEqual(
+            prefixtree.aggregate_prefixes(["10.0.0.0/25", "10.0.0.128/25"]),
+            ["10.0.0.0/24"],
+        )
+        self.assertEqual(
+            prefixtree.aggregate_prefixes(["2001:db8::/33", "2001:db8:8000::/33"]),
+            ["2001:db8::/32"],
+        )
+        # overlapping
+        self.assertEqual(
+            prefixtree.aggregate_prefixes(
+                ["10.0.0.0/24", "10.0.0.0/25", "10.0.0.64/26"]
+            ),
+            ["10.0.0.0/24"],
+        )
+        # neither adjacent nor overlapping
+        self.assertEqual(
+            prefixtree.aggregate_prefixes(["10.0.0.0/25", "10.0.1.0/25"]),
+            ["10.0.0.0/25", "10.0.1.0/25"],
+        )
+        # 25% of the address space of 10.0.0.0/24 is over-approximated
+        for overapproximation, aggregated_prefixes in [
+            (0, ["10.0.0.0/25", "10.0.0.128/26"]),
+            (20, ["10.0.0.0/25", "10.0.0.128/26"]),
+            (25, ["10.0.0.0/24"]),
+        ]:
+            self.assertEqual(
+                prefixtree.aggregate_prefixes(
+                    ["10.0.0.0/25", "10.0.0.128/26"], overapproximation
+                ),
+                aggregated_prefixes,
+            )
+
+    def test_aggregate_prefixes_lookups(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            # mixed-family (RFC2622) prefix ranges
+            dict_tree = random_dict_tree(rng, rng.randint(1, 6))
+            prefix_tree = prefixtree.dict_to_prefix_tree(dict_tree)
+            expanded_tree = expand_dict_tree(dict_tree)
+            for base_network in BASE_NETWORKS:
+                ip_version = "v{}".format(base_network.version)
+                granularity = base_network.prefixlen + 6
+                prefixes = list(prefix_tree[ip_version])
+                aggregated_prefixes = prefixtree.aggregate_prefixes(prefixes)
+                overapproximated_prefixes = prefixtree.aggregate_prefixes(prefixes, 50)
+                # every configured prefix is still monitored
+                for configured_prefix in expanded_tree:
+                    if configured_prefix.version == base_network.version:
+                        self.assertTrue(
+                            covered_by_prefixes(
+                                aggregated_prefixes, configured_prefix, granularity
+                            )
+                        )
+                for _ in range(200):
+                    prefix = random_prefix(rng, base_network.supernet(2))
+                    covered = covered_by_prefixes(prefixes, prefix, granularity)
+                    # a prefix is monitored as a whole if it is covered by the
+                    # configured prefixes, and only then
+                    self.assertEqual(
+                        covered_by_prefixes(aggregated_prefixes, prefix, 0),
+                        covered,
+                        prefix,
+                    )
+                    if covered:
+                        self.assertTrue(
+                            covered_by_prefixes(overapproximated_prefixes, prefix, 0),
+                            prefix,
+                        )
+
+    @patch.object(prefixtree, "PREFIXTREE_SNAPSHOT_FILE", "")
+    def test_configure_prefixtree_confs_before_version(self):
+        shared_memory_manager_dict = prefixtree.PrefixTree().shared_memory_manager_dict
+        config = {
+            "timestamp": 1,
+            "rules": [
+                {"prefixes": ["10.0.0.0/24"], "origin_asns": [1], "neighbors": [2]}
+            ],
+        }
+        publish_prefix_tree = prefixtree.publish_prefix_tree
+        served_confs = []
+
+        def read_confs_upon_version_change(*args):
+            publish_prefix_tree(*args)
+            if args[1] == "prefix_tree":
+                # as a data worker that sees the new version right away
+                prefix_tree = prefixtree.dict_to_prefix_tree(
+                    shared_memory_manager_dict["prefix_tree"]
+                )
+                prefix_node = prefixtree.lookup_prefix_node_reference(
+                    prefix_tree, "10.0.0.0/24"
+                )
+                served_confs.append(
+                    (
+                        prefix_node,
+                        dict(shared_memory_manager_dict["prefix_tree_confs"]),
+                    )
+                )
+
+        with patch.object(
+            prefixtree, "publish_prefix_tree", read_confs_upon_version_change
+        ):
+            self.assertTrue(
+                prefixtree.configure_prefixtree(config, shared_memory_manager_dict)[
+                    "success"
+                ]
+            )
+        self.assertEqual(len(served_confs), 1)
+        prefix_node, prefix_tree_confs = served_confs[0]
+        self.assertEqual(prefix_tree_confs["timestamp"], prefix_node["timestamp"])
+        for conf_id in prefix_node["conf_ids"]:
+            self.assertIn(conf_id, prefix_tree_confs["confs"])
+
+    def test_configure_prefixtree_snapshot_across_parses(self):
+        raw_config = "rules:\n- prefixes: [10.0.0.0/24]\n  origin_asns: [1]\n"
+        parses = []
+        for timestamp, comment in [(1, "# first parse\n"), (2, "# second parse\n")]:
+            # as parsed by configuration, each time with a new timestamp
+            parses.append(
+                {
+                    "rules": [
+                        {
+                            "prefixes": ["10.0.0.0/24"],
+                            "origin_asns": [1],
+                            "neighbors": [2],
+                        }
+                    ],
+                    "timestamp": timestamp,
+                    "raw_config": comment + raw_config,
+                }
+            )
+        self.assertEqual(
+            prefixtree.get_config_hash(parses[0]),
+            prefixtree.get_config_hash(parses[1]),
+        )
+
+        with tempfile.TemporaryDirectory() as snapshot_dir, patch.object(
+            prefixtree,
+            "PREFIXTREE_SNAPSHOT_FILE",
+            os.path.join(snapshot_dir, "prefixtree.pickle"),
+        ):
+            shared_memory_manager_dict = (
+                prefixtree.PrefixTree().shared_memory_manager_dict
+            )
+            self.assertTrue(
+                prefixtree.configure_prefixtree(parses[0], shared_memory_manager_dict)[
+                    "success"
+                ]
+            )
+            compiled_prefix_tree = shared_memory_manager_dict["prefix_tree"]
+
+            # e.g., upon restart, the snapshot of the first parse is loaded
+            shared_memory_manager_dict = (
+                prefixtree.PrefixTree().shared_memory_manager_dict
+            )
+            with patch.object(prefixtree, "compile_prefixtree") as compile_prefixtree:
+                self.assertTrue(
+                    prefixtree.configure_prefixtree(
+                        parses[1], shared_memory_manager_dict
+                    )["success"]
+                )
+            compile_prefixtree.assert_not_called()
+            loaded_prefix_tree = shared_memory_manager_dict["prefix_tree"]
+            self.assertEqual(loaded_prefix_tree["timestamp"], 2)
+            self.assertEqual(
+                shared_memory_manager_dict["prefix_tree_confs"]["timestamp"], 2
+            )
+            self.assertEqual(
+                dict(loaded_prefix_tree, timestamp=1), compiled_prefix_tree
+            )
+
+    @patch.object(prefixtree, "PREFIXTREE_SNAPSHOT_FILE", "")
+    @patch("prefixtree.ping_redis", MagicMock())
+    @patch("prefixtree.PrefixTreeDataWorker.producer")
+    def test_handle_autoconf_updates(self, mock_producer):
+        shared_memory_manager_dict = prefixtree.PrefixTree().shared_memory_manager_dict
+        config = {
+            "timestamp": 1,
+            "rules": [
+                {"prefixes": ["10.0.0.0/24"], "origin_asns": [1], "neighbors": [2]}
+            ],
+        }
+        prefixtree.configure_prefixtree(config, shared_memory_manager_dict)
+        pool = prefixtree.PrefixTreeDataWorkerPool(shared_memory_manager_dict)
+        pool.load_prefix_trees()
+        bgp_updates = [
+            # seen before
+            {"key": "1", "prefix": "10.0.0.0/24", "type": "A", "path": [3, 5]},
+            # not to be processed
+            {"key": "2", "prefix": "10.0.0.0/24", "type": "A", "path": [3, 5]},
+            # already configured
+            {"key": "3", "prefix": "10.0.0.0/24", "type": "A", "path": [3, 1]},
+            {"key": "4", "prefix": "10.0.0.0/24", "type": "A", "path": [3, 5]},
+            {"key": "5", "prefix": "10.0.1.0/24", "type": "A", "path": [3, 1]},
+        ]
+        # SMISMEMBER and its SISMEMBER fallback (redis < 6.2)
+        for redis_smismember in [True, False]:
+            redis_instance = fakeredis.FakeStrictRedis()
+            redis_instance.set("1", "1")
+            redis_instance.sadd("autoconf-update-keys-to-process", "1", "3", "4", "5")
+            with patch("redis.Redis", MagicMock(return_value=redis_instance)):
+                data_worker = prefixtree.PrefixTreeDataWorker(
+                    MagicMock(),
+                    shared_memory_manager_dict,
+                    pool.prefix_trees,
+                    MagicMock(),
+                    "test",
+                )
+            data_worker.redis_smismember = redis_smismember
+            message = MagicMock()
+            message.payload = copy.deepcopy(bgp_updates)
+
+            data_worker.handle_autoconf_updates(message)
+
+            self.assertTrue(message.ack.called)
+            filtered_bgp_updates = mock_producer.publish.call_args[0][0]
+            self.assertEqual(
+                [bgp_update["key"] for bgp_update in filtered_bgp_updates], ["4", "5"]
+            )
+            self.assertEqual(
+                redis_instance.smembers("autoconf-update-keys-to-process"),
+                {b"1", b"4", b"5"},
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -49,6 +49,9 @@ update_to_type = {"announcements": "A", "withdrawals": "W"}
 update_types = ["announcements", "withdrawals"]
 redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
 SERVICE_NAME = "riperistap"
+# publish the BGP updates of each RIS message as one batch (list) message
+# instead of one message per update (prefixtree accepts both)
+RIS_BATCH_UPDATES = os.getenv("RIS_BATCH_UPDATES", "false") == "true"
 
 
 def start_data_worker(shared_memory_manager_dict):
@@ -430,6 +433,7 @@ class RipeRisTapDataWorker:
                                 norm_ris_msgs = self.normalize_ripe_ris(
                                     msg, prefix_tree
                                 )
+                                batch = []
                                 for norm_ris_msg in norm_ris_msgs:
                                     redis.set(
                                         "ris_seen_bgp_update",
@@ -444,6 +448,9 @@ class RipeRisTapDataWorker:
                                             for norm_path_msg in norm_path_msgs:
                                                 key_generator(norm_path_msg)
                                                 log.debug(norm_path_msg)
+                                                if RIS_BATCH_UPDATES:
+                                                    batch.append(norm_path_msg)
+                                                    continue
                                                 producer.publish(
                                                     norm_path_msg,
                                                     exchange=self.update_exchange,
@@ -461,6 +468,13 @@ class RipeRisTapDataWorker:
                                                 norm_ris_msg
                                             )
                                         )
+                                if batch:
+                                    producer.publish(
+                                        batch,
+                                        exchange=self.update_exchange,
+                                        routing_key="update",
+                                        serializer="ujson",
+                                    )
                         except Exception:
                             log.exception("exception")
                             log.error("exception message {}".format(data))
@@ -22,7 +22,7 @@ CREATE TRIGGER db_details_no_delete
 BEFORE DELETE ON db_details
 FOR EACH ROW EXECUTE PROCEDURE db_version_no_delete();
 
-INSERT INTO db_details (version, upgraded_on) VALUES (24, now());
+INSERT INTO db_details (version, upgraded_on) VALUES (26, now());
 
 CREATE TABLE IF NOT EXISTS bgp_updates (
     key VARCHAR ( 32 ) NOT NULL,
@@ -48,6 +48,20 @@ ON bgp_updates(prefix, peer_asn, type, hijack_key);
 CREATE INDEX handled_idx
 ON bgp_updates(handled);
 
+CREATE INDEX key_idx
+ON bgp_updates(key);
+
+CREATE INDEX withdrawn_peer_idx
+ON bgp_updates(prefix, peer_asn, timestamp DESC)
+WHERE type = 'W' AND handled = true;
+
+CREATE INDEX hijack_key_gin_idx
+ON bgp_updates USING GIN (hijack_key);
+
+CREATE INDEX hijack_updates_idx
+ON bgp_updates(type)
+WHERE handled = true AND hijack_key <> ARRAY[]::text[];
+
 SELECT create_hypertable('bgp_updates', 'timestamp', if_not_exists => TRUE);
 
 create trigger send_insert_test_event
@@ -256,7 +270,7 @@ RETURNS SETOF view_bgpupdates AS $$
     SELECT *
     FROM view_bgpupdates
     WHERE
-        key = ANY(view_bgpupdates.hijack_key)
+        view_bgpupdates.hijack_key @> ARRAY[key]
 $$ LANGUAGE sql STABLE;
 
 CREATE FUNCTION search_bgpupdates_by_as_path_and_hijack_key(key text, as_paths BIGINT[])
@@ -264,5 +278,5 @@ CREATE FUNCTION search_bgpupdates_by_as_path_and_hijack_key(key text, as_paths B
     SELECT *
     FROM view_bgpupdates
     WHERE
-        key = ANY(view_bgpupdates.hijack_key) and as_paths <@ view_bgpupdates.as_path
+        view_bgpupdates.hijack_key @> ARRAY[key] and as_paths <@ view_bgpupdates.as_path
 $$ LANGUAGE sql STABLE;
@@ -0,0 +1,156 @@
+"""
+Benchmark of the bulk insertion of BGP updates into PostgreSQL.
+
+Inserts a synthetic stream of bgp_updates rows, in batches of the size that
+the database bulk updater flushes, into a scratch copy of the bgp_updates
+table (a hypertable, if TimescaleDB is installed) through:
+
+    values:  INSERT ... VALUES with psycopg2 execute_values (page size 1000)
+    copy:    COPY into a temporary staging table, then INSERT ... SELECT
+             ON CONFLICT DO NOTHING (artemis_utils.db.DB.copy_values)
+
+and reports the rows/sec of each. It needs an initialized ARTEMIS database,
+e.g., the postgres container of docker-compose.testdetection.yaml:
+
+    DB_HOST=localhost python testing/detection/insertbenchmark.py --rows 200000
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import psycopg2
+import ujson as json
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+# the artemis_utils of this tree, which provides DB.copy_values
+sys.path.insert(0, os.path.join(TESTING_DIR, "..", "..", "utils"))
+
+from artemis_utils.db import DB  # noqa: E402
+from artemis_utils.envvars import DB_HOST  # noqa: E402
+from artemis_utils.envvars import DB_NAME  # noqa: E402
+from artemis_utils.envvars import DB_PASS  # noqa: E402
+from artemis_utils.envvars import DB_PORT  # noqa: E402
+from artemis_utils.envvars import DB_USER  # noqa: E402
+
+COLUMNS = [
+    "prefix",
+    "key",
+    "origin_as",
+    "peer_asn",
+    "as_path",
+    "service",
+    "type",
+    "communities",
+    "timestamp",
+    "hijack_key",
+    "handled",
+    "matched_prefix",
+    "orig_path",
+]
+
+
+def synthesize_rows(count, seed):
+    rng = random.Random(seed)
+    start = datetime.datetime.now() - datetime.timedelta(hours=1)
+    rows = []
+    for i in range(count):
+        path = [rng.randint(1, 65000) for _ in range(rng.randint(2, 8))]
+        prefix = "10.{}.{}.0/24".format(rng.randint(0, 255), rng.randint(0, 255))
+        rows.append(
+            (
+                prefix,
+                "{:032x}".format(i),
+                path[-1],
+                path[0],
+                path,
+                "ripe-ris|rrc{:02d}".format(rng.randint(0, 25)),
+                "A",
+                json.dumps([(path[0], rng.randint(0, 65535))]),
+                start + datetime.timedelta(milliseconds=i),
+                [],
+                False,
+                "10.0.0.0/8",
+                json.dumps(None),
+            )
+        )
+    return rows
+
+
+def insert_values(db, table, batch):
+    db.execute_values(
+        "INSERT INTO {} ({}) VALUES %s".format(table, ", ".join(COLUMNS)),
+        batch,
+        page_size=1000,
+    )
+
+
+def insert_copy(db, table, batch):
+    db.copy_values(table, COLUMNS, (row for row in batch))
+
+
+def run(db, table, rows, batch_size, insert):
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        insert(db, table, rows[i : i + batch_size])
+    return len(rows) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ARTEMIS bgp_updates insertion benchmark"
+    )
+    parser.add_argument("--rows", type=int, default=100000, help="rows to insert")
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=10000,
+        help="rows per bulk update (as flushed by the database bulk updater)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="synthetic rows seed")
+    parser.add_argument(
+        "--table", default="bgp_updates_benchmark", help="scratch table to create"
+    )
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT, database=DB_NAME
+    )
+    connection.autocommit = True
+    cursor = connection.cursor()
+    db = DB(
+        application_name="insert-benchmark",
+        user=DB_USER,
+        password=DB_PASS,
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+    )
+    rows = synthesize_rows(args.rows, args.seed)
+    print("{} rows in batches of {}".format(len(rows), args.batch))
+    try:
+        cursor.execute(
+            "CREATE TABLE {} (LIKE bgp_updates INCLUDING ALL)".format(args.table)
+        )
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'")
+        if cursor.fetchone():
+            cursor.execute("SELECT create_hypertable(%s, 'timestamp')", (args.table,))
+        for name, insert in [("values", insert_values), ("copy", insert_copy)]:
+            cursor.execute("TRUNCATE {}".format(args.table))
+            rate = run(db, args.table, rows, args.batch, insert)
+            cursor.execute("SELECT count(*) FROM {}".format(args.table))
+            print(
+                "{:<8} {:>12.0f} rows/sec ({} rows stored)".format(
+                    name, rate, cursor.fetchone()[0]
+                )
+            )
+    finally:
+        db.close()
+        cursor.execute("DROP TABLE IF EXISTS {}".format(args.table))
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
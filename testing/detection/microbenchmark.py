@@ -0,0 +1,144 @@
+"""
+Offline microbenchmark of the detection hot path.
+
+Builds the prefix tree of a detection test configuration, annotates the
+announcements of the detection test corpus with their prefix nodes and
+measures how many updates/sec DetectionDataWorker.handle_bgp_update
+can classify, without any RabbitMQ, Redis or database round trips.
+
+To compare against another revision of the detection module:
+
+    git show <rev>:backend-services/detection/core/detection.py > /tmp/detection_before.py
+    python testing/detection/microbenchmark.py --baseline /tmp/detection_before.py
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import time
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import ujson as json
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(TESTING_DIR, "..", "..", "backend-services")
+for service in ["configuration", "prefixtree", "detection"]:
+    sys.path.insert(0, os.path.join(BACKEND_DIR, service, "core"))
+# the artemis_utils of this tree, which also serves the baseline revisions
+sys.path.insert(0, os.path.join(TESTING_DIR, "..", "..", "utils"))
+
+import configuration  # noqa: E402
+import detection  # noqa: E402
+import prefixtree  # noqa: E402
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_prefix_tree(config_file):
+    with open(config_file) as f:
+        config, ok, error = configuration.parse(f.read(), yaml=True)
+    if not ok:
+        raise ValueError("invalid configuration '{}': {}".format(config_file, error))
+    return prefixtree.dict_to_prefix_tree(
+        prefixtree.compile_prefixtree(config)["prefix_tree"]
+    )
+
+
+def load_corpus(testfiles_dir, prefix_tree):
+    corpus = []
+    for testfile in sorted(os.listdir(testfiles_dir)):
+        with open(os.path.join(testfiles_dir, testfile)) as f:
+            events = json.load(f)
+        for event in events:
+            update = event["send"]
+            if update["type"] != "A":
+                continue
+            try:
+                prefix_node = prefixtree.lookup_prefix_node(
+                    prefix_tree, update["prefix"]
+                )
+            except (KeyError, ValueError):
+                prefix_node = None
+            if prefix_node is None:
+                continue
+            update = dict(update)
+            update["prefix_node"] = prefix_node
+            corpus.append(update)
+    return corpus
+
+
+def make_worker(module):
+    with patch("redis.Redis", MagicMock()), patch.object(
+        module, "ping_redis", MagicMock()
+    ), patch.object(module, "wait_data_worker_dependencies", MagicMock()):
+        worker = module.DetectionDataWorker(MagicMock(), {})
+
+    hijacks = []
+
+    def commit_hijack(monitor_event, hijacker, hij_dimensions):
+        hijacks.append((monitor_event["key"], hijacker, "|".join(hij_dimensions)))
+
+    worker.commit_hijack = commit_hijack
+    worker.mark_handled = lambda monitor_event: None
+    worker.gen_implicit_withdrawal = lambda monitor_event: None
+    return worker, hijacks
+
+
+def run(module, corpus, rounds):
+    worker, hijacks = make_worker(module)
+    handle_bgp_update = worker.handle_bgp_update
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for update in corpus:
+            handle_bgp_update(dict(update))
+    elapsed = time.perf_counter() - start
+    return len(corpus) * rounds / elapsed, hijacks[: len(hijacks) // rounds]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ARTEMIS detection microbenchmark")
+    parser.add_argument(
+        "--config",
+        default=os.path.join(TESTING_DIR, "configs", "config.yaml"),
+        help="configuration file used to build the prefix tree",
+    )
+    parser.add_argument(
+        "--testfiles",
+        default=os.path.join(TESTING_DIR, "testfiles"),
+        help="directory of the BGP update corpus",
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=500, help="passes over the corpus"
+    )
+    parser.add_argument(
+        "--baseline", help="detection.py of another revision to compare against"
+    )
+    args = parser.parse_args()
+
+    prefix_tree = build_prefix_tree(args.config)
+    corpus = load_corpus(args.testfiles, prefix_tree)
+    print("{} annotated announcements x {} rounds".format(len(corpus), args.rounds))
+
+    after_rate, after_hijacks = run(detection, corpus, args.rounds)
+    if args.baseline:
+        baseline = load_module("detection_baseline", args.baseline)
+        before_rate, before_hijacks = run(baseline, corpus, args.rounds)
+        print("before: {:>12.0f} updates/sec".format(before_rate))
+        print("after:  {:>12.0f} updates/sec".format(after_rate))
+        print("speedup: {:.2f}x".format(after_rate / before_rate))
+        if before_hijacks != after_hijacks:
+            print("ERROR: hijack decisions differ between the two revisions")
+            sys.exit(1)
+        print("hijack decisions match ({} hijacks)".format(len(after_hijacks)))
+    else:
+        print("{:.0f} updates/sec".format(after_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+Offline replay of the ARTEMIS detection pipeline.
+
+Runs the stages that a BGP update goes through from the monitors to the
+hijacks table in a single process:
+
+    prefixtree (annotate) -> database (store) -> detection
+        -> database (hijack/handled updates) -> database bulk updater
+
+against in-memory stand-ins of the external systems:
+
+    redis:       fakeredis (with Lua through lupa), so the hijack scripts run as-is
+    RabbitMQ:    a local bus that routes published messages to the consuming stage
+    PostgreSQL:  a recorder of the statements and rows of the bulk updater
+
+It replays the detection testfiles (or a synthetic stream) and reports
+updates/sec, per-stage latency percentiles and the hijacks produced; the
+hijacks can be saved and compared against those of another revision:
+
+    python testing/detection/replay.py --save /tmp/hijacks.json
+    git checkout <rev>
+    python testing/detection/replay.py --compare /tmp/hijacks.json
+
+Requirements (besides those of the services): pip install fakeredis lupa
+"""
+import argparse
+import collections
+import datetime
+import os
+import queue
+import random
+import sys
+import time
+from unittest.mock import patch
+
+import ujson as json
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(TESTING_DIR, "..", "..", "backend-services")
+for service in ["configuration", "prefixtree", "detection", "database"]:
+    sys.path.insert(0, os.path.join(BACKEND_DIR, service, "core"))
+# the artemis_utils of this tree, which provides the shared redis hijack helpers
+sys.path.insert(0, os.path.join(TESTING_DIR, "..", "..", "utils"))
+
+import database  # noqa: E402
+import detection  # noqa: E402
+import fakeredis  # noqa: E402
+import prefixtree  # noqa: E402
+from microbenchmark import build_prefix_tree  # noqa: E402
+
+HIJACK_FIELDS = [
+    "prefix",
+    "hijack_as",
+    "type",
+    "configured_prefix",
+    "num_asns_inf",
+    "community_annotation",
+    "rpki_status",
+]
+
+
+class LocalMessage:
+    """
+    Delivered message, as seen by a consumer callback.
+    """
+
+    def __init__(self, payload, headers=None):
+        self.payload = payload
+        self.headers = headers or {}
+
+    def ack(self):
+        pass
+
+
+class LocalBus:
+    """
+    In-process stand-in of RabbitMQ: it is both the channel that the
+    exchanges are declared on and the producer of every worker.
+    Published messages are serialized (as they would be on the wire) and
+    queued until the replay delivers them.
+    """
+
+    def __init__(self):
+        self.messages = collections.deque()
+        self.published = collections.Counter()
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def publish(self, body, exchange=None, routing_key=None, headers=None, **kwargs):
+        exchange = getattr(exchange, "name", exchange)
+        if exchange.endswith("-hashing"):
+            self.published[(exchange, "*")] += 1
+        else:
+            self.published[(exchange, routing_key)] += 1
+        self.messages.append((exchange, routing_key, json.dumps(body), headers))
+
+
+class RecordingDB:
+    """
+    In-memory stand-in of artemis_utils.db.DB; reads return no rows and
+    writes are only counted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.statements = collections.Counter()
+        self.rows = collections.Counter()
+
+    def _record(self, query, rows):
+        statement = " ".join(query.split()[:3])
+        self.statements[statement] += 1
+        self.rows[statement] += rows
+
+    def execute(self, query, vals=None, fetch_one=False, **kwargs):
+        self._record(query, 1)
+        return None if fetch_one else []
+
+    def execute_batch(self, query, vals, **kwargs):
+        self._record(query, len(vals))
+
+    def execute_values(self, query, vals, **kwargs):
+        self._record(query, len(vals))
+
+    def copy_values(self, table, columns, vals, **kwargs):
+        self._record("INSERT INTO {}".format(table), len(list(vals)))
+        return 0
+
+
+class OfflineDetectionDataWorker(detection.DetectionDataWorker):
+    @property
+    def producer(self):
+        return self.connection
+
+
+class OfflineDatabaseDataWorker(database.DatabaseDataWorker):
+    @property
+    def producer(self):
+        return self.connection
+
+
+def make_workers(bus):
+    server = fakeredis.FakeServer()
+    shared_memory_manager_dict = {
+        "data_worker_running": True,
+        "service_reconfiguring": False,
+        "monitored_prefixes": [],
+        "monitors": {},
+        "configured_prefix_count": 0,
+        "config_timestamp": -1,
+    }
+    with patch(
+        "redis.Redis", lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+    ), patch.object(database, "DB", RecordingDB), patch.object(
+        database, "wait_data_worker_dependencies", lambda dependencies: None
+    ), patch.object(
+        detection, "wait_data_worker_dependencies", lambda dependencies: None
+    ), patch.object(
+        database.mp, "Process"
+    ), patch.object(
+        database.mp, "Queue", queue.Queue
+    ):
+        database_worker = OfflineDatabaseDataWorker(bus, shared_memory_manager_dict)
+        detection_worker = OfflineDetectionDataWorker(bus, {})
+    # the bulk updater runs in the replay loop instead of its own process
+    bulk_updater = database_worker.bulk_updater
+    bulk_updater.redis = database_worker.redis
+    bulk_updater.redis_add_hijack_update_keys = bulk_updater.redis.register_script(
+        database.HIJACK_ADD_UPDATE_KEYS_SCRIPT
+    )
+    bulk_updater.redis_purge_hijack = bulk_updater.redis.register_script(
+        database.HIJACK_PURGE_SCRIPT
+    )
+    return detection_worker, database_worker, bulk_updater
+
+
+def load_testfiles(testfiles_dir):
+    updates = []
+    for testfile in sorted(os.listdir(testfiles_dir)):
+        with open(os.path.join(testfiles_dir, testfile)) as f:
+            for event in json.load(f):
+                # update keys are only unique per testfile
+                update = dict(event["send"])
+                update["key"] = "{}-{}".format(testfile, update["key"])
+                updates.append(update)
+    return updates
+
+
+def synthesize_updates(prefix_tree, count, seed):
+    """
+    Generates a stream of exact/sub-prefix announcements and withdrawals of
+    the configured (IPv4) prefixes, from legal or random (hijacker) origins.
+    """
+    rng = random.Random(seed)
+    # the least specific configured prefix of every (IPv4) base prefix
+    prefix_nodes = [
+        prefixtree.lookup_prefix_node(
+            prefix_tree,
+            "{}/{}".format(
+                prefix.split("/")[0],
+                min(min_len for _, min_len, _ in prefix_tree["v4"][prefix]["ranges"]),
+            ),
+        )
+        for prefix in prefix_tree["v4"]
+    ]
+    peers = [rng.randint(1000, 65000) for _ in range(50)]
+    updates = []
+    for i in range(count):
+        prefix_node = rng.choice(prefix_nodes)
+        conf = rng.choice(prefix_node["data"]["confs"])
+        network, prefix_len = prefix_node["prefix"].split("/")
+        prefix = prefix_node["prefix"]
+        if rng.random() < 0.3 and int(prefix_len) < 32:
+            prefix = "{}/{}".format(network, int(prefix_len) + 1)
+        origins = [asn for asn in conf["origin_asns"] if isinstance(asn, int)]
+        origin = rng.choice(origins or [1])
+        if rng.random() < 0.1:
+            origin = rng.randint(60000, 60100)
+        peer_asn = rng.choice(peers)
+        path = [peer_asn]
+        path.extend(rng.randint(3000, 3100) for _ in range(rng.randint(0, 3)))
+        neighbors = [asn for asn in conf["neighbors"] if isinstance(asn, int)]
+        if neighbors:
+            path.append(rng.choice(neighbors))
+        path.append(origin)
+        updates.append(
+            {
+                "key": "synthetic-{}".format(i),
+                "timestamp": i,
+                "orig_path": [],
+                "communities": [],
+                "service": "synthetic",
+                "type": "W" if rng.random() < 0.05 else "A",
+                "path": path,
+                "prefix": prefix,
+                "peer_asn": peer_asn,
+            }
+        )
+    return updates
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return "-"
+    return " ".join(
+        "p{}={:.1f}us".format(
+            q, 1e6 * latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))]
+        )
+        for q in [50, 90, 99]
+    )
+
+
+class Replay:
+    def __init__(self, prefix_tree, bulk_every):
+        self.prefix_tree = prefix_tree
+        self.bulk_every = bulk_every
+        self.bus = LocalBus()
+        (
+            self.detection_worker,
+            self.database_worker,
+            self.bulk_updater,
+        ) = make_workers(self.bus)
+        # the confs of the prefix node references, as fetched from prefixtree
+        self.detection_worker.prefix_node_confs = dict(
+            zip(prefix_tree["conf_ids"], prefix_tree["confs"])
+        )
+        self.detection_worker.prefix_node_confs_timestamp = prefix_tree["timestamp"]
+        self.latencies = collections.defaultdict(list)
+        self.hijacks = {}
+        self.routes = {
+            ("bgp-update", "update"): self.annotate,
+            ("bgp-update", "withdraw"): self.database_worker.handle_withdraw_update,
+            (
+                "handled-update",
+                "update",
+            ): self.database_worker.handle_handled_bgp_update,
+        }
+
+    def timed(self, stage, callback, *args):
+        start = time.perf_counter()
+        result = callback(*args)
+        self.latencies[stage].append(time.perf_counter() - start)
+        return result
+
+    def annotate(self, message):
+        # prefixtree: annotate the update and hand it to the database
+        bgp_update = message.payload
+        prefix_node = self.timed(
+            "prefixtree",
+            prefixtree.lookup_prefix_node_reference,
+            self.prefix_tree,
+            bgp_update["prefix"],
+        )
+        if prefix_node is None:
+            return
+        bgp_update["prefix_node"] = prefix_node
+        self.timed(
+            "database-store",
+            self.database_worker.handle_bgp_update,
+            LocalMessage(bgp_update),
+        )
+        # stored update, as published by the database upon insertion
+        stored_update = dict(bgp_update)
+        stored_update["as_path"] = stored_update.pop("path")
+        stored_update["timestamp"] = str(
+            datetime.datetime.fromtimestamp(stored_update["timestamp"])
+        )
+        stored_update["communities"] = [
+            [community["asn"], community["value"]]
+            for community in stored_update["communities"]
+        ]
+        self.bus.publish(
+            stored_update,
+            exchange="bgp-update-hashing",
+            routing_key=prefix_node["prefix"],
+            headers={"type": "stored-update-with-prefix-node"},
+        )
+
+    def deliver(self):
+        while self.bus.messages:
+            exchange, routing_key, body, headers = self.bus.messages.popleft()
+            message = LocalMessage(json.loads(body), headers)
+            if exchange == "bgp-update-hashing":
+                self.timed(
+                    "detection", self.detection_worker.handle_hashed_update, message
+                )
+            elif exchange == "hijack-hashing":
+                self.hijacks[routing_key] = {
+                    field: message.payload.get(field) for field in HIJACK_FIELDS
+                }
+                self.hijacks[routing_key]["peers_seen"] = sorted(
+                    message.payload["peers_seen"]
+                )
+                self.timed(
+                    "database-hijack",
+                    self.database_worker.handle_hijack_update,
+                    message,
+                )
+            elif (exchange, routing_key) in self.routes:
+                self.routes[(exchange, routing_key)](message)
+
+    def bulk_update(self):
+        self.timed("database-bulk", self.bulk_updater.bulk_update)
+        self.database_worker.ack_committed_messages()
+
+    def run(self, updates):
+        # shift the stream to the present, since the database discards old updates
+        offset = time.time() - max(update["timestamp"] for update in updates)
+        start = time.perf_counter()
+        for i, update in enumerate(updates, 1):
+            update = dict(update, timestamp=update["timestamp"] + offset)
+            self.bus.publish(update, exchange="bgp-update", routing_key="update")
+            self.deliver()
+            if i % self.bulk_every == 0:
+                self.bulk_update()
+        if self.detection_worker.bgp_update_batch:
+            self.detection_worker.flush_bgp_update_batch()
+            self.deliver()
+        self.bulk_update()
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ARTEMIS offline detection replay")
+    parser.add_argument(
+        "--config",
+        default=os.path.join(TESTING_DIR, "configs", "config.yaml"),
+        help="configuration file used to build the prefix tree",
+    )
+    parser.add_argument(
+        "--testfiles",
+        default=os.path.join(TESTING_DIR, "testfiles"),
+        help="directory of the BGP update testfiles to replay",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="replay this many synthetic updates instead of the testfiles",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="synthetic stream seed")
+    parser.add_argument(
+        "--bulk-every",
+        type=int,
+        default=1000,
+        help="run the database bulk updater every this many updates",
+    )
+    parser.add_argument("--save", help="save the produced hijacks to this file")
+    parser.add_argument(
+        "--compare", help="compare the produced hijacks against this file"
+    )
+    args = parser.parse_args()
+
+    prefix_tree = build_prefix_tree(args.config)
+    if args.synthetic:
+        updates = synthesize_updates(prefix_tree, args.synthetic, args.seed)
+    else:
+        updates = load_testfiles(args.testfiles)
+
+    replay = Replay(prefix_tree, args.bulk_every)
+    elapsed = replay.run(updates)
+
+    print("{} updates in {:.3f}s".format(len(updates), elapsed))
+    print("{:.0f} updates/sec".format(len(updates) / elapsed))
+    for stage, latencies in replay.latencies.items():
+        print(
+            "{:<16} {:>8} calls  {}".format(
+                stage, len(latencies), percentiles(latencies)
+            )
+        )
+    for (exchange, routing_key), count in sorted(replay.bus.published.items()):
+        print("published {:>8} x {}/{}".format(count, exchange, routing_key))
+    for statement, rows in sorted(replay.bulk_updater.wo_db.rows.items()):
+        print("database {:>9} rows x {}".format(rows, statement))
+    print("{} hijacks".format(len(replay.hijacks)))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(replay.hijacks, f, sort_keys=True, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            expected = json.load(f)
+        if expected != json.loads(json.dumps(replay.hijacks)):
+            print("ERROR: hijacks differ from '{}'".format(args.compare))
+            sys.exit(1)
+        print("hijacks match '{}'".format(args.compare))
+
+
+if __name__ == "__main__":
+    main()
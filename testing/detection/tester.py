@@ -41,6 +41,26 @@ DATA_WORKER_DEPENDENCIES = [
     "prefixtree",
 ]
 REST_PORT = 3000
+# hot queries on bgp_updates and the index that each one is expected to use;
+# checked (EXPLAIN) only by this end-to-end test, which runs against the postgres
+# of docker-compose.testdetection.yaml, and not by the unit tests (make unittest)
+INDEXED_QUERIES = [
+    (
+        "SELECT key FROM bgp_updates WHERE hijack_key @> ARRAY[%s]::text[] AND handled = true;",
+        ("a",),
+        "hijack_key_gin_idx",
+    ),
+    (
+        "SELECT key FROM bgp_updates WHERE key = ANY(%s);",
+        (["a"],),
+        "key_idx",
+    ),
+    (
+        "SELECT key, hijack_key FROM bgp_updates WHERE handled = true AND hijack_key<>ARRAY[]::text[];",
+        None,
+        "hijack_updates_idx",
+    ),
+]
 
 
 def wait_data_worker_dependencies(data_worker_dependencies):
@@ -444,6 +464,10 @@ class Tester:
                                 # avoid infinite loop by timeout
                                 assert False, "Consumer timeout"
 
+        db_con = self.getDbConnection()
+        Helper.check_index_usage(db_con)
+        db_con.close()
+
         with open("configs/config.yaml") as f1, open("configs/config2.yaml") as f2:
             new_data = f2.read()
             old_data = f1.read()
@@ -600,6 +624,22 @@ class Helper:
             action, hijack_keys, response["message"]
         )
 
+    @staticmethod
+    def check_index_usage(db_con):
+        db_cur = db_con.cursor()
+        # the tables of the test are small, so the planner is kept off
+        # sequential scans to check whether the indexes can be used
+        db_cur.execute("ANALYZE bgp_updates;")
+        db_cur.execute("SET enable_seqscan = off;")
+        for query, query_arguments, index in INDEXED_QUERIES:
+            db_cur.execute("EXPLAIN " + query, query_arguments)
+            plan = "\n".join(row[0] for row in db_cur.fetchall())
+            assert index in plan, "Index {} not used by '{}':\n{}".format(
+                index, query, plan
+            )
+        db_cur.execute("RESET enable_seqscan;")
+        db_cur.close()
+
     @staticmethod
     def load_as_sets(connection):
         r = requests.get(
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
+import datetime
+import io
+import itertools
 import time
 
 import psycopg2.extras
+from psycopg2 import sql
 
 from . import get_logger
 
@@ -9,6 +13,11 @@ ISOLEVEL = psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
 
 LIMIT_RETRIES = 5
 
+# bounds of the (adaptive) number of rows per COPY page and target duration (sec) of a page
+COPY_MIN_PAGE_SIZE = 1000
+COPY_MAX_PAGE_SIZE = 100000
+COPY_PAGE_DURATION = 1.0
+
 log = get_logger()
 
 
@@ -162,6 +171,80 @@ class DB:
         if not self.readonly:
             self._connection.commit()
 
+    def copy_values(
+        self,
+        table,
+        columns,
+        vals,
+        page_size=COPY_MIN_PAGE_SIZE,
+        on_conflict="ON CONFLICT DO NOTHING",
+    ):
+        # rows are consumed lazily (e.g., from a generator) page by page; each page is
+        # copied into a temporary staging table and then moved to the table, so that
+        # conflicting rows are skipped instead of failing the whole page
+        log.debug("copy_values table {}".format(table))
+        staging_table = sql.Identifier("{}_copy".format(table))
+        column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+        queries = [
+            sql.SQL(
+                "CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)"
+            ).format(staging_table, sql.Identifier(table)),
+            sql.SQL("TRUNCATE {}").format(staging_table),
+            sql.SQL("COPY {} ({}) FROM STDIN").format(staging_table, column_list),
+            sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} {}").format(
+                sql.Identifier(table),
+                column_list,
+                column_list,
+                staging_table,
+                sql.SQL(on_conflict),
+            ),
+        ]
+        vals = iter(vals)
+        num_of_rows = 0
+        while True:
+            page = list(itertools.islice(vals, page_size))
+            if not page:
+                break
+            start = time.time()
+            num_of_rows += self._copy_page(queries, page)
+            # adapt the page size to the target page duration, growing at most 2x per page
+            elapsed = max(time.time() - start, 0.001)
+            page_size = int(
+                min(page_size * COPY_PAGE_DURATION / elapsed, 2 * page_size)
+            )
+            page_size = max(COPY_MIN_PAGE_SIZE, min(page_size, COPY_MAX_PAGE_SIZE))
+        return num_of_rows
+
+    def _copy_page(self, queries, page, retry_counter=0):
+        create_query, truncate_query, copy_query, insert_query = queries
+        try:
+            self._cursor.execute(create_query)
+            self._cursor.execute(truncate_query)
+            self._cursor.copy_expert(
+                copy_query,
+                io.StringIO("".join(copy_text_row(row) for row in page)),
+            )
+            self._cursor.execute(insert_query)
+            num_of_rows = self._cursor.rowcount
+            retry_counter = 0
+        except (psycopg2.DatabaseError, psycopg2.OperationalError) as error:
+            if retry_counter >= LIMIT_RETRIES:
+                raise error
+            retry_counter += 1
+            log.error(
+                "got error {}. retrying {}".format(str(error).strip(), retry_counter)
+            )
+            time.sleep(1)
+            self.reset()
+            return self._copy_page(queries, page, retry_counter)
+        except (Exception, psycopg2.Error) as error:
+            if not self.readonly:
+                self._connection.rollback()
+            raise error
+        if not self.readonly:
+            self._connection.commit()
+        return num_of_rows
+
     def reset(self):
         log.debug("connection reset")
         self.close()
@@ -182,3 +265,36 @@ class DB:
         log.debug("connection init")
         self.connect()
         self.cursor()
+
+
+def copy_text_value(value):
+    # value in the text format of COPY
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        value = "t" if value else "f"
+    elif isinstance(value, (list, tuple)):
+        value = "{{{}}}".format(",".join(map(copy_array_element, value)))
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_array_element(value):
+    # element of an array literal
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def copy_text_row(row):
+    return "\t".join(map(copy_text_value, row)) + "\n"
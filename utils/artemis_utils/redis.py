@@ -1,10 +1,155 @@
 # redis aux functions
 import time
+import warnings
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
 
 from . import get_hash
 from . import log
 
 
+# hijacks are kept in redis as a hash of scalar fields ({redis hijack key}),
+# a set of peers (hijack_{redis hijack key}_peers_seen), a HyperLogLog
+# of infected ASes (hijack_{redis hijack key}_asns_inf) and a capped set of
+# BGP update keys (hijack_{redis hijack key}_bgpupdate_keys)
+REDIS_HIJACK_FLOAT_FIELDS = {
+    "time_started",
+    "time_last",
+    "time_detected",
+    "timestamp_of_config",
+}
+REDIS_HIJACK_INT_FIELDS = {"hijack_as"}
+
+# Lua helpers shared by the redis hijack scripts
+REDIS_HIJACK_LUA_HELPERS = """
+local function sadd_all(key, members)
+    for _, member in ipairs(members) do
+        redis.call("SADD", key, member)
+    end
+end
+
+local function add_bgpupdate_keys(hijack_key, bgpupdate_keys_key, cap, new_keys)
+    if redis.call("HEXISTS", hijack_key, "bgpupdate_keys_spilled") == 1 then
+        return
+    end
+    sadd_all(bgpupdate_keys_key, new_keys)
+    if redis.call("SCARD", bgpupdate_keys_key) > cap then
+        redis.call("DEL", bgpupdate_keys_key)
+        redis.call("HSET", hijack_key, "bgpupdate_keys_spilled", 1)
+    end
+end
+"""
+
+
+# atomically purges the ephemeral and persistent keys of a hijack and
+# returns {hijack fields, peers seen} of the purged hijack; prefix-peer
+# pairs left without hijacks are published as "-{prefix}_{peer}" on the
+# prefix-peer-hijacks channel
+# KEYS: hijack, persistent-keys, hij_orig_neighb, hijack prefixes-peers,
+#       peers seen, infected ASes, BGP update keys
+# ARGV: persistent hijack key
+HIJACK_PURGE_SCRIPT = """
+local hijack = {redis.call("HGETALL", KEYS[1]), redis.call("SMEMBERS", KEYS[5])}
+for _, prefix_peer in ipairs(redis.call("SMEMBERS", KEYS[4])) do
+    local sep = string.find(prefix_peer, "_", 1, true)
+    local prefix_peer_key = "prefix_" .. string.sub(prefix_peer, 1, sep - 1)
+        .. "_peer_" .. string.sub(prefix_peer, sep + 1) .. "_hijacks"
+    redis.call("SREM", prefix_peer_key, KEYS[1])
+    if redis.call("SCARD", prefix_peer_key) == 0 then
+        redis.call("PUBLISH", "prefix-peer-hijacks", "-" .. prefix_peer)
+    end
+end
+redis.call("DEL", KEYS[1], KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7])
+redis.call("SREM", KEYS[2], ARGV[1])
+return hijack
+"""
+
+
+def encode_redis_hijack(hijack: Dict) -> Dict:
+    """
+    Encodes the scalar fields of a hijack as redis hash values.
+    """
+    return {
+        field: "" if value is None else str(value) for field, value in hijack.items()
+    }
+
+
+def decode_redis_hijack(hijack_fields: List[bytes], peers_seen: List[bytes]) -> Dict:
+    """
+    Decodes the (flat) field-value list of a redis hijack hash together with
+    the peers that have seen the hijack.
+    """
+    hijack = {}
+    fields = iter(hijack_fields)
+    for field, value in zip(fields, fields):
+        field = field.decode("utf-8")
+        value = value.decode("utf-8")
+        if field in REDIS_HIJACK_FLOAT_FIELDS:
+            value = float(value)
+        elif field in REDIS_HIJACK_INT_FIELDS:
+            value = int(value)
+        elif value == "":
+            value = None
+        hijack[field] = value
+    hijack.pop("bgpupdate_keys_spilled", None)
+    hijack.pop("version", None)
+    hijack["peers_seen"] = [int(peer) for peer in peers_seen]
+    return hijack
+
+
+def redis_hijack_keys(redis_hijack_key: str) -> List[str]:
+    """
+    Returns the redis keys holding the state of a hijack.
+    """
+    return [
+        redis_hijack_key,
+        "persistent-keys",
+        "hij_orig_neighb_{}".format(redis_hijack_key),
+        "hijack_{}_prefixes_peers".format(redis_hijack_key),
+        "hijack_{}_peers_seen".format(redis_hijack_key),
+        "hijack_{}_asns_inf".format(redis_hijack_key),
+        "hijack_{}_bgpupdate_keys".format(redis_hijack_key),
+    ]
+
+
+def purge_redis_hijack(
+    purge_script: Callable, ephemeral_key: str, persistent_key: str
+) -> Optional[Dict]:
+    """
+    Purges the ephemeral (redis) and persistent keys of a hijack in one
+    atomic step and returns the purged hijack (if any).
+    """
+    hijack_fields, peers_seen = purge_script(
+        keys=redis_hijack_keys(ephemeral_key), args=[persistent_key]
+    )
+    if not hijack_fields:
+        return None
+    return decode_redis_hijack(hijack_fields, peers_seen)
+
+
+def purge_redis_eph_pers_keys(redis_instance, ephemeral_key, persistent_key):
+    """
+    Deprecated: use purge_redis_hijack with HIJACK_PURGE_SCRIPT instead.
+    Kept for the services of previous versions (e.g., the baselines of the
+    detection microbenchmark), which also use the (removed) purge tokens.
+    """
+    warnings.warn(
+        "purge_redis_eph_pers_keys is deprecated, use purge_redis_hijack",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    redis_instance.delete(
+        "{}token_active".format(ephemeral_key), "{}token".format(ephemeral_key)
+    )
+    purge_redis_hijack(
+        redis_instance.register_script(HIJACK_PURGE_SCRIPT),
+        ephemeral_key,
+        persistent_key,
+    )
+
+
 def redis_key(prefix, hijack_as, _type):
     assert (
         isinstance(prefix, str)
@@ -25,39 +170,6 @@ def ping_redis(redis_instance, timeout=5):
             time.sleep(timeout)
 
 
-def purge_redis_eph_pers_keys(redis_instance, ephemeral_key, persistent_key):
-    # to prevent detectors from working in parallel with key deletion
-    redis_instance.set("{}token_active".format(ephemeral_key), "1")
-    if redis_instance.exists("{}token".format(ephemeral_key)):
-        token = redis_instance.blpop("{}token".format(ephemeral_key), timeout=60)
-        if not token:
-            log.info(
-                "Redis cleanup encountered redis token timeout for hijack {}".format(
-                    persistent_key
-                )
-            )
-    redis_pipeline = redis_instance.pipeline()
-    # purge also tokens since they are not relevant any more
-    redis_pipeline.delete("{}token_active".format(ephemeral_key))
-    redis_pipeline.delete("{}token".format(ephemeral_key))
-    redis_pipeline.delete(ephemeral_key)
-    redis_pipeline.srem("persistent-keys", persistent_key)
-    redis_pipeline.delete("hij_orig_neighb_{}".format(ephemeral_key))
-    if redis_instance.exists("hijack_{}_prefixes_peers".format(ephemeral_key)):
-        for element in redis_instance.sscan_iter(
-            "hijack_{}_prefixes_peers".format(ephemeral_key)
-        ):
-            subelems = element.decode("utf-8").split("_")
-            prefix_peer_hijack_set = "prefix_{}_peer_{}_hijacks".format(
-                subelems[0], subelems[1]
-            )
-            redis_pipeline.srem(prefix_peer_hijack_set, ephemeral_key)
-            if redis_instance.scard(prefix_peer_hijack_set) <= 1:
-                redis_pipeline.delete(prefix_peer_hijack_set)
-        redis_pipeline.delete("hijack_{}_prefixes_peers".format(ephemeral_key))
-    redis_pipeline.execute()
-
-
 class RedisExpiryChecker:
     """
     Checker for redis expiry events (stops data worker and allows it to restart automatically)